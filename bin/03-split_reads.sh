@@ -20,7 +20,7 @@ fi
 echo $0 $SAMPLE_NAME
 echo teeing to $LOG_FILE
 date
-time python ${RSW_HOME}/bin/split_read.py ${INPUT_FILE} ${OUTPUT_FILE} ${SPLIT_MARGIN}
+time python ${RSW_HOME}/bin/split_read.py ${INPUT_FILE} ${OUTPUT_FILE} ${SPLIT_MARGIN} "${@:3}"
 chmod g+rw ${LOG_FILE} ${OUTPUT_FILE}
 date
 echo done.
@@ -2,6 +2,8 @@
 
 SAMPLE_NAME=$1
 READ_LENGTH=$2
+#optional; when set, sam output carries @RG/RG:Z: (ID and SM) so add_readgroup_to_sam.py can be skipped
+READ_GROUP=$3
 
 MIN_DISTANCE=2
 MAX_DISTANCE=39999
@@ -22,7 +24,7 @@ fi
 echo $0 $SAMPLE_NAME
 echo teeing to $LOG_FILE
 date
-time python ${RSW_HOME}/bin/identify_pairs.py ${INPUT_FILE} ${OUTPUT_FILE} ${READ_LENGTH} ${MIN_DISTANCE} ${MAX_DISTANCE} 
+time python ${RSW_HOME}/bin/identify_pairs.py ${INPUT_FILE} ${OUTPUT_FILE} ${READ_LENGTH} ${MIN_DISTANCE} ${MAX_DISTANCE} ${READ_GROUP:+${READ_GROUP} ${READ_GROUP}}
 chmod g+rw ${LOG_FILE} ${OUTPUT_FILE}
 date
 echo done.
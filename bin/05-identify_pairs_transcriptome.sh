@@ -2,6 +2,8 @@
 
 SAMPLE_NAME=$1
 READ_LENGTH=$2
+#optional; when set, sam output carries @RG/RG:Z: (ID and SM) so add_readgroup_to_sam.py can be skipped
+READ_GROUP=$3
 
 MIN_DISTANCE=2
 MAX_DISTANCE=39999
@@ -9,11 +11,15 @@ RSW_HOME=`dirname $0`/../
 SCRIPT_NAME=`basename $0 .sh`
 mkdir -p logs
 
-INPUT_FILE=${SAMPLE_NAME}.04-bowtie_align_splits_to_transcriptome_1mm.sam
+INPUT_SUFFIX=.04-bowtie_align_splits_to_transcriptome_1mm.sam
+INPUT_FILE=${SAMPLE_NAME}${INPUT_SUFFIX}
 OUTPUT_FILE=${SAMPLE_NAME}.${SCRIPT_NAME}.rsw
 LOG_FILE=logs/${SAMPLE_NAME}.${SCRIPT_NAME}.log
 
-if [ ! -f ${INPUT_FILE} ]; then
+#given a sample name without _R1/_R2, pair both mates in a single run
+if [ ! -f ${INPUT_FILE} -a -f ${SAMPLE_NAME}_R1${INPUT_SUFFIX} -a -f ${SAMPLE_NAME}_R2${INPUT_SUFFIX} ]; then
+	INPUT_FILE=R1=${SAMPLE_NAME}_R1${INPUT_SUFFIX},R2=${SAMPLE_NAME}_R2${INPUT_SUFFIX}
+elif [ ! -f ${INPUT_FILE} ]; then
 	echo Input file [${INPUT_FILE}] not found. Check specified sample name [${SAMPLE_NAME}] is correct.
 	exit 1
 fi
@@ -22,7 +28,7 @@ fi
 echo $0 $SAMPLE_NAME
 echo teeing to $LOG_FILE
 date
-time python ${RSW_HOME}/bin/identify_pairs.py ${INPUT_FILE} ${OUTPUT_FILE} ${READ_LENGTH} ${MIN_DISTANCE} ${MAX_DISTANCE} 
+time python ${RSW_HOME}/bin/identify_pairs.py ${INPUT_FILE} ${OUTPUT_FILE} ${READ_LENGTH} ${MIN_DISTANCE} ${MAX_DISTANCE} ${READ_GROUP:+${READ_GROUP} ${READ_GROUP}}
 chmod g+rw ${LOG_FILE} ${OUTPUT_FILE}
 date
 echo done.
@@ -1,14 +1,13 @@
 #!/bin/bash
 
 SCRIPTDIR=`dirname $0`
+PREDECESSOR_SUFFIX=.05-identify_pairs_transcriptome.sam
 
 function merge_sam {
-	READ_1=$1
-	READ_2=$2
-	MERGE_FILE=$3
+	MERGE_FILE=$1
+	shift
 	echo Merging to ${MERGE_FILE}...
-	cp ${READ_1} ${MERGE_FILE}
-	grep '^[^@]' ${READ_2} >> ${MERGE_FILE}
+	python ${SCRIPTDIR}/merge_sam.py ${MERGE_FILE} "$@"
 }
 
 function add_read_group {
@@ -20,38 +19,26 @@ function add_read_group {
 }
 
 
-
-merge_sam Sample_21786_R1.05-identify_pairs_transcriptome.sam Sample_21786_R2.05-identify_pairs_transcriptome.sam Sample_21786_ALL.06-postprocess.sam
-merge_sam Sample_21787_R1.05-identify_pairs_transcriptome.sam Sample_21787_R2.05-identify_pairs_transcriptome.sam Sample_21787_ALL.06-postprocess.sam
-merge_sam Sample_21788_R1.05-identify_pairs_transcriptome.sam Sample_21788_R2.05-identify_pairs_transcriptome.sam Sample_21788_ALL.06-postprocess.sam
-merge_sam Sample_21789_R1.05-identify_pairs_transcriptome.sam Sample_21789_R2.05-identify_pairs_transcriptome.sam Sample_21789_ALL.06-postprocess.sam
-merge_sam Sample_21790_R1.05-identify_pairs_transcriptome.sam Sample_21790_R2.05-identify_pairs_transcriptome.sam Sample_21790_ALL.06-postprocess.sam
-merge_sam Sample_21791_R1.05-identify_pairs_transcriptome.sam Sample_21791_R2.05-identify_pairs_transcriptome.sam Sample_21791_ALL.06-postprocess.sam
-merge_sam Sample_21792_R1.05-identify_pairs_transcriptome.sam Sample_21792_R2.05-identify_pairs_transcriptome.sam Sample_21792_ALL.06-postprocess.sam
-merge_sam Sample_21793_R1.05-identify_pairs_transcriptome.sam Sample_21793_R2.05-identify_pairs_transcriptome.sam Sample_21793_ALL.06-postprocess.sam
-merge_sam Sample_21794_R1.05-identify_pairs_transcriptome.sam Sample_21794_R2.05-identify_pairs_transcriptome.sam Sample_21794_ALL.06-postprocess.sam
-merge_sam Sample_21795_R1.05-identify_pairs_transcriptome.sam Sample_21795_R2.05-identify_pairs_transcriptome.sam Sample_21795_ALL.06-postprocess.sam
-merge_sam Sample_21796_R1.05-identify_pairs_transcriptome.sam Sample_21796_R2.05-identify_pairs_transcriptome.sam Sample_21796_ALL.06-postprocess.sam
-merge_sam Sample_21797_R1.05-identify_pairs_transcriptome.sam Sample_21797_R2.05-identify_pairs_transcriptome.sam Sample_21797_ALL.06-postprocess.sam
-
-add_read_group Sample_21786_ALL.06-postprocess.sam
-add_read_group Sample_21787_ALL.06-postprocess.sam
-add_read_group Sample_21788_ALL.06-postprocess.sam
-add_read_group Sample_21789_ALL.06-postprocess.sam
-add_read_group Sample_21790_ALL.06-postprocess.sam
-add_read_group Sample_21791_ALL.06-postprocess.sam
-add_read_group Sample_21792_ALL.06-postprocess.sam
-add_read_group Sample_21793_ALL.06-postprocess.sam
-add_read_group Sample_21794_ALL.06-postprocess.sam
-add_read_group Sample_21795_ALL.06-postprocess.sam
-add_read_group Sample_21796_ALL.06-postprocess.sam
-add_read_group Sample_21797_ALL.06-postprocess.sam
-
-echo 'Merging all headers...'
-grep --no-filename '^@' Sample_*_ALL.06-postprocess.rg.sam | grep -v '^@PG' | sort -k1,1r | uniq > all_samples_merged.06-postprocess.sam
-echo 'Merging all alignments...'
-grep --no-filename -v '^@' Sample_*_ALL.06-postprocess.rg.sam >> all_samples_merged.06-postprocess.sam
-echo 'Changing spaces to tabs'
-sed -i 's/ \+/	/g' all_samples_merged.06-postprocess.sam
+for READ_1 in Sample_*_R1${PREDECESSOR_SUFFIX}; do
+	[ -f "${READ_1}" ] || continue
+	SAMPLE=`basename ${READ_1} _R1${PREDECESSOR_SUFFIX}`
+	merge_sam ${SAMPLE}_ALL.06-postprocess.sam ${READ_1} ${SAMPLE}_R2${PREDECESSOR_SUFFIX}
+	add_read_group ${SAMPLE}_ALL.06-postprocess.sam
+done
+
+#samples paired jointly (R1 and R2 in one identify_pairs run) need no mate merge
+for JOINT in Sample_*${PREDECESSOR_SUFFIX}; do
+	case ${JOINT} in
+		*_R1${PREDECESSOR_SUFFIX}|*_R2${PREDECESSOR_SUFFIX}|"Sample_*${PREDECESSOR_SUFFIX}") continue;;
+	esac
+	SAMPLE=`basename ${JOINT} ${PREDECESSOR_SUFFIX}`
+	merge_sam ${SAMPLE}_ALL.06-postprocess.sam ${JOINT}
+	add_read_group ${SAMPLE}_ALL.06-postprocess.sam
+done
+
+#headers are unioned (minus @PG) and spaces changed to tabs by merge_sam.py
+#(alternatively, pass the comma-separated rg.sam files straight to cluster_gaps.py)
+echo 'Merging all samples...'
+merge_sam all_samples_merged.06-postprocess.sam Sample_*_ALL.06-postprocess.rg.sam
 
 echo Done.
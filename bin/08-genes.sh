@@ -11,25 +11,17 @@ chmod g+rw logs
 LOG_FILE=logs/${SCRIPT_NAME}.log
 
 
-function add_gene_symbol {
-	INPUT_FILE=$1
-	OUTPUT_FILE=$2
+function add_gene_symbols {
 	TRANSCRIPT_COLUMN_INDEX=0
-	echo "Adding gene symbol to ${INPUT_FILE}..."
-	
-	"${BIN_DIR}"/transcript_to_gene_symbol.py ${INPUT_FILE} ${TRANSCRIPT_COLUMN_INDEX} ${TRANSCRIPT_MAPPING_FILE} ${OUTPUT_FILE}
-
+	echo "Adding gene symbols to $@..."
+	#each argument is infile=outfile; the mapping is loaded once for all files
+	"${BIN_DIR}"/transcript_to_gene_symbol.py --batch ${TRANSCRIPT_COLUMN_INDEX} ${TRANSCRIPT_MAPPING_FILE} "$@"
 }
 
-function convert_sam_to_bam {
-	BASENAME=`basename $1 .sam`
-	BAMNAME=${BASENAME}.bam
-	SORTEDNAME=${BASENAME}.sorted
-	INDEXEDNAME=${SORTEDNAME}.bam
-	echo Converting $1 to ${BAMNAME}...
-	time samtools view -bS $1 > ${BAMNAME}
-	time samtools sort ${BAMNAME} ${SORTEDNAME}
-	time samtools index ${INDEXEDNAME}
+function link_gene_symbols {
+	#07-cluster already appended gene symbols; link rather than rewrite
+	echo "Linking $1 to $2..."
+	ln -f $1 $2
 }
 
 
@@ -37,9 +29,17 @@ function convert_sam_to_bam {
 echo teeing to $LOG_FILE
 date
 
-add_gene_symbol ${PREDECESSOR_PREFIX}.sorted.tab ${OUTPUT_BASE_NAME}.tab
-add_gene_symbol ${PREDECESSOR_PREFIX}.cluster-groups.tab ${OUTPUT_BASE_NAME}.cluster-groups.tab
-add_gene_symbol ${PREDECESSOR_PREFIX}.sample-groups.tab ${OUTPUT_BASE_NAME}.sample-groups.tab
+#the gap file is annotated in chromosome/cluster/sample order (see 07-cluster)
+if grep -q -m 1 "^#chromosome.*gene_symbol$" ${PREDECESSOR_PREFIX}.sorted.tab; then
+	link_gene_symbols ${PREDECESSOR_PREFIX}.sorted.tab ${OUTPUT_BASE_NAME}.tab
+	link_gene_symbols ${PREDECESSOR_PREFIX}.cluster-groups.tab ${OUTPUT_BASE_NAME}.cluster-groups.tab
+	link_gene_symbols ${PREDECESSOR_PREFIX}.sample-groups.tab ${OUTPUT_BASE_NAME}.sample-groups.tab
+else
+	add_gene_symbols \
+		${PREDECESSOR_PREFIX}.sorted.tab=${OUTPUT_BASE_NAME}.tab \
+		${PREDECESSOR_PREFIX}.cluster-groups.tab=${OUTPUT_BASE_NAME}.cluster-groups.tab \
+		${PREDECESSOR_PREFIX}.sample-groups.tab=${OUTPUT_BASE_NAME}.sample-groups.tab
+fi
 
 chmod g+rw ${LOG_FILE} *.${SCRIPT_NAME}.* 
 date
@@ -1,33 +1,64 @@
 #! /usr/bin/env python
-""" Quick script to add readgroup lines to sam files. Script also appends the optional 'RG' tag data to the end of each data line. """
+""" Quick script to add readgroup lines to sam files. Script also appends the optional 'RG' tag data to the end of each data line.
+
+The input is streamed in large blocks (so memory use does not grow with the
+size of the SAM) and the tag is appended to every line of a block with a
+single bytes replace. add_read_group can be imported to tag alignments inline
+from other stages."""
 
 import sys, os
-    
+
+_BLOCK_SIZE = 8 * 1024 * 1024
+
+def _tag_lines(block, suffix):
+    """Appends suffix to each newline-terminated line in block."""
+    if b"\r" in block:
+        block = block.replace(b"\r\n", b"\n")
+    return block.replace(b"\n", suffix + b"\n")
+
+def add_read_group(reader, writer, rg_id, rg_sample, block_size=_BLOCK_SIZE):
+    """Copies SAM from binary reader to binary writer, adding an @RG header
+    line (ahead of the first @PG line, or at the end of the header) and an
+    RG:Z: tag on every alignment."""
+    read_group_line = "@RG\tID:{0}\tSM:{1}\n".format(rg_id, rg_sample).encode()
+    suffix = "\tRG:Z:{0}".format(rg_id).encode()
+
+    read_group_written = False
+    line = reader.readline()
+    while line.startswith(b"@"):
+        if line.startswith(b"@PG") and not read_group_written:
+            writer.write(read_group_line)
+            read_group_written = True
+        writer.write(line)
+        line = reader.readline()
+    if not read_group_written:
+        writer.write(read_group_line)
+
+    remainder = line
+    while True:
+        block = reader.read(block_size)
+        if not block:
+            break
+        block = remainder + block
+        end = block.rfind(b"\n") + 1
+        remainder = block[end:]
+        writer.write(_tag_lines(block[:end], suffix))
+    if remainder.strip():
+        writer.write(_tag_lines(remainder.rstrip() + b"\n", suffix))
+
 if __name__ == '__main__':
-    
-	if (len(sys.argv) != 5):
-		print "usage: {0} [sam infile] [ReadGroup ID] [ReadGroup sample] [outfile]".format(os.path.basename(sys.argv[0]))
-		sys.exit()
-            
-	sam_filename = sys.argv[1]
-	rg_id = sys.argv[2]
-	rg_sample = sys.argv[3]
-	outfile_name = sys.argv[4]
-
-	newline = "@RG\tID:{0}\tSM:{1}\n".format(rg_id, rg_sample)
-	
-	sam_file = file(sam_filename)
-	outfile = file(outfile_name, "w")
-
-	for line in sam_file.readlines():
-		if line.startswith("@PG"):
-			outfile.write(newline)
-			outfile.write(line)
-		elif line.startswith("@"):
-			outfile.write(line)
-		else:
-			line = line.strip()
-			newline = "{0}\tRG:Z:{1}\n".format(line, rg_id)
-			outfile.write(newline)
-    
-	print "done."
+
+    if (len(sys.argv) != 5):
+        print ("usage: {0} [sam infile] [ReadGroup ID] [ReadGroup sample] [outfile]".format(os.path.basename(sys.argv[0])))
+        sys.exit()
+
+    SAM_FILENAME = sys.argv[1]
+    RG_ID = sys.argv[2]
+    RG_SAMPLE = sys.argv[3]
+    OUTFILE_NAME = sys.argv[4]
+
+    with open(SAM_FILENAME, "rb") as SAM_FILE:
+        with open(OUTFILE_NAME, "wb") as OUTFILE:
+            add_read_group(SAM_FILE, OUTFILE, RG_ID, RG_SAMPLE)
+
+    print ("done.")
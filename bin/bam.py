@@ -0,0 +1,820 @@
+#! /usr/bin/env python
+
+"""
+bam.py
+Reads and writes BAM alignment files (without samtools or pysam). BAM input
+is read as SAM text lines, so the line based stages (identify_pairs,
+cluster_gaps, merge_sam) accept BAM input wherever they accept SAM.
+
+BgzfReader reads the BGZF blocks of the file and inflates them (zlib, which
+releases the GIL) in a thread pool, a batch at a time; the next batch is
+inflated while the current one is decoded. BamReader decodes the binary
+header and alignment records straight into SAM fields. Passes which only
+read the core fields (name, flag, reference, positions, template length,
+sequence length and tags) can ask for lines without sequences: SEQ is then a
+placeholder of the correct length ("N"s) and QUAL is "*", which skips the
+(relatively expensive) decoding of the packed bases and qualities.
+
+open_alignments() opens either format, recognizing BAM by content rather
+than file extension.
+
+BamWriter is the reverse: a file-like object which accepts the SAM text the
+stages already write and encodes it as BAM, compressing BGZF blocks on a
+thread pool (BgzfWriter). With sort, alignments are held in memory-bounded
+runs (spilled to disk as sorted runs when the bound is reached), merged in
+coordinate order at close and indexed as they are written (BamIndex, a .bai
+index), replacing samtools view -bS / sort / index. open_alignment_output()
+chooses SAM or BAM output by file extension.
+"""
+from contextlib import contextmanager
+import heapq
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zlib
+
+_DEFAULT_THREADS = 4
+_BATCH_BLOCKS = 64
+_LINES_PER_BLOCK = 10000
+_CACHE_SIZE = 100000
+_GZIP_MAGIC = b"\x1f\x8b\x08\x04"
+_BAM_MAGIC = b"BAM\x01"
+_BLOCK_DATA_SIZE = 0xff00
+_COMPRESSION_LEVEL = 6
+_EOF_BLOCK = _GZIP_MAGIC + b"\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" \
+    b"\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+_SORT_MEMORY_MB = 512
+# approximate per-record cost of a list of byte strings held for sorting
+_SORT_RECORD_OVERHEAD = 48
+_RUN_READ_SIZE = 4 * 1024 * 1024
+_METADATA_BIN = 37450
+
+_CORE = struct.Struct("<iiBBHHHiiii")
+_INT32 = struct.Struct("<i")
+_REFERENCE_POSITION = struct.Struct("<ii")
+# l_read_name, (mapq), bin, n_cigar_op, flag
+_INDEX_FIELDS = struct.Struct("<BxHHH")
+_CIGAR_OPS = "MIDNSHP=X"
+_CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+_REFERENCE_OPS = "MDN=X"
+_SEQ_CODES = "=ACMGRSVTWYHKDBN"
+_SEQ_PAIRS = [first + second for first in _SEQ_CODES for second in _SEQ_CODES]
+_QUAL_TABLE = "".join(chr((i + 33) % 256) for i in range(256))
+_SEQ_PACK = dict((_SEQ_CODES[i] + _SEQ_CODES[j], chr(i << 4 | j))
+    for i in range(16) for j in range(16))
+_QUAL_ENCODE_TABLE = "".join(chr((i - 33) % 256) for i in range(256))
+# tag type -> (struct format, size); integer types are written as SAM "i"
+_TAG_VALUES = {"c": ("<b", 1), "C": ("<B", 1), "s": ("<h", 2),
+    "S": ("<H", 2), "i": ("<i", 4), "I": ("<I", 4), "f": ("<f", 4)}
+
+
+class BamError(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class BamFormatError(BamError):
+    def __init__(self, file_name, message):
+        super(BamFormatError, self).__init__()
+        self.file_name = file_name
+        self.message = message
+
+    def __str__(self):
+        return repr("Could not read BAM file [{0}]: {1}". \
+            format(self.file_name, self.message))
+
+
+def _inflate(block):
+    (file_name, data, size) = block
+    inflated = zlib.decompress(data, -15)
+    if len(inflated) != size:
+        raise BamFormatError(file_name, "BGZF block size mismatch")
+    return inflated
+
+
+class BgzfReader():
+    """Iterates the inflated contents of a BGZF file in batches of blocks
+    (see module doc)."""
+
+    def __init__(self, file_name, threads=_DEFAULT_THREADS,
+            batch_blocks=_BATCH_BLOCKS):
+        self.file_name = file_name
+        self._threads = threads
+        self._batch_blocks = batch_blocks
+
+    def _read_block(self, reader):
+        """Returns (file_name, compressed data, inflated size) for the next
+        block or None at end of file."""
+        header = reader.read(12)
+        if not header:
+            return None
+        if len(header) < 12 or header[0:4] != _GZIP_MAGIC:
+            raise BamFormatError(self.file_name, "not a BGZF file")
+        extra_len = struct.unpack("<H", header[10:12])[0]
+        extra = reader.read(extra_len)
+        block_size = None
+        index = 0
+        while index + 4 <= len(extra):
+            field_len = struct.unpack("<H", extra[index + 2:index + 4])[0]
+            if extra[index:index + 2] == b"BC":
+                block_size = struct.unpack("<H",
+                    extra[index + 4:index + 6])[0] + 1
+            index += 4 + field_len
+        if block_size is None:
+            raise BamFormatError(self.file_name, "missing BGZF block size")
+        data = reader.read(block_size - extra_len - 20)
+        trailer = reader.read(8)
+        if len(trailer) < 8:
+            raise BamFormatError(self.file_name, "truncated BGZF block")
+        return (self.file_name, data, struct.unpack("<I", trailer[4:8])[0])
+
+    def _read_batch(self, reader):
+        blocks = []
+        while len(blocks) < self._batch_blocks:
+            block = self._read_block(reader)
+            if block is None:
+                break
+            blocks.append(block)
+        return blocks
+
+    def batches(self):
+        """Yields the inflated contents of each batch of blocks."""
+        pool = ThreadPool(self._threads)
+        try:
+            with open(self.file_name, "rb") as reader:
+                pending = pool.map_async(_inflate, self._read_batch(reader))
+                while True:
+                    inflated = pending.get()
+                    if not inflated:
+                        break
+                    pending = pool.map_async(_inflate,
+                        self._read_batch(reader))
+                    yield b"".join(inflated)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class _BlockBuffer():
+    """Inflated data with a read offset, refilled from an iterator of
+    blocks."""
+
+    def __init__(self, file_name, blocks):
+        self._file_name = file_name
+        self._blocks = iter(blocks)
+        self.data = b""
+        self.offset = 0
+
+    def fill(self, size):
+        """Makes size bytes available from offset; returns False if the input
+        ends first."""
+        while len(self.data) - self.offset < size:
+            block = next(self._blocks, None)
+            if block is None:
+                return False
+            self.data = self.data[self.offset:] + block
+            self.offset = 0
+        return True
+
+    def take(self, size):
+        if not self.fill(size):
+            raise BamFormatError(self._file_name, "unexpected end of file")
+        value = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return value
+
+
+def _cigar_text(data):
+    if not data:
+        return "*"
+    return "".join(["{0}{1}".format(op >> 4, _CIGAR_OPS[op & 15])
+        for op in struct.unpack("<{0}I".format(len(data) // 4), data)])
+
+def _tags_text(data):
+    """Returns the tags in data as SAM optional fields (each preceded by a
+    tab)."""
+    (fields, offset, end) = ([""], 0, len(data))
+    while offset < end:
+        (tag, tag_type) = (data[offset:offset + 2], data[offset + 2])
+        offset += 3
+        if tag_type == "Z" or tag_type == "H":
+            stop = data.index(b"\x00", offset)
+            value = data[offset:stop]
+            offset = stop + 1
+        elif tag_type == "A":
+            value = data[offset]
+            offset += 1
+        elif tag_type == "B":
+            (sub_type, count) = (data[offset],
+                _INT32.unpack_from(data, offset + 1)[0])
+            (value_format, size) = _TAG_VALUES[sub_type]
+            values = struct.unpack_from("<{0}{1}".format(count,
+                value_format[1]), data, offset + 5)
+            template = "{0:g}" if sub_type == "f" else "{0}"
+            value = ",".join([sub_type] +
+                [template.format(item) for item in values])
+            offset += 5 + count * size
+        else:
+            (value_format, size) = _TAG_VALUES[tag_type]
+            value = struct.unpack_from(value_format, data, offset)[0]
+            if tag_type == "f":
+                value = "{0:g}".format(value)
+            else:
+                tag_type = "i"
+            offset += size
+        fields.append("{0}:{1}:{2}".format(tag, tag_type, value))
+    return "\t".join(fields)
+
+
+class BamReader():
+    """Reads a BAM file as SAM text lines (see module doc)."""
+
+    def __init__(self, file_name, threads=_DEFAULT_THREADS):
+        self.file_name = file_name
+        self._threads = threads
+        self._references = []
+        self._cigars = {}
+        self._tags = {}
+
+    def _header_lines(self, buffer):
+        if buffer.take(4) != _BAM_MAGIC:
+            raise BamFormatError(self.file_name, "not a BAM file")
+        text_len = _INT32.unpack(buffer.take(4))[0]
+        text = buffer.take(text_len).rstrip(b"\x00")
+        header_lines = [line + "\n" for line in text.splitlines() if line]
+        reference_count = _INT32.unpack(buffer.take(4))[0]
+        self._references = []
+        reference_lines = []
+        for _ in range(reference_count):
+            name_len = _INT32.unpack(buffer.take(4))[0]
+            name = buffer.take(name_len).rstrip(b"\x00")
+            length = _INT32.unpack(buffer.take(4))[0]
+            self._references.append(name)
+            reference_lines.append("@SQ\tSN:{0}\tLN:{1}\n".format(name,
+                length))
+        if any(line.startswith("@SQ") for line in header_lines):
+            return header_lines
+        # the text header may omit the references; SAM output needs them
+        version_lines = [line for line in header_lines if line.startswith("@HD")]
+        other_lines = [line for line in header_lines if not line.startswith("@HD")]
+        return version_lines + reference_lines + other_lines
+
+    def _cached(self, cache, raw, decode):
+        """Returns decode(raw), memoized in cache; cigars and tags repeat
+        heavily across alignments."""
+        value = cache.get(raw)
+        if value is None:
+            if len(cache) >= _CACHE_SIZE:
+                cache.clear()
+            value = cache[raw] = decode(raw)
+        return value
+
+    def _line(self, data, offset, end, sequences):
+        (reference_id, position, name_len, mapq, _, cigar_len, flag,
+            seq_len, next_reference_id, next_position, template_len) = \
+            _CORE.unpack_from(data, offset)
+        offset += _CORE.size
+        name = data[offset:offset + name_len - 1]
+        offset += name_len
+        cigar = self._cached(self._cigars, data[offset:offset + 4 * cigar_len],
+            _cigar_text)
+        offset += 4 * cigar_len
+        packed_len = (seq_len + 1) // 2
+        if not seq_len:
+            (seq, qual) = ("*", "*")
+        elif not sequences:
+            (seq, qual) = ("N" * seq_len, "*")
+        else:
+            seq = "".join([_SEQ_PAIRS[code] for code in
+                bytearray(data[offset:offset + packed_len])])[:seq_len]
+            qual = "*" if data[offset + packed_len] == b"\xff" else \
+                data[offset + packed_len:offset + packed_len + seq_len]. \
+                translate(_QUAL_TABLE)
+        offset += packed_len + seq_len
+        tags = self._cached(self._tags, data[offset:end], _tags_text) \
+            if offset < end else ""
+
+        references = self._references
+        reference = references[reference_id] if reference_id >= 0 else "*"
+        if next_reference_id < 0:
+            next_reference = "*"
+        elif next_reference_id == reference_id:
+            next_reference = "="
+        else:
+            next_reference = references[next_reference_id]
+        return "%s\t%d\t%s\t%d\t%d\t%s\t%s\t%d\t%d\t%s\t%s%s\n" % (name,
+            flag, reference, position + 1, mapq, cigar, next_reference,
+            next_position + 1, template_len, seq, qual, tags)
+
+    def line_blocks(self, sequences=True):
+        """Yields lists of SAM lines: the header lines, then the alignments
+        of each inflated batch (gathered into lists of at least
+        _LINES_PER_BLOCK)."""
+        buffer = _BlockBuffer(self.file_name,
+            BgzfReader(self.file_name, self._threads).batches())
+        yield self._header_lines(buffer)
+        lines = []
+        while True:
+            (data, offset) = (buffer.data, buffer.offset)
+            data_len = len(data)
+            while offset + 4 <= data_len:
+                end = offset + 4 + _INT32.unpack_from(data, offset)[0]
+                if end > data_len:
+                    break
+                lines.append(self._line(data, offset + 4, end, sequences))
+                offset = end
+            buffer.offset = offset
+            if len(lines) >= _LINES_PER_BLOCK:
+                yield lines
+                lines = []
+            # the remainder is a partial record; append the next batch
+            if not buffer.fill(data_len - offset + 1):
+                break
+        if buffer.offset < len(buffer.data):
+            raise BamFormatError(self.file_name, "truncated alignment")
+        if lines:
+            yield lines
+
+    def lines(self, sequences=True):
+        for block in self.line_blocks(sequences):
+            for line in block:
+                yield line
+
+
+def _deflate(data):
+    """Returns data compressed as one BGZF block."""
+    compressor = zlib.compressobj(_COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return _GZIP_MAGIC + b"\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + \
+        struct.pack("<H", len(compressed) + 25) + compressed + \
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter():
+    """Writes a BGZF file; blocks are compressed on a thread pool a batch at
+    a time while the caller fills the next batch.
+
+    tell() returns a logical offset (block number and offset within the
+    block) because compressed block addresses are only known once earlier
+    blocks are compressed; virtual_offset() converts it to a BAM virtual
+    file offset after close()."""
+
+    def __init__(self, file_name, threads=_DEFAULT_THREADS,
+            batch_blocks=_BATCH_BLOCKS):
+        self.file_name = file_name
+        self._batch_blocks = batch_blocks
+        self._file = open(file_name, "wb")
+        self._pool = ThreadPool(threads)
+        self._pending = None
+        self._buffer = []
+        self._buffer_len = 0
+        self._blocks = []
+        self._block_count = 0
+        self._addresses = []
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_len += len(data)
+        if self._buffer_len >= _BLOCK_DATA_SIZE:
+            data = b"".join(self._buffer)
+            start = 0
+            while len(data) - start >= _BLOCK_DATA_SIZE:
+                self._add_block(data[start:start + _BLOCK_DATA_SIZE])
+                start += _BLOCK_DATA_SIZE
+            self._buffer = [data[start:]]
+            self._buffer_len = len(data) - start
+
+    def tell(self):
+        return self._block_count << 16 | self._buffer_len
+
+    def virtual_offset(self, logical_offset):
+        return self._addresses[logical_offset >> 16] << 16 | \
+            logical_offset & 0xffff
+
+    def _add_block(self, data):
+        self._blocks.append(data)
+        self._block_count += 1
+        if len(self._blocks) == self._batch_blocks:
+            self._compress_blocks()
+
+    def _compress_blocks(self):
+        self._write_pending()
+        self._pending = self._pool.map_async(_deflate, self._blocks)
+        self._blocks = []
+
+    def _write_pending(self):
+        if self._pending:
+            for block in self._pending.get():
+                self._addresses.append(self._file.tell())
+                self._file.write(block)
+            self._pending = None
+
+    def close(self):
+        try:
+            if self._buffer_len:
+                self._add_block(b"".join(self._buffer))
+                (self._buffer, self._buffer_len) = ([], 0)
+            self._compress_blocks()
+            self._write_pending()
+            self._addresses.append(self._file.tell())
+            self._file.write(_EOF_BLOCK)
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._file.close()
+
+
+def _reg2bin(start, end):
+    """Returns the BAM bin of the 0-based region [start, end) (see the SAM
+    specification)."""
+    end -= 1
+    for (shift, offset) in ((14, 4681), (17, 585), (20, 73), (23, 9),
+            (26, 1)):
+        if start >> shift == end >> shift:
+            return offset + (start >> shift)
+    return 0
+
+def _cigar_bytes(cigar):
+    """Returns (packed cigar, reference length) for a SAM cigar string."""
+    if cigar == "*":
+        return (b"", 0)
+    operations = _CIGAR_RE.findall(cigar)
+    if "".join(length + op for (length, op) in operations) != cigar:
+        raise ValueError("invalid cigar [{0}]".format(cigar))
+    packed = b"".join([struct.pack("<I", int(length) << 4 |
+        _CIGAR_OPS.index(op)) for (length, op) in operations])
+    reference_len = sum([int(length) for (length, op) in operations
+        if op in _REFERENCE_OPS])
+    return (packed, reference_len)
+
+def _int_tag(value):
+    if value < 0:
+        for (tag_type, minimum) in (("c", -0x80), ("s", -0x8000)):
+            if value >= minimum:
+                return tag_type + struct.pack(_TAG_VALUES[tag_type][0], value)
+        return "i" + struct.pack("<i", value)
+    for (tag_type, maximum) in (("C", 0xff), ("S", 0xffff)):
+        if value <= maximum:
+            return tag_type + struct.pack(_TAG_VALUES[tag_type][0], value)
+    return "I" + struct.pack("<I", value)
+
+def _tags_bytes(text):
+    """Returns SAM optional fields (separated by tabs or spaces) as BAM
+    tags."""
+    tags = []
+    for field in text.split():
+        (tag, tag_type, value) = field.split(":", 2)
+        if tag_type == "i":
+            tags.append(tag + _int_tag(int(value)))
+        elif tag_type in ("Z", "H", "A"):
+            tags.append(tag + tag_type + value +
+                (b"" if tag_type == "A" else b"\x00"))
+        elif tag_type == "f":
+            tags.append(tag + "f" + struct.pack("<f", float(value)))
+        elif tag_type == "B":
+            items = value.split(",")
+            (sub_type, values) = (items[0], items[1:])
+            converter = float if sub_type == "f" else int
+            tags.append(tag + "B" + sub_type +
+                _INT32.pack(len(values)) +
+                struct.pack("<{0}{1}".format(len(values),
+                _TAG_VALUES[sub_type][0][1]),
+                *[converter(item) for item in values]))
+        else:
+            raise ValueError("unknown tag type [{0}]".format(field))
+    return b"".join(tags)
+
+def _pack_seq(seq):
+    if len(seq) % 2:
+        seq += "="
+    return b"".join([_SEQ_PACK[seq[i:i + 2]] for i in range(0, len(seq), 2)])
+
+def _sort_key(record):
+    """Coordinate order: reference, then position; unplaced alignments
+    (reference -1) last."""
+    (reference_id, position) = _REFERENCE_POSITION.unpack_from(record, 4)
+    return (reference_id & 0xffffffff) << 32 | position + 1
+
+def _run_records(file_name, run_index):
+    """Yields (sort key, run index, record) for the records of a sorted
+    run."""
+    with open(file_name, "rb") as run_file:
+        (data, offset) = (b"", 0)
+        while True:
+            chunk = run_file.read(_RUN_READ_SIZE)
+            if not chunk:
+                break
+            data = data[offset:] + chunk
+            offset = 0
+            while offset + 4 <= len(data):
+                end = offset + 4 + _INT32.unpack_from(data, offset)[0]
+                if end > len(data):
+                    break
+                record = data[offset:end]
+                yield (_sort_key(record), run_index, record)
+                offset = end
+
+
+class _ReferenceIndex():
+    """Bins, linear index and counts for the alignments of one reference."""
+
+    def __init__(self):
+        self.bins = {}
+        self.linear = []
+        self.start = None
+        self.end = None
+        self.mapped = 0
+        self.unmapped = 0
+
+
+class BamIndex():
+    """Builds a .bai index from the coordinate sorted records of a BAM file
+    as they are written (offsets are BgzfWriter logical offsets)."""
+
+    def __init__(self, reference_count):
+        self._references = [_ReferenceIndex()
+            for _ in range(reference_count)]
+        self._unplaced = 0
+
+    def add(self, record, start, end):
+        (reference_id, position) = _REFERENCE_POSITION.unpack_from(record, 4)
+        if reference_id < 0:
+            self._unplaced += 1
+            return
+        reference = self._references[reference_id]
+        (name_len, bin_number, cigar_len, flag) = \
+            _INDEX_FIELDS.unpack_from(record, 12)
+        if flag & 4:
+            reference.unmapped += 1
+            reference_end = position + 1
+        else:
+            reference.mapped += 1
+            cigar_offset = 4 + _CORE.size + name_len
+            reference_end = position + max(1, sum([op >> 4 for op in
+                struct.unpack_from("<{0}I".format(cigar_len), record,
+                cigar_offset) if _CIGAR_OPS[op & 15] in _REFERENCE_OPS]))
+
+        chunks = reference.bins.setdefault(bin_number, [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+        linear = reference.linear
+        last_window = (reference_end - 1) >> 14
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(position >> 14, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start
+        if reference.start is None:
+            reference.start = start
+        reference.end = end
+
+    def write(self, file_name, virtual_offset):
+        """Writes the index; virtual_offset converts logical offsets."""
+        with open(file_name, "wb") as index_file:
+            index_file.write(b"BAI\x01" +
+                _INT32.pack(len(self._references)))
+            for reference in self._references:
+                bins = sorted(reference.bins.items())
+                if reference.start is not None:
+                    bins.append((_METADATA_BIN, None))
+                index_file.write(_INT32.pack(len(bins)))
+                for (bin_number, chunks) in bins:
+                    if chunks is None:
+                        pairs = [(virtual_offset(reference.start),
+                            virtual_offset(reference.end)),
+                            (reference.mapped, reference.unmapped)]
+                    else:
+                        pairs = [(virtual_offset(chunk_start),
+                            virtual_offset(chunk_end))
+                            for (chunk_start, chunk_end) in chunks]
+                    index_file.write(struct.pack("<Ii", bin_number,
+                        len(pairs)))
+                    for pair in pairs:
+                        index_file.write(struct.pack("<QQ", *pair))
+                index_file.write(_INT32.pack(len(reference.linear)))
+                previous = 0
+                for window_offset in reference.linear:
+                    if window_offset is not None:
+                        previous = virtual_offset(window_offset)
+                    index_file.write(struct.pack("<Q", previous))
+            index_file.write(struct.pack("<Q", self._unplaced))
+
+
+class BamWriter():
+    """File-like writer which accepts SAM text and writes it as BAM. If sort,
+    alignments are coordinate sorted (in memory-bounded runs spilled to
+    spill_dir, merged at close) and a .bai index is written alongside."""
+
+    def __init__(self, file_name, sort=False, threads=_DEFAULT_THREADS,
+            max_memory_mb=_SORT_MEMORY_MB, spill_dir=None):
+        self.file_name = file_name
+        self._sort = sort
+        self._max_sort_bytes = max_memory_mb * 1024 * 1024
+        self._spill_dir = spill_dir
+        self._bgzf = BgzfWriter(file_name, threads)
+        self._header_lines = []
+        self._reference_ids = None
+        self._partial = ""
+        self._cigars = {}
+        self._tags = {}
+        self._sort_records = []
+        self._sort_bytes = 0
+        self._run_dir = None
+        self._run_file_names = []
+
+    def write(self, text):
+        if self._partial:
+            text = self._partial + text
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if line:
+                self._write_line(line.rstrip("\r"))
+
+    def _write_line(self, line):
+        if line.startswith("@"):
+            if self._reference_ids is not None:
+                raise BamFormatError(self.file_name,
+                    "header line after alignments [{0}]".format(line))
+            self._header_lines.append(line)
+            return
+        if self._reference_ids is None:
+            self._write_header()
+        record = self._record(line)
+        if self._sort:
+            self._sort_records.append(record)
+            self._sort_bytes += len(record) + _SORT_RECORD_OVERHEAD
+            if self._sort_bytes >= self._max_sort_bytes:
+                self._spill()
+        else:
+            self._bgzf.write(record)
+
+    def _write_header(self):
+        header_lines = self._header_lines
+        if self._sort:
+            header_lines = [line for line in header_lines
+                if not line.startswith("@HD")]
+            version_lines = [line for line in self._header_lines
+                if line.startswith("@HD")] or ["@HD\tVN:1.0"]
+            header_lines.insert(0, "\t".join([field for field
+                in version_lines[0].split("\t")
+                if not field.startswith("SO:")] + ["SO:coordinate"]))
+        references = []
+        for line in header_lines:
+            if line.startswith("@SQ"):
+                fields = dict(field.split(":", 1)
+                    for field in line.split("\t")[1:] if ":" in field)
+                references.append((fields["SN"], int(fields.get("LN", 0))))
+        self._reference_ids = dict((name, reference_id) for
+            (reference_id, (name, _)) in enumerate(references))
+
+        text = "".join(line + "\n" for line in header_lines)
+        self._bgzf.write(_BAM_MAGIC + _INT32.pack(len(text)) + text +
+            _INT32.pack(len(references)))
+        for (name, length) in references:
+            self._bgzf.write(_INT32.pack(len(name) + 1) + name + b"\x00" +
+                _INT32.pack(length))
+
+    def _reference_id(self, name):
+        if name == "*":
+            return -1
+        try:
+            return self._reference_ids[name]
+        except KeyError:
+            raise BamFormatError(self.file_name,
+                "reference [{0}] is not in the header".format(name))
+
+    def _cached(self, cache, text, encode):
+        value = cache.get(text)
+        if value is None:
+            if len(cache) >= _CACHE_SIZE:
+                cache.clear()
+            value = cache[text] = encode(text)
+        return value
+
+    def _record(self, line):
+        fields = line.split("\t", 11)
+        try:
+            (name, flag, reference, position, mapq, cigar, next_reference,
+                next_position, template_len, seq, qual) = fields[:11]
+            reference_id = self._reference_id(reference)
+            next_reference_id = reference_id if next_reference == "=" \
+                else self._reference_id(next_reference)
+            position = int(position) - 1
+            (packed_cigar, reference_len) = self._cached(self._cigars, cigar,
+                _cigar_bytes)
+            tags = self._cached(self._tags, fields[11], _tags_bytes) \
+                if len(fields) > 11 else b""
+            if seq == "*":
+                (seq_len, packed_seq, packed_qual) = (0, b"", b"")
+            else:
+                seq_len = len(seq)
+                packed_seq = _pack_seq(seq.upper())
+                packed_qual = b"\xff" * seq_len if qual == "*" \
+                    else qual.translate(_QUAL_ENCODE_TABLE)
+                if len(packed_qual) != seq_len:
+                    raise ValueError("SEQ and QUAL lengths differ")
+            body = _CORE.pack(reference_id, position, len(name) + 1,
+                int(mapq), _reg2bin(position, position + max(reference_len, 1)),
+                len(packed_cigar) // 4, int(flag), seq_len, next_reference_id,
+                int(next_position) - 1, int(template_len)) + name + \
+                b"\x00" + packed_cigar + packed_seq + packed_qual + tags
+        except (ValueError, KeyError, struct.error) as error:
+            raise BamFormatError(self.file_name,
+                "could not encode [{0}]: {1}".format(line, error))
+        return _INT32.pack(len(body)) + body
+
+    def _spill(self):
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix="bam_sort.",
+                dir=self._spill_dir)
+        self._sort_records.sort(key=_sort_key)
+        run_file_name = os.path.join(self._run_dir,
+            "run.{0}".format(len(self._run_file_names)))
+        with open(run_file_name, "wb") as run_file:
+            run_file.write(b"".join(self._sort_records))
+        self._run_file_names.append(run_file_name)
+        (self._sort_records, self._sort_bytes) = ([], 0)
+
+    def _write_sorted(self):
+        if self._run_file_names:
+            if self._sort_records:
+                self._spill()
+            records = (record for (_, _, record) in heapq.merge(
+                *[_run_records(file_name, index) for (index, file_name)
+                in enumerate(self._run_file_names)]))
+        else:
+            self._sort_records.sort(key=_sort_key)
+            records = self._sort_records
+        index = BamIndex(len(self._reference_ids))
+        bgzf = self._bgzf
+        for record in records:
+            start = bgzf.tell()
+            bgzf.write(record)
+            index.add(record, start, bgzf.tell())
+        self._sort_records = []
+        return index
+
+    def close(self):
+        try:
+            if self._partial:
+                self._write_line(self._partial.rstrip("\r"))
+                self._partial = ""
+            if self._reference_ids is None:
+                self._write_header()
+            index = self._write_sorted() if self._sort else None
+            self._bgzf.close()
+            if index:
+                index.write(self.file_name + ".bai",
+                    self._bgzf.virtual_offset)
+        finally:
+            if self._run_dir:
+                shutil.rmtree(self._run_dir)
+                self._run_dir = None
+
+
+def is_bam(file_name):
+    """Returns True if the file is BGZF compressed and begins with the BAM
+    magic number."""
+    with open(file_name, "rb") as reader:
+        if reader.read(4) != _GZIP_MAGIC:
+            return False
+    try:
+        for batch in BgzfReader(file_name, threads=1, batch_blocks=1). \
+                batches():
+            return batch[0:4] == _BAM_MAGIC
+    except (BamFormatError, zlib.error):
+        return False
+    return False
+
+@contextmanager
+def open_alignments(file_name, sequences=True):
+    """Opens a SAM or BAM file as an iterator of SAM lines; for BAM input,
+    sequences=False skips decoding SEQ and QUAL (see module doc)."""
+    if is_bam(file_name):
+        lines = BamReader(file_name).lines(sequences)
+        try:
+            yield lines
+        finally:
+            lines.close()
+    else:
+        with open(file_name, "r") as sam_file:
+            yield sam_file
+
+@contextmanager
+def open_alignment_output(file_name, sort=False, spill_dir=None):
+    """Opens file_name for writing SAM text; a .bam file name is written as
+    BAM instead (coordinate sorted and indexed if sort; see BamWriter)."""
+    if file_name.endswith(".bam"):
+        writer = BamWriter(file_name, sort, spill_dir=spill_dir)
+        try:
+            yield writer
+        finally:
+            writer.close()
+    else:
+        with open(file_name, "w") as sam_file:
+            yield sam_file
@@ -0,0 +1,329 @@
+#! /usr/bin/env python
+
+"""
+benchmark.py
+Times the main stages (split_read, identify_pairs, cluster_gaps) on synthetic
+data at several scales and compares the results against a stored baseline.
+
+SyntheticData generates reproducible (seeded) inputs for each stage:
+ - FASTQ reads for split_read;
+ - split-alignment SAM for identify_pairs: each read's left and right splits
+   align to the same transcript and strand separated by a (mostly short) gap;
+   a fraction of splits also align elsewhere (multi-mapping) or not at all,
+   and some reads have no partner split (so do not form a read group);
+ - merged pair SAM for cluster_gaps: pairs from several read group samples
+   piled up around gap hotspots (which cluster) plus scattered noise gaps.
+
+Each stage runs as a separate process (as in the pipeline) so its wall time
+and peak resident memory can be measured in isolation; a scale is a number of
+reads (or pairs for cluster_gaps). Scripts that collect stage metrics (see
+instrumentation.py) also contribute their per-stage breakdown. Results are
+written to [working_dir]/benchmark.json; with --save-baseline they replace the
+baseline. Timings only mean something on the machine that recorded them, so
+the default baseline (bin/benchmark_baseline.json) is a local file ignored by
+git: record one with --save-baseline before making changes. A stage is reported as a regression when it is slower or uses more
+memory than the baseline at the same scale by more than the tolerance (and a
+small absolute margin, so timer noise on small inputs is ignored); the exit
+status is 1 if any stage regressed.
+
+Example usage: ./benchmark.py /tmp/rsw_benchmark 1000,10000,100000
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from instrumentation import METRICS_DIR_ENV
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BIN_DIR, "benchmark_baseline.json")
+DEFAULT_SCALES = [1000, 10000, 100000]
+READ_LEN = 50
+SPLIT_MARGIN = 20
+MIN_DISTANCE = 2
+MAX_DISTANCE = 39999
+TOLERANCE = 0.25
+_MIN_SECONDS_DELTA = 0.5
+_MIN_MEMORY_DELTA = 10
+_BASES = "ACGT"
+
+
+class SyntheticData():
+    """Writes seeded synthetic inputs for each stage (see module doc)."""
+
+    def __init__(self, seed=42, read_len=READ_LEN, split_margin=SPLIT_MARGIN,
+            transcript_count=200, transcript_len=10000):
+        self._random = random.Random(seed)
+        self.read_len = read_len
+        self.split_margin = split_margin
+        self.transcripts = ["transcript{0}".format(i)
+            for i in range(transcript_count)]
+        self.transcript_len = transcript_len
+
+    def _sequence(self, length):
+        return "".join(self._random.choice(_BASES) for _ in range(length))
+
+    def _gap(self):
+        """Mostly short (spliced-out or deleted) gaps with a long tail."""
+        if self._random.random() < 0.9:
+            return self._random.randint(MIN_DISTANCE, 200)
+        return self._random.randint(200, 3000)
+
+    def write_fastq(self, writer, read_count):
+        quality = "I" * self.read_len
+        for i in range(read_count):
+            writer.write("@read{0} 1:N:0:ACGT\n{1}\n+\n{2}\n".format(i,
+                self._sequence(self.read_len), quality))
+
+    def _sam_header(self, writer, read_groups=()):
+        writer.write("@HD\tVN:1.0\tSO:unsorted\n")
+        for transcript in self.transcripts:
+            writer.write("@SQ\tSN:{0}\tLN:{1}\n".format(transcript,
+                self.transcript_len))
+        for read_group in read_groups:
+            writer.write("@RG\tID:{0}\tSM:{0}\n".format(read_group))
+        writer.write("@PG\tID:Bowtie\tVN:0.12.8\n")
+
+    def _split_alignment(self, name, side, split_len, flag, transcript,
+            position):
+        return "{0}-{1}-{2}\t{3}\t{4}\t{5}\t255\t{2}M\t*\t0\t0\t{6}\t{7}\t" \
+            "XA:i:0\tMD:Z:{2}\tNM:i:0\n".format(name, side, split_len, flag,
+            transcript, position, "A" * split_len, "I" * split_len)
+
+    def write_split_alignments(self, writer, read_count, multimap_rate=0.2,
+            unaligned_rate=0.1, orphan_rate=0.3):
+        """Writes a split-alignment SAM with one split per read (as the
+        pipeline aligns one split length per read once reads are split)."""
+        self._sam_header(writer)
+        for i in range(read_count):
+            name = "read{0}".format(i)
+            left_len = self._random.randint(self.split_margin,
+                self.read_len - self.split_margin)
+            right_len = self.read_len - left_len
+            transcript = self._random.choice(self.transcripts)
+            reverse = self._random.random() < 0.5
+            flag = 16 if reverse else 0
+            gap = self._gap()
+            left = self._random.randint(1, self.transcript_len - gap -
+                self.read_len)
+            right = left + left_len + gap
+            if reverse:
+                (left, right) = (right, left)
+            writer.write(self._split_alignment(name, "L", left_len, flag,
+                transcript, left))
+            if self._random.random() < orphan_rate:
+                continue
+            if self._random.random() < unaligned_rate:
+                writer.write("{0}-R-{1}\t4\t*\t0\t0\t*\t*\t0\t0\t{2}\t{3}\n". \
+                    format(name, right_len, "C" * right_len, "I" * right_len))
+                continue
+            writer.write(self._split_alignment(name, "R", right_len, flag,
+                transcript, right))
+            while self._random.random() < multimap_rate:
+                writer.write(self._split_alignment(name, "R", right_len, flag,
+                    transcript, right + self._random.randint(1, 1000)))
+
+    def write_pair_alignments(self, writer, pair_count, samples=("A", "B"),
+            hotspot_count=50, noise_rate=0.2):
+        """Writes a merged (read group tagged) pair SAM as identify_pairs and
+        merge_sam would, with gaps piled up around hotspots."""
+        self._sam_header(writer, samples)
+        hotspots = [(self._random.choice(self.transcripts),
+            self._random.randint(100, self.transcript_len - 4000),
+            self._random.randint(MIN_DISTANCE, 1000))
+            for _ in range(hotspot_count)]
+        for i in range(pair_count):
+            if self._random.random() < noise_rate:
+                transcript = self._random.choice(self.transcripts)
+                gap_start = self._random.randint(self.read_len,
+                    self.transcript_len - 4000)
+                gap = self._gap()
+            else:
+                (transcript, gap_start, gap) = self._random.choice(hotspots)
+                gap_start += self._random.randint(-5, 5)
+                gap += self._random.randint(-5, 5)
+            left_len = self._random.randint(self.split_margin,
+                self.read_len - self.split_margin)
+            right_len = self.read_len - left_len
+            left = gap_start - left_len
+            right = gap_start + max(gap, MIN_DISTANCE)
+            tag = "XA:i:0\tRG:Z:{0}".format(self._random.choice(samples))
+            writer.write("read{0}-L-{1}\t67\t{2}\t{3}\t255\t{1}M\t=\t{4}\t{5}\t"
+                "{6}\t{7}\t{8}\n".format(i, left_len, transcript, left, right,
+                right - left, "A" * left_len, "I" * left_len, tag))
+            writer.write("read{0}-L-{1}\t131\t{2}\t{3}\t255\t{4}M\t=\t{5}\t{6}\t"
+                "{7}\t{8}\t{9}\n".format(i, left_len, transcript, right,
+                right_len, left, left - right, "C" * right_len,
+                "I" * right_len, tag))
+
+
+def _python_command(script, *args):
+    return [sys.executable, os.path.join(BIN_DIR, script)] + \
+        [str(arg) for arg in args]
+
+def _split_read_stage(data, scale, path):
+    input_file_name = path("reads.fastq")
+    with open(input_file_name, "w") as writer:
+        data.write_fastq(writer, scale)
+    return _python_command("split_read.py", input_file_name,
+        path("split_reads.fastq"), data.split_margin)
+
+def _identify_pairs_stage(data, scale, path):
+    input_file_name = path("split_alignments.sam")
+    with open(input_file_name, "w") as writer:
+        data.write_split_alignments(writer, scale)
+    return _python_command("identify_pairs.py", input_file_name,
+        path("pairs.rsw"), data.read_len, MIN_DISTANCE, MAX_DISTANCE)
+
+def _cluster_gaps_stage(data, scale, path):
+    input_file_name = path("pairs.sam")
+    with open(input_file_name, "w") as writer:
+        data.write_pair_alignments(writer, scale)
+    return _python_command("cluster_gaps.py", input_file_name, data.read_len,
+        path("gaps.tab"), path("clustered.sam"))
+
+# (name, function(data, scale, path) which writes the input and returns the
+# command)
+STAGES = [("split_read", _split_read_stage),
+    ("identify_pairs", _identify_pairs_stage),
+    ("cluster_gaps", _cluster_gaps_stage)]
+
+
+def _stage_metrics(metrics_dir):
+    """Returns the per-stage breakdown written by an instrumented script (or
+    an empty list)."""
+    for file_name in sorted(os.listdir(metrics_dir)):
+        with open(os.path.join(metrics_dir, file_name), "r") as metrics_file:
+            return json.load(metrics_file).get("stages", [])
+    return []
+
+def run_command(command, log_file_name, metrics_dir):
+    """Runs command, returning (wall seconds, peak resident memory in Mb).
+    Raises CalledProcessError if the command fails."""
+    environ = dict(os.environ)
+    environ[METRICS_DIR_ENV] = metrics_dir
+    with open(log_file_name, "w") as log_file:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=log_file,
+            stderr=subprocess.STDOUT, env=environ)
+        (_, status, usage) = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode,
+            " ".join(command))
+    return (seconds, usage.ru_maxrss // 1024)
+
+def run_stage(name, stage_function, scale, working_dir, seed=42):
+    """Generates the stage input at scale, runs the stage and returns its
+    result."""
+    stage_dir = os.path.join(working_dir, "{0}.{1}".format(name, scale))
+    metrics_dir = os.path.join(stage_dir, "metrics")
+    for directory in [stage_dir, metrics_dir]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    for file_name in os.listdir(metrics_dir):
+        os.remove(os.path.join(metrics_dir, file_name))
+    path = lambda file_name: os.path.join(stage_dir, file_name)
+
+    command = stage_function(SyntheticData(seed), scale, path)
+    (seconds, peak_rss_mb) = run_command(command, path("stage.log"),
+        metrics_dir)
+    return {"stage": name,
+        "scale": scale,
+        "seconds": round(seconds, 3),
+        "records_per_second": round(scale / seconds, 1) if seconds else None,
+        "peak_rss_mb": peak_rss_mb,
+        "stages": _stage_metrics(metrics_dir)}
+
+def run(scales, working_dir, logger=None, stages=None):
+    results = []
+    for (name, stage_function) in (stages or STAGES):
+        for scale in scales:
+            result = run_stage(name, stage_function, scale, working_dir)
+            if logger:
+                logger.log(format_result(result))
+            results.append(result)
+    return results
+
+
+def format_result(result):
+    return "{stage}|scale={scale}|seconds={seconds}|"\
+        "records_per_second={records_per_second}|peak_rss_mb={peak_rss_mb}". \
+        format(**result)
+
+def compare(results, baseline_results, tolerance=TOLERANCE):
+    """Returns a description of each result that is slower or uses more
+    memory than the baseline result for the same stage and scale."""
+    baseline = dict(((result["stage"], result["scale"]), result)
+        for result in baseline_results)
+    regressions = []
+    for result in results:
+        expected = baseline.get((result["stage"], result["scale"]))
+        if not expected:
+            continue
+        for (metric, margin) in [("seconds", _MIN_SECONDS_DELTA),
+                ("peak_rss_mb", _MIN_MEMORY_DELTA)]:
+            (value, limit) = (result[metric], expected[metric])
+            if value > limit * (1 + tolerance) and value - limit > margin:
+                regressions.append("{0}|scale={1}|{2}={3} (baseline {4})". \
+                    format(result["stage"], result["scale"], metric, value,
+                    limit))
+    return regressions
+
+def read_baseline(file_name):
+    if not os.path.isfile(file_name):
+        return []
+    with open(file_name, "r") as baseline_file:
+        return json.load(baseline_file)["results"]
+
+def write_results(results, file_name):
+    with open(file_name, "w") as results_file:
+        json.dump({"date": str(datetime.datetime.today()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results}, results_file, indent=1, sort_keys=True)
+        results_file.write("\n")
+
+
+class _PrintLogger():
+    def log(self, message):
+        print (message)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    BASENAME = os.path.basename(sys.argv[0])
+    BASELINE_FLAG = "--baseline="
+    SAVE_BASELINE_FLAG = "--save-baseline"
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if (len(ARGS) not in (1, 2)):
+        # pylint: disable=line-too-long
+        print ("usage: {0} [working_dir] [scales (comma separated read counts; default {1})] [{2}baseline file (default {3})] [{4} (replace the baseline with these results)]".format(BASENAME, ",".join(str(SCALE) for SCALE in DEFAULT_SCALES), BASELINE_FLAG, BASELINE_FILE, SAVE_BASELINE_FLAG))
+        sys.exit()
+
+    WORKING_DIR = os.path.abspath(ARGS[0])
+    SCALES = [int(SCALE) for SCALE in ARGS[1].split(",")] if len(ARGS) == 2 else DEFAULT_SCALES
+    BASELINE_FILE_NAME = BASELINE_FILE
+    for ARG in sys.argv[1:]:
+        if ARG.startswith(BASELINE_FLAG):
+            BASELINE_FILE_NAME = os.path.abspath(ARG[len(BASELINE_FLAG):])
+
+    RESULTS = run(SCALES, WORKING_DIR, _PrintLogger())
+    write_results(RESULTS, os.path.join(WORKING_DIR, "benchmark.json"))
+    if SAVE_BASELINE_FLAG in sys.argv[1:]:
+        write_results(RESULTS, BASELINE_FILE_NAME)
+        print ("baseline written to {0}".format(BASELINE_FILE_NAME))
+        sys.exit()
+
+    BASELINE_RESULTS = read_baseline(BASELINE_FILE_NAME)
+    if not BASELINE_RESULTS:
+        print ("no baseline at {0}; run with {1} to record one".format(BASELINE_FILE_NAME, SAVE_BASELINE_FLAG))
+    REGRESSIONS = compare(RESULTS, BASELINE_RESULTS)
+    for REGRESSION in REGRESSIONS:
+        print ("regression: {0}".format(REGRESSION))
+    print ("{0} done.".format(BASENAME))
+    sys.exit(1 if REGRESSIONS else 0)
@@ -9,15 +9,34 @@ cluster_gaps.py
     b) read and passthrough sample ids from sam 
     c) emit a sam file with cluster annotations
 8/1/2013 - cgates: adjusted to emit original read as sam tag
+
+Given a transcript to gene symbol mapping (--gene-map), a gene_symbol column
+is appended to the gap and group files, keyed by the chromosome (transcript)
+of each row.
+
+An output sam file named .bam is written as BAM; with --sort-output it is
+also coordinate sorted and indexed (.bai) as it is written (see bam.py).
+
+Reads collapsed by split_read.py --collapse-duplicates carry the number of
+identical reads they stand for in their names (;size=N). Each gap is weighted
+by that count, so clustering and the group summaries (read counts, means and
+standard deviations) come out as if the duplicates had been split and aligned
+individually.
 """
-from contextlib import nested
+from array import array
+from contextlib import contextmanager, nested
 import datetime
+import hashlib
 import os
 import re
-import resource
 import sys
-import traceback
+import numpy as np
 from cluster_utility import DbscanClusterUtility
+from bam import open_alignment_output, open_alignments
+from instrumentation import StdErrLogger, metrics_for
+from merge_sam import merged_lines
+from split_read import duplicate_count
+from transcript_to_gene_symbol import NOT_FOUND, parse_gene_map
 
 class ClusterGapsError(Exception):
     """Base class for exceptions in this module."""
@@ -32,6 +51,15 @@ class MissingReadGroupError(ClusterGapsError):
         return repr("Alignment has no read group: '{0}'". \
             format(self.line))
 
+class UnsortedSamError(ClusterGapsError):
+    def __init__(self, line):
+        super(UnsortedSamError, self).__init__()
+        self.line = line
+
+    def __str__(self):
+        return repr("Alignments are not grouped by reference: '{0}'". \
+            format(self.line))
+
 class InvalidReadGroupError(ClusterGapsError):
     def __init__(self, line):
         super(InvalidReadGroupError, self).__init__()
@@ -43,32 +71,17 @@ class InvalidReadGroupError(ClusterGapsError):
 
             
 # pylint: disable=R0903
-class StdErrLogger():
-    """Writes basic utilization data to stderr"""
-    def __init__(self, verbose = False):
-        self._verbose = verbose
-
-    def log(self, message, verbose=None):
-        """Logs message to std err with optional stats on peak utilization"""
-        verbose = self._verbose if verbose is None else verbose
-        if (verbose):
-            usage = resource.getrusage(resource.RUSAGE_SELF)
-            memory_used = usage.ru_maxrss/1024
-            function_name = traceback.extract_stack()[-2:-1][0][2]
-            message = "usertime(s)={0:.0f}|systime(s)={1:.0f}|"\
-                "peak_memory_used(mb)={2}|{3}|{4}". \
-                format(usage.ru_utime, usage.ru_stime, memory_used, 
-                    function_name, message)
-        sys.stderr.write("{0}|{1}\n".format(datetime.datetime.today(), message))
-
 class Gap():
     """Models an aligned pair of split reads"""
     
     @staticmethod
-    def header(delimiter):
-        return delimiter.join(["#chromosome", "cluster", "sample_name", 
+    def header(delimiter, gene_symbol=False):
+        columns = ["#chromosome", "cluster", "sample_name", 
             "gap_start", "gap_end","gap_width","read_start","read_end",
-            "read_width","split_read_name","original_read_name"])
+            "read_width","split_read_name","original_read_name"]
+        if gene_symbol:
+            columns.append("gene_symbol")
+        return delimiter.join(columns)
 
     _name_re = re.compile(r"(.+)-([LR])-([\d]+)$")
 
@@ -105,21 +118,456 @@ class Gap():
     def _original_read_name(self):
         return self._name_re.match(self._split_read_name).group(1)
 
-    def format(self, delimiter):
-        return delimiter.join(
-            [self.chromosome, str(self.cluster), self.sample, str(self.gap_start), str(self._gap_end), 
+    def format(self, delimiter, gene_map=None):
+        fields = [self.chromosome, str(self.cluster), self.sample, str(self.gap_start), str(self._gap_end), 
                 str(self.gap_width()), str(self._read_start), 
                 str(self._read_end), str(self._read_width()), 
-                self._split_read_name, self._original_read_name()])
+                self._split_read_name, self._original_read_name()]
+        if gene_map is not None:
+            fields.append(gene_map.get(self.chromosome, NOT_FOUND))
+        return delimiter.join(fields)
 
     def additional_sam_tags(self, delimiter):
         return "XC:i:{0}{1}XR:Z:{2}".format(self.cluster, delimiter, self._original_read_name())        
 
+class PackedNames():
+    """Immutable sequence of names stored end to end in a single str, with
+    an array of offsets (name i is data[offsets[i]:offsets[i + 1]]). Each
+    name costs its characters plus an 8 byte offset rather than a Python
+    str (about 40 bytes of object overhead) and a list slot."""
+
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+
+    @staticmethod
+    def pack(names):
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        if names:
+            offsets[1:] = np.cumsum([len(name) for name in names])
+        return PackedNames("".join(names), offsets)
+
+    @staticmethod
+    def concatenate(packed_names):
+        offsets = [np.zeros(1, dtype=np.int64)]
+        length = 0
+        for names in packed_names:
+            offsets.append(names._offsets[1:] + length)
+            length += len(names._data)
+        return PackedNames("".join([names._data for names in packed_names]),
+            np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._data[self._offsets[index]:self._offsets[index + 1]]
+
+    def __iter__(self):
+        return iter(self.select(slice(None)))
+
+    def select(self, indexes):
+        """Returns a list of the names at indexes (an array or slice)."""
+        data = self._data
+        starts = self._offsets[:-1][indexes].tolist()
+        ends = self._offsets[1:][indexes].tolist()
+        return [data[start:end] for (start, end) in zip(starts, ends)]
+
+
+class GapTable():
+    """Columnar collection of gaps backed by numpy arrays. Chromosomes and
+    samples are stored once and referenced by integer index. Each gap costs
+    36 bytes of numeric columns plus its split read name's characters and an
+    8 byte offset (see PackedNames; names are all but unique, so they are
+    referenced through the name index but not deduplicated), rather than a
+    full Gap instance and its attribute dict. Indexing a table returns an
+    equivalent Gap. Each gap has a
+    weight: the number of identical reads its read stands for (see
+    split_read.duplicate_count)."""
+
+    _FORMAT_BLOCK_SIZE = 100000
+
+    def __init__(self, chromosomes, samples, split_read_names,
+            chromosome_ids, sample_ids, read_starts, gap_starts, gap_ends,
+            read_ends, name_indexes, clusters=None, weights=None):
+        self._chromosomes = chromosomes
+        self._samples = samples
+        self._split_read_names = split_read_names
+        self._chromosome_ids = np.asarray(chromosome_ids, dtype=np.int32)
+        self._sample_ids = np.asarray(sample_ids, dtype=np.int32)
+        self._read_start = np.asarray(read_starts, dtype=np.int32)
+        self.gap_start = np.asarray(gap_starts, dtype=np.int32)
+        self._gap_end = np.asarray(gap_ends, dtype=np.int32)
+        self._read_end = np.asarray(read_ends, dtype=np.int32)
+        self._name_index = np.asarray(name_indexes, dtype=np.int32)
+        if clusters is None:
+            clusters = np.empty(len(self._chromosome_ids), dtype=np.int32)
+            clusters.fill(-1)
+        self.cluster = np.asarray(clusters, dtype=np.int32)
+        if weights is None:
+            weights = np.ones(len(self._chromosome_ids), dtype=np.int32)
+        self.weight = np.asarray(weights, dtype=np.int32)
+
+    def __len__(self):
+        return len(self._chromosome_ids)
+
+    def __getitem__(self, index):
+        gap = Gap(self._samples[self._sample_ids[index]],
+            self._split_read_names[self._name_index[index]],
+            self._chromosomes[self._chromosome_ids[index]],
+            int(self._read_start[index]), int(self.gap_start[index]),
+            int(self._gap_end[index]), int(self._read_end[index]))
+        gap.cluster = int(self.cluster[index])
+        return gap
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def gap_width(self):
+        return self._gap_end - self.gap_start
+
+    def is_weighted(self):
+        """Returns true if any gap stands for more than one read."""
+        return bool(np.any(self.weight != 1))
+
+    def _take(self, order):
+        return GapTable(self._chromosomes, self._samples,
+            self._split_read_names, self._chromosome_ids[order],
+            self._sample_ids[order], self._read_start[order],
+            self.gap_start[order], self._gap_end[order],
+            self._read_end[order], self._name_index[order],
+            self.cluster[order], self.weight[order])
+
+    def sample_names(self):
+        """Returns the distinct samples referenced by this table."""
+        return [self._samples[i] for i in np.unique(self._sample_ids).tolist()]
+
+    def subtable(self, start, end):
+        """Returns a new table of rows [start, end)."""
+        return self._take(slice(start, end))
+
+    @staticmethod
+    def concatenate(tables):
+        """Returns a single table containing the rows of each table in 
+        order, with chromosome, sample and split read names merged."""
+        chromosome_ids = {}
+        sample_ids = {}
+        split_read_names = []
+        name_count = 0
+        columns = [[] for _ in range(9)]
+        for table in tables:
+            chromosome_map = np.array([GapTableBuilder._id(chromosome_ids,
+                name) for name in table._chromosomes], dtype=np.int32)
+            sample_map = np.array([GapTableBuilder._id(sample_ids, name)
+                for name in table._samples], dtype=np.int32)
+            if len(table):
+                columns[0].append(chromosome_map[table._chromosome_ids])
+                columns[1].append(sample_map[table._sample_ids])
+            columns[2].append(table._read_start)
+            columns[3].append(table.gap_start)
+            columns[4].append(table._gap_end)
+            columns[5].append(table._read_end)
+            columns[6].append(table._name_index + name_count)
+            columns[7].append(table.cluster)
+            columns[8].append(table.weight)
+            split_read_names.append(table._split_read_names)
+            name_count += len(table._split_read_names)
+        columns = [np.concatenate(column) if column else np.empty(0)
+            for column in columns]
+        return GapTable(GapTableBuilder._names(chromosome_ids),
+            GapTableBuilder._names(sample_ids),
+            PackedNames.concatenate(split_read_names), *columns)
+
+    def to_arrays(self):
+        """Returns a dict of numpy arrays suitable for np.savez; chromosome,
+        sample and split read names are reduced to those referenced."""
+        arrays = {}
+        for (label, names, ids) in [
+                ("chromosome", self._chromosomes, self._chromosome_ids),
+                ("sample", self._samples, self._sample_ids)]:
+            (used_ids, remapped_ids) = np.unique(ids, return_inverse=True)
+            arrays[label + "s"] = np.array([names[i] for i in 
+                used_ids.tolist()], dtype=str)
+            arrays[label + "_ids"] = remapped_ids.astype(np.int32)
+        (used_ids, remapped_ids) = np.unique(self._name_index,
+            return_inverse=True)
+        arrays["split_read_names"] = np.array(
+            self._split_read_names.select(used_ids), dtype=str)
+        arrays["split_read_name_ids"] = remapped_ids.astype(np.int32)
+        arrays["read_start"] = self._read_start
+        arrays["gap_start"] = self.gap_start
+        arrays["gap_end"] = self._gap_end
+        arrays["read_end"] = self._read_end
+        arrays["cluster"] = self.cluster
+        arrays["weight"] = self.weight
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        """Inverse of to_arrays; accepts a dict or a loaded npz archive
+        (archives written before gaps were weighted have unit weights)."""
+        return GapTable([str(name) for name in arrays["chromosomes"]],
+            [str(name) for name in arrays["samples"]],
+            PackedNames.pack([str(name) for name in
+                arrays["split_read_names"]]),
+            arrays["chromosome_ids"], arrays["sample_ids"],
+            arrays["read_start"], arrays["gap_start"], arrays["gap_end"],
+            arrays["read_end"], arrays["split_read_name_ids"], 
+            arrays["cluster"],
+            arrays["weight"] if "weight" in arrays else None)
+
+    def content_hash(self):
+        """Returns a hex digest over every gap's coordinates and names (but
+        not its cluster); equal tables in equal order hash equally."""
+        digest = hashlib.sha1()
+        arrays = self.to_arrays()
+        for name in ["chromosomes", "samples", "split_read_names"]:
+            digest.update("\0".join(arrays[name].tolist()).encode("utf-8"))
+        for name in ["chromosome_ids", "sample_ids", "split_read_name_ids",
+                "read_start", "gap_start", "gap_end", "read_end"]:
+            digest.update(np.ascontiguousarray(arrays[name],
+                dtype=np.int32).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _rank(names):
+        """Returns an array mapping each name index to its alphabetic rank."""
+        rank = np.empty(len(names), dtype=np.int32)
+        rank[np.argsort(np.array(names, dtype=object), kind="mergesort")] = \
+            np.arange(len(names))
+        return rank
+
+    def sorted(self):
+        """Returns a new table sorted by chromosome name (alphabetic) and
+        gap_start (numeric); ties keep their original order."""
+        chromosome_rank = self._rank(self._chromosomes)[self._chromosome_ids]
+        order = np.lexsort((self.gap_start, chromosome_rank))
+        return self._take(order)
+
+    def chromosome_count(self):
+        return len(np.unique(self._chromosome_ids))
+
+    def chromosome_slices(self):
+        """Yields (chromosome, start, end) for each contiguous run of a
+        chromosome; assumes the table is sorted."""
+        if len(self) == 0:
+            return
+        boundaries = np.flatnonzero(np.diff(self._chromosome_ids)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(self)]))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield (self._chromosomes[self._chromosome_ids[start]], start, end)
+
+    def key_index(self):
+        """Returns a dict of gap key to row index (see Gap.key)."""
+        index = {}
+        rows = zip(self._sample_ids.tolist(), self._chromosome_ids.tolist(),
+            self._name_index.tolist(), self._read_start.tolist(),
+            self._read_end.tolist())
+        for row, (sample_id, chromosome_id, name_index, read_start,
+                read_end) in enumerate(rows):
+            key = hash(tuple([self._samples[sample_id],
+                self._chromosomes[chromosome_id],
+                self._split_read_names[name_index], read_start, read_end]))
+            index[key] = row
+        return index
+
+    def format_blocks(self, delimiter, gene_map=None):
+        """Yields newline-terminated blocks of formatted gap lines, matching
+        Gap.format for each row."""
+        column_count = 11 if gene_map is None else 12
+        template = delimiter.replace("%", "%%").join(["%s"] * column_count) \
+            + "\n"
+        if gene_map is not None:
+            gene_symbols = [gene_map.get(chromosome, NOT_FOUND)
+                for chromosome in self._chromosomes]
+        name_re = Gap._name_re
+        for block_start in range(0, len(self), self._FORMAT_BLOCK_SIZE):
+            block = slice(block_start, block_start + self._FORMAT_BLOCK_SIZE)
+            chromosomes = [self._chromosomes[i] for i in
+                self._chromosome_ids[block].tolist()]
+            samples = [self._samples[i] for i in
+                self._sample_ids[block].tolist()]
+            names = self._split_read_names.select(self._name_index[block])
+            original_names = [name_re.match(name).group(1) for name in names]
+            gap_start = self.gap_start[block]
+            gap_end = self._gap_end[block]
+            read_start = self._read_start[block]
+            read_end = self._read_end[block]
+            columns = [chromosomes, self.cluster[block].tolist(), samples,
+                gap_start.tolist(), gap_end.tolist(),
+                (gap_end - gap_start).tolist(), read_start.tolist(),
+                read_end.tolist(), (read_end - read_start).tolist(),
+                names, original_names]
+            if gene_map is not None:
+                columns.append([gene_symbols[i] for i in
+                    self._chromosome_ids[block].tolist()])
+            rows = zip(*columns)
+            yield "".join([template % row for row in rows])
+
+    def _original_read_ids(self):
+        """Returns an array of integer ids for each gap's original read."""
+        name_re = Gap._name_re
+        ids = {}
+        name_ids = [ids.setdefault(name_re.match(name).group(1), len(ids))
+            for name in self._split_read_names]
+        return np.array(name_ids, dtype=np.int32)[self._name_index]
+
+    @staticmethod
+    def _distinct_counts(group_ids, values, group_count, weights=None):
+        """Returns the number of distinct values within each group; if
+        weights is given, the sum of the weights of the distinct values
+        (the weight of the first row with each)."""
+        order = np.lexsort((values, group_ids))
+        sorted_groups = group_ids[order]
+        sorted_values = values[order]
+        is_new = np.ones(len(order), dtype=bool)
+        is_new[1:] = (sorted_groups[1:] != sorted_groups[:-1]) | \
+            (sorted_values[1:] != sorted_values[:-1])
+        if weights is not None:
+            weights = weights[order][is_new]
+        return np.bincount(sorted_groups[is_new], weights=weights,
+            minlength=group_count)
+
+    @staticmethod
+    def _mean_and_stdev(values, starts, counts, weights=None):
+        """Returns per-group mean and population standard deviation of
+        values (already ordered by group, counts values per group); if
+        weights is given, each value counts weight times."""
+        if weights is None:
+            means = np.add.reduceat(values, starts) / counts
+            deviations = values - np.repeat(means, counts)
+            stdevs = np.sqrt(np.add.reduceat(deviations * deviations,
+                starts) / counts)
+            return (means, stdevs)
+        totals = np.add.reduceat(weights, starts)
+        means = np.add.reduceat(values * weights, starts) / totals
+        deviations = values - np.repeat(means, counts)
+        stdevs = np.sqrt(np.add.reduceat(weights * deviations * deviations,
+            starts) / totals)
+        return (means, stdevs)
+
+    def group_summaries(self, by_sample):
+        """Summarizes gaps grouped by (chromosome, cluster) or, if by_sample,
+        by (chromosome, cluster, sample). Yields one tuple per group, ordered
+        by chromosome (alphabetic), cluster (numeric) and sample:
+        (chromosome, cluster, sample or distinct_sample_count, 
+        gap_start_mean, gap_start_stdev, gap_length_min, gap_length_mean,
+        gap_length_max, gap_length_stdev, split_read_count,
+        original_read_count). Counts, means and standard deviations are
+        weighted by gap weight."""
+        if len(self) == 0:
+            return
+        sample_rank = self._rank(self._samples)[self._sample_ids]
+        keys = [self._rank(self._chromosomes)[self._chromosome_ids],
+            self.cluster]
+        if by_sample:
+            keys.append(sample_rank)
+        order = np.lexsort(keys[::-1])
+        is_new = np.zeros(len(self), dtype=bool)
+        is_new[0] = True
+        for key in keys:
+            sorted_key = key[order]
+            is_new[1:] |= sorted_key[1:] != sorted_key[:-1]
+        starts = np.flatnonzero(is_new)
+        counts = np.diff(np.append(starts, len(self)))
+        group_ids = np.empty(len(self), dtype=np.int64)
+        group_ids[order] = np.cumsum(is_new) - 1
+
+        weights = None
+        read_counts = counts
+        if self.is_weighted():
+            weights = self.weight[order].astype(np.float64)
+            read_counts = np.add.reduceat(self.weight[order], starts)
+
+        widths = self.gap_width()[order].astype(np.float64)
+        (start_means, start_stdevs) = self._mean_and_stdev(
+            self.gap_start[order].astype(np.float64), starts, counts, weights)
+        (width_means, width_stdevs) = self._mean_and_stdev(
+            widths, starts, counts, weights)
+        width_mins = np.minimum.reduceat(widths, starts)
+        width_maxs = np.maximum.reduceat(widths, starts)
+        original_counts = self._distinct_counts(group_ids,
+            self._original_read_ids(), len(starts),
+            None if weights is None else self.weight)
+        sample_counts = self._distinct_counts(group_ids, self._sample_ids,
+            len(starts))
+
+        first_rows = order[starts]
+        for i, row in enumerate(first_rows.tolist()):
+            sample = self._samples[self._sample_ids[row]] if by_sample \
+                else int(sample_counts[i])
+            yield (self._chromosomes[self._chromosome_ids[row]],
+                int(self.cluster[row]), sample, float(start_means[i]),
+                float(start_stdevs[i]), int(width_mins[i]),
+                float(width_means[i]), int(width_maxs[i]),
+                float(width_stdevs[i]), int(read_counts[i]),
+                int(original_counts[i]))
+
+
+class GapTableBuilder():
+    """Accumulates gaps into compact typed arrays and builds a GapTable. Each
+    gap is weighted by the duplicate count in its split read name."""
+
+    def __init__(self):
+        self._chromosome_ids = {}
+        self._sample_ids = {}
+        self._name_data = bytearray()
+        self._name_offsets = array("l", [0])
+        self._columns = [array("i") for _ in range(7)]
+
+    @staticmethod
+    def _id(ids, value):
+        try:
+            return ids[value]
+        except KeyError:
+            ids[value] = len(ids)
+            return ids[value]
+
+    # pylint: disable=R0913
+    def append(self, sample, split_read_name, chromosome, read_start,
+            gap_start, gap_end, read_end):
+        (chromosome_ids, sample_ids, read_starts, gap_starts, gap_ends,
+            read_ends, weights) = self._columns
+        chromosome_ids.append(self._id(self._chromosome_ids, chromosome))
+        sample_ids.append(self._id(self._sample_ids, sample))
+        read_starts.append(read_start)
+        gap_starts.append(gap_start)
+        gap_ends.append(gap_end)
+        read_ends.append(read_end)
+        weights.append(duplicate_count(split_read_name))
+        self._name_data += split_read_name
+        self._name_offsets.append(len(self._name_data))
+
+    @staticmethod
+    def _names(ids):
+        names = [None] * len(ids)
+        for name, index in ids.items():
+            names[index] = name
+        return names
+
+    def build(self):
+        columns = [np.frombuffer(column, dtype=np.intc) if len(column)
+            else np.empty(0, dtype=np.intc) for column in self._columns]
+        split_read_names = PackedNames(str(self._name_data),
+            np.frombuffer(self._name_offsets, dtype=np.int_))
+        return GapTable(self._names(self._chromosome_ids),
+            self._names(self._sample_ids), split_read_names,
+            columns[0], columns[1], columns[2], columns[3], columns[4],
+            columns[5], np.arange(len(split_read_names)),
+            weights=columns[6])
+
+
 class GapUtility():
     
-    def __init__(self, original_read_len, delimiter, logger):
+    _RG_TAG = "RG:Z:"
+
+    def __init__(self, original_read_len, delimiter, logger, gene_map=None):
         self._original_read_len = int(original_read_len)
+        self._gene_map = gene_map
         self._delimiter = delimiter
+        self._delimited_rg_tag = delimiter + self._RG_TAG
         self._logger = logger
         self._read_group_sample_dict = {}
 
@@ -134,20 +582,36 @@ class GapUtility():
                 raise InvalidReadGroupError(sam_line)
                 
     def sample_from_alignment(self, sam_line):
-        bits = sam_line.rstrip().split(self._delimiter)
+        bits = sam_line.rstrip().split(self._delimiter, 11)
+        return self._sample_from_fields(bits, sam_line)
+
+    def _sample_from_fields(self, bits, sam_line):
+        """Returns the sample for the RG:Z: tag in the optional fields, where
+        bits is the line split with maxsplit=11 (so bits[11] holds all the
+        optional fields, unsplit)."""
         if len(bits) < 12:
             raise MissingReadGroupError(sam_line)
-        opt_dict = dict(re.split(':\w:', entries) for entries in bits[11:])
-        if 'RG' not in opt_dict:
-            raise MissingReadGroupError(sam_line)
-        read_group = opt_dict['RG']
-        if read_group not in self._read_group_sample_dict:
+        optional_fields = bits[11]
+        if optional_fields.startswith(self._RG_TAG):
+            tag_start = len(self._RG_TAG)
+        else:
+            tag_start = optional_fields.find(self._delimited_rg_tag)
+            if tag_start == -1:
+                raise MissingReadGroupError(sam_line)
+            tag_start += len(self._delimited_rg_tag)
+        tag_end = optional_fields.find(self._delimiter, tag_start)
+        read_group = optional_fields[tag_start:] if tag_end == -1 \
+            else optional_fields[tag_start:tag_end]
+        try:
+            return self._read_group_sample_dict[read_group.rstrip()]
+        except KeyError:
             raise InvalidReadGroupError(sam_line)
-        return self._read_group_sample_dict[read_group]
-        
 
     def build_gap(self, sam_line):
-        bits = sam_line.split(self._delimiter)[0:10]
+        return Gap(*self._gap_fields(sam_line.split(self._delimiter, 11), 
+            sam_line))
+
+    def _gap_fields(self, bits, sam_line):
         split_read_name = bits[0] 
         transcript_name = bits[2] 
         start_pos = int(bits[3])
@@ -164,55 +628,108 @@ class GapUtility():
             gap_end = start_pos
             rightmost_end = start_pos + len(seq)
         
-        sample_name = self.sample_from_alignment(sam_line)
+        sample_name = self._sample_from_fields(bits, sam_line)
         
-        return Gap(sample_name, split_read_name, transcript_name, 
+        return (sample_name, split_read_name, transcript_name, 
             leftmost_start, gap_start, gap_end, rightmost_end)
 
     def samfile_to_gaps(self, sam_file):
         
-        def is_leftmost_alignment_of_pair(line):
-            tlen = int(line.split(self._delimiter)[8])
-            return tlen > 0
-        
-        gaps = []
+        builder = GapTableBuilder()
         for line in sam_file:
             if line.startswith("@"):
                 self.process_sam_header_line(line)
-            elif is_leftmost_alignment_of_pair(line):
-                gaps.append(self.build_gap(line))
-        return gaps
+            else:
+                self._append_leftmost_gap(builder, line)
+        return builder.build()
+
+    def _append_leftmost_gap(self, builder, line):
+        bits = line.split(self._delimiter, 11)
+        if int(bits[8]) > 0:
+            builder.append(*self._gap_fields(bits, line))
 
     @staticmethod
     def sort_gaps(gaps):
+        if isinstance(gaps, GapTable):
+            return gaps.sorted()
         return sorted(gaps, key=lambda gap: (gap.chromosome, gap.gap_start))
 
     def write_gap_file(self, sorted_gaps, writer, additional_header_lines):
+        self._write_gap_header(writer, additional_header_lines)
+        self._write_gaps(sorted_gaps, writer)
+
+    def _write_gap_header(self, writer, additional_header_lines):
         for line in additional_header_lines:
             writer.write("#")
             writer.write(line)
             writer.write("\n")
-        writer.write(Gap.header(self._delimiter))
+        writer.write(Gap.header(self._delimiter,
+            gene_symbol=self._gene_map is not None))
         writer.write("\n")
+
+    def _write_gaps(self, sorted_gaps, writer):
+        if isinstance(sorted_gaps, GapTable):
+            for block in sorted_gaps.format_blocks(self._delimiter,
+                    self._gene_map):
+                writer.write(block)
+            return
         for gap in sorted_gaps:
-            writer.write(gap.format(self._delimiter))
+            writer.write(gap.format(self._delimiter, self._gene_map))
             writer.write("\n")
 
+    def write_group_file(self, gaps, writer, by_sample):
+        """Writes per-cluster summary statistics of a GapTable (see
+        GapTable.group_summaries)."""
+        self._write_group_header(writer, by_sample)
+        self._write_groups(gaps, writer, by_sample)
+
+    def _write_group_header(self, writer, by_sample):
+        third_column = "sample_name" if by_sample else "distinct_sample_count"
+        columns = ["#transcript", "cluster",
+            third_column, "gap_start_mean", "gap_start_stdev",
+            "gap_length_min", "gap_length_mean", "gap_length_max",
+            "gap_length_stdev", "split_read_count", "original_read_count"]
+        if self._gene_map is not None:
+            columns.append("gene_symbol")
+        writer.write(self._delimiter.join(columns))
+        writer.write("\n")
+
+    def _write_groups(self, gaps, writer, by_sample):
+        formats = ["%s", "%d", "%s",
+            "%.2f", "%.2f", "%d", "%.2f", "%d", "%.2f", "%d", "%d"]
+        if self._gene_map is None:
+            template = self._delimiter.replace("%", "%%").join(formats) + "\n"
+            for summary in gaps.group_summaries(by_sample):
+                writer.write(template % summary)
+            return
+        template = self._delimiter.replace("%", "%%").join(formats + ["%s"]) \
+            + "\n"
+        for summary in gaps.group_summaries(by_sample):
+            writer.write(template % (summary +
+                (self._gene_map.get(summary[0], NOT_FOUND),)))
+
+    @staticmethod
+    def _gap_dict(gaps):
+        if isinstance(gaps, GapTable):
+            return gaps.key_index()
+        gap_dict = {}
+        for index, gap in enumerate(gaps):
+            gap_dict[gap.key()] = index
+        return gap_dict
+
+    def _tagged_sam_line(self, line, gaps, gap_dict):
+        sam_gap = self.build_gap(line)
+        reference_gap = gaps[gap_dict[sam_gap.key()]]
+        additional_tags = reference_gap.additional_sam_tags(self._delimiter)
+        return "{0}{1}{2}\n".format(
+                line.rstrip(), self._delimiter, additional_tags)
+
     def write_sam_file(
             self, input_sam_file, gaps, output_sam_file, 
             additional_header_lines):
-            
-        def _tagged_sam_line(line, gap_dict):
-            sam_gap = self.build_gap(line)
-            reference_gap = gap_dict[sam_gap.key()]
-            additional_tags = reference_gap.additional_sam_tags(self._delimiter)
-            return "{0}{1}{2}\n".format(
-                    line.rstrip(), self._delimiter, additional_tags)
         
         self._logger.log("building gap dictionary")
-        gap_dict = {}
-        for gap in gaps:
-            gap_dict[gap.key()] = gap
+        gap_dict = self._gap_dict(gaps)
                 
         for line in additional_header_lines:
                 output_sam_file.write("@CO\t{0}\n".format(line))
@@ -224,49 +741,184 @@ class GapUtility():
             if line.startswith("@"):
                 output_sam_file.write(line)
             else:
-                output_sam_file.write(_tagged_sam_line(line, gap_dict))
+                output_sam_file.write(
+                    self._tagged_sam_line(line, gaps, gap_dict))
         self._logger.log("processed {0} lines".format(count))
 
-def main(input_sam_file_name, original_read_len, gap_file_name, output_sam_file_name, delimiter):
+    def _chromosome_alignments(self, input_sam_file, output_sam_file):
+        """Passes header lines through to output_sam_file and yields 
+        (chromosome, alignment_lines) for each run of alignments on the same
+        reference. Raises UnsortedSamError if a reference reappears after
+        another reference's alignments."""
+        finished_chromosomes = set()
+        chromosome = None
+        lines = []
+        for line in input_sam_file:
+            if line.startswith("@"):
+                self.process_sam_header_line(line)
+                output_sam_file.write(line)
+                continue
+            line_chromosome = line.split(self._delimiter, 3)[2]
+            if line_chromosome != chromosome:
+                if lines:
+                    yield (chromosome, lines)
+                    finished_chromosomes.add(chromosome)
+                if line_chromosome in finished_chromosomes:
+                    raise UnsortedSamError(line)
+                chromosome = line_chromosome
+                lines = []
+            lines.append(line)
+        if lines:
+            yield (chromosome, lines)
+
+    # pylint: disable=R0913
+    def process_sorted_sam_file(self, input_sam_file, cluster_utility,
+            gap_writer, sample_group_writer, cluster_group_writer,
+            output_sam_file, additional_header_lines):
+        """Clusters and writes one chromosome at a time. Requires alignments 
+        to be grouped by reference (e.g. coordinate sorted), so peak memory
+        is bounded by the largest chromosome rather than the whole file.
+        Gap and group rows are written in input reference order."""
+        self._write_gap_header(gap_writer, additional_header_lines)
+        self._write_group_header(sample_group_writer, by_sample=True)
+        self._write_group_header(cluster_group_writer, by_sample=False)
+        for line in additional_header_lines:
+            output_sam_file.write("@CO\t{0}\n".format(line))
+
+        gap_count = 0
+        for (chromosome, lines) in self._chromosome_alignments(
+                input_sam_file, output_sam_file):
+            builder = GapTableBuilder()
+            for line in lines:
+                self._append_leftmost_gap(builder, line)
+            gaps = builder.build().sorted()
+            gap_count += len(gaps)
+            cluster_utility.assign_table_clusters(gaps)
+
+            self._write_gaps(gaps, gap_writer)
+            self._write_groups(gaps, sample_group_writer, by_sample=True)
+            self._write_groups(gaps, cluster_group_writer, by_sample=False)
+            gap_dict = self._gap_dict(gaps)
+            for line in lines:
+                output_sam_file.write(
+                    self._tagged_sam_line(line, gaps, gap_dict))
+        self._logger.log("processed {0} gaps".format(gap_count))
+
+def group_file_names(gap_file_name):
+    base_name = os.path.splitext(gap_file_name)[0]
+    return ("{0}.sample-groups.tab".format(base_name), 
+        "{0}.cluster-groups.tab".format(base_name))
+
+@contextmanager
+def open_sam_input(input_sam_file_name, coordinate_sorted=False,
+        sequences=True):
+    """Opens a SAM (or BAM) file, or for a comma-separated list of files, a
+    virtual merged stream of them (see merge_sam.merged_lines). For BAM input,
+    sequences=False skips decoding SEQ and QUAL (see bam.open_alignments)."""
+    file_names = input_sam_file_name.split(",")
+    if len(file_names) == 1:
+        with open_alignments(input_sam_file_name, sequences) as sam_file:
+            yield sam_file
+    else:
+        yield merged_lines(file_names, coordinate_sorted, sequences)
+
+def _main_sorted(input_sam_file_name, gap_file_name, output_sam_file_name,
+        gap_utility, header_lines, logger, metrics, sort_output=False):
+    (sample_group_file_name, cluster_group_file_name) = \
+        group_file_names(gap_file_name)
+    cluster_utility = DbscanClusterUtility(logger=logger, deduplication_threshold=1000)
+    logger.log("clustering sorted sam file one chromosome at a time")
+    with metrics.stage("cluster_sorted"), nested(open_sam_input(input_sam_file_name, coordinate_sorted=True),
+            open(gap_file_name, "w"),
+            open(sample_group_file_name, "w"), 
+            open(cluster_group_file_name, "w"),
+            open_alignment_output(output_sam_file_name, sort_output)) \
+            as (input_sam_file, gap_file, sample_group_file, 
+                cluster_group_file, output_sam_file):
+        gap_utility.process_sorted_sam_file(input_sam_file, cluster_utility,
+            gap_file, sample_group_file, cluster_group_file, output_sam_file,
+            header_lines)
+    logger.log("{0} complete".format(input_sam_file_name))
+
+def main(input_sam_file_name, original_read_len, gap_file_name, output_sam_file_name, delimiter, sorted_input=False, gene_map_file_name=None, sort_output=False):
     logger = StdErrLogger(verbose=True)
     logger.log(" ".join(sys.argv), verbose=False)
     header_lines = [str(datetime.datetime.today()), " ".join(sys.argv)] 
-    gap_utility = GapUtility(original_read_len, delimiter, logger)
+    gene_map = None
+    if gene_map_file_name:
+        logger.log("loading gene symbol mapping")
+        gene_map = parse_gene_map(gene_map_file_name)
+    gap_utility = GapUtility(original_read_len, delimiter, logger, gene_map)
+    metrics = metrics_for("cluster_gaps")
+
+    if sorted_input:
+        _main_sorted(input_sam_file_name, gap_file_name, output_sam_file_name,
+            gap_utility, header_lines, logger, metrics, sort_output)
+        return
     
     logger.log("parsing sam file")
-    with open(input_sam_file_name,"r") as sam_file:
-        gaps = gap_utility.samfile_to_gaps(sam_file)
+    with metrics.stage("parse_sam") as stage, \
+            open_sam_input(input_sam_file_name, sequences=False) as sam_file:
+        gaps = gap_utility.samfile_to_gaps(stage.counted(sam_file, "lines"))
+        stage.count("gaps", len(gaps))
 
     logger.log("sorting {0} gaps".format(len(gaps)))    
-    gaps = GapUtility.sort_gaps(gaps)
+    with metrics.stage("sort_gaps"):
+        gaps = GapUtility.sort_gaps(gaps)
 
     logger.log("clustering gaps")
-    cluster_utility = DbscanClusterUtility(logger=logger, deduplication_threshold=1000)
-    cluster_utility.assign_clusters(gaps)
+    with metrics.stage("cluster_gaps") as stage:
+        cluster_utility = DbscanClusterUtility(logger=logger, deduplication_threshold=1000)
+        cluster_utility.assign_table_clusters(gaps)
+        stage.count("gaps", len(gaps))
 
     logger.log("writing {0} gaps to file".format(len(gaps)))
-    with open(gap_file_name, "w") as gap_file:
+    with metrics.stage("write_gaps") as stage, \
+            open(gap_file_name, "w") as gap_file:
         gap_utility.write_gap_file(gaps, gap_file, header_lines)
+        stage.count("gaps", len(gaps))
+
+    (sample_group_file_name, cluster_group_file_name) = \
+        group_file_names(gap_file_name)
+    logger.log("writing group summaries")
+    with metrics.stage("write_groups"):
+        with open(sample_group_file_name, "w") as sample_group_file:
+            gap_utility.write_group_file(gaps, sample_group_file, by_sample=True)
+        with open(cluster_group_file_name, "w") as cluster_group_file:
+            gap_utility.write_group_file(gaps, cluster_group_file, 
+                by_sample=False)
 
     logger.log("writing sam file with clusters")
-    with nested(open(input_sam_file_name,"r"), open(output_sam_file_name,"w")) \
+    with metrics.stage("write_sam") as stage, \
+            nested(open_sam_input(input_sam_file_name), 
+            open_alignment_output(output_sam_file_name, sort_output)) \
             as (input_sam_file, output_sam_file):
-        gap_utility.write_sam_file(
-            input_sam_file, gaps, output_sam_file, header_lines)
+        gap_utility.write_sam_file(stage.counted(input_sam_file, "lines"),
+            gaps, output_sam_file, header_lines)
 
     logger.log("{0} complete".format(input_sam_file_name))
 
 if __name__ == "__main__":
     BASENAME = os.path.basename(sys.argv[0])
-    if (len(sys.argv) != 5):
+    SORTED_FLAG = "--sorted"
+    GENE_MAP_FLAG = "--gene-map="
+    SORT_OUTPUT_FLAG = "--sort-output"
+    ARGS = [arg for arg in sys.argv[1:] if arg not in (SORTED_FLAG, SORT_OUTPUT_FLAG) and not arg.startswith(GENE_MAP_FLAG)]
+    SORT_OUTPUT = SORT_OUTPUT_FLAG in sys.argv[1:]
+    if (len(ARGS) != 4) or (SORT_OUTPUT and not ARGS[3].endswith(".bam")):
         # pylint: disable=line-too-long
-        print ("usage: {0} [input_sam_file] [original_read_len] [gap_file] [output_sam_file]".format(BASENAME))
+        print ("usage: {0} [input_sam_file[,input_sam_file...] (sam or bam; several files are merged on the fly)] [original_read_len] [gap_file] [output_sam_file (written as bam if named .bam)] [{1} (input grouped by reference; cluster one chromosome at a time)] [{2}mapping datafile (append gene_symbol column)] [{3} (coordinate sort the bam output and write a .bai index)]".format(BASENAME, SORTED_FLAG, GENE_MAP_FLAG, SORT_OUTPUT_FLAG))
         sys.exit()
 
-    (INPUT_SAM_FILE_NAME, ORIGINAL_READ_LEN, GAP_FILE_NAME, OUTPUT_SAM_FILE_NAME) = sys.argv[1:]
-    INPUT_SAM_FILE_NAME = os.path.abspath(INPUT_SAM_FILE_NAME)
+    (INPUT_SAM_FILE_NAME, ORIGINAL_READ_LEN, GAP_FILE_NAME, OUTPUT_SAM_FILE_NAME) = ARGS
+    SORTED_INPUT = SORTED_FLAG in sys.argv[1:]
+    GENE_MAP_FILE_NAME = None
+    for ARG in sys.argv[1:]:
+        if ARG.startswith(GENE_MAP_FLAG):
+            GENE_MAP_FILE_NAME = os.path.abspath(ARG[len(GENE_MAP_FLAG):])
+    INPUT_SAM_FILE_NAME = ",".join([os.path.abspath(FILE_NAME) for FILE_NAME in INPUT_SAM_FILE_NAME.split(",")])
     GAP_FILE_NAME = os.path.abspath(GAP_FILE_NAME)
     OUTPUT_SAM_FILE_NAME = os.path.abspath(OUTPUT_SAM_FILE_NAME)
 
-    main(INPUT_SAM_FILE_NAME, ORIGINAL_READ_LEN, GAP_FILE_NAME, OUTPUT_SAM_FILE_NAME, "\t") 
+    main(INPUT_SAM_FILE_NAME, ORIGINAL_READ_LEN, GAP_FILE_NAME, OUTPUT_SAM_FILE_NAME, "\t", SORTED_INPUT, GENE_MAP_FILE_NAME, SORT_OUTPUT)
     print ("{0} done.".format(BASENAME))
@@ -7,10 +7,7 @@ enable modular clustering substitution and mocking.
 """
 import time
 import numpy as np
-from scipy.spatial import distance
 from sklearn.cluster import DBSCAN
-from sklearn.preprocessing import StandardScaler
-from sklearn.preprocessing import MinMaxScaler
 
 
 class DbscanClusterUtility():
@@ -122,7 +119,85 @@ class DbscanClusterUtility():
 
         return cluster_count
 
-        
+
+    def _cluster_coordinates(self, coordinates, weights=None):
+        """Clusters an (n, 2) array of (gap_start, gap_width) and returns 
+        (labels, cluster_count). Above the deduplication threshold, clusters
+        at most min_samples copies of each distinct coordinate (see 
+        _deduplicate_and_cluster_gaps) and broadcasts the labels back. If
+        weights is given, each coordinate counts weight times (see
+        _cluster_weighted_coordinates)."""
+        if weights is not None:
+            return self._cluster_weighted_coordinates(coordinates, weights)
+        if len(coordinates) < self._deduplication_threshold:
+            labels = self._dbscan.fit_predict(coordinates)
+        else:
+            (distinct, inverse, counts) = np.unique(coordinates, axis=0, 
+                return_inverse=True, return_counts=True)
+            copies = np.minimum(counts, self._min_samples)
+            deduped = np.repeat(distinct, copies, axis=0)
+            self._logger.log(
+                "Deduplication reduced gap count from {0} to {1}". \
+                format(len(coordinates), len(deduped)))
+            first_copy = np.concatenate(([0], np.cumsum(copies)[:-1]))
+            deduped_labels = self._dbscan.fit_predict(deduped)
+            labels = deduped_labels[first_copy][inverse.ravel()]
+        cluster_count = len(set(labels)) - (1 if -1 in labels else 0)
+        return (labels, cluster_count)
+
+    def _cluster_weighted_coordinates(self, coordinates, weights):
+        """As _cluster_coordinates, for gaps standing for weight identical
+        reads each (collapsed duplicates): clusters weight copies of each
+        coordinate (at most min_samples of each distinct coordinate above the
+        deduplication threshold, judged by total weight), so labels match
+        clustering the duplicates individually."""
+        if weights.sum() < self._deduplication_threshold:
+            (distinct, inverse, copies) = (coordinates, 
+                np.arange(len(coordinates)), weights)
+        else:
+            (distinct, inverse) = np.unique(coordinates, axis=0, 
+                return_inverse=True)
+            inverse = inverse.ravel()
+            copies = np.minimum(np.bincount(inverse, weights=weights), 
+                self._min_samples).astype(np.int64)
+        deduped = np.repeat(distinct, copies, axis=0)
+        if len(deduped) != weights.sum():
+            self._logger.log(
+                "Deduplication reduced gap count from {0} to {1}". \
+                format(weights.sum(), len(deduped)))
+        first_copy = np.concatenate(([0], np.cumsum(copies)[:-1]))
+        labels = self._dbscan.fit_predict(deduped)[first_copy][inverse]
+        cluster_count = len(set(labels)) - (1 if -1 in labels else 0)
+        return (labels, cluster_count)
+
+    def assign_table_clusters(self, sorted_gap_table):
+        """Assigns clusters in place to a sorted GapTable, one chromosome 
+        at a time."""
+        chromosome_count = 0
+        total_chromosome_count = sorted_gap_table.chromosome_count()
+        gap_starts = sorted_gap_table.gap_start
+        gap_widths = sorted_gap_table.gap_width()
+        weights = sorted_gap_table.weight \
+            if sorted_gap_table.is_weighted() else None
+        for (chromosome, start, end) in sorted_gap_table.chromosome_slices():
+            chromosome_count += 1
+            self._logger.log(
+                "clustering {0} gaps in chromosome {1} ({2}/{3})". \
+                format(end - start, chromosome, chromosome_count, 
+                    total_chromosome_count))
+            start_time = time.clock()
+            coordinates = np.column_stack(
+                (gap_starts[start:end], gap_widths[start:end])). \
+                astype(np.float64)
+            (labels, cluster_count) = self._cluster_coordinates(coordinates,
+                None if weights is None else weights[start:end])
+            sorted_gap_table.cluster[start:end] = labels
+            self._logger.log(
+                "found {0} clusters for {1} gaps in "
+                "chromosome {2} in {3:.0f} seconds". \
+                format(cluster_count, end - start, chromosome, 
+                    time.clock()-start_time))
+
     def assign_clusters(self, gaps_sorted_by_chromosome):
         chromosome_count = 0
         total_chromosome_count = \
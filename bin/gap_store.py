@@ -0,0 +1,310 @@
+#! /usr/bin/env python
+
+"""
+gap_store.py
+Incrementally clusters gaps for a growing cohort of samples.
+
+Gaps are persisted in a store directory as one compact numpy archive per
+chromosome (see GapTable.to_arrays) alongside a JSON index. The index records,
+for each chromosome, a content hash of its gaps and the content hash its
+DBSCAN labels were computed against. Adding a sample's alignments merges its
+gaps into the affected chromosomes (changing their content hash); clustering
+then reruns DBSCAN only for chromosomes whose labels are stale and reuses the
+stored labels for every other chromosome. Cohort updates therefore cost time
+proportional to the new data rather than to the whole cohort.
+
+Archives are never rewritten in place: an update writes new archives and then
+switches the index to them in a single atomic rename, so a run which dies
+partway leaves the store as it was (and the sample can simply be added
+again). Files the index no longer references are removed after each switch.
+
+Each run writes the complete gap table and group summaries for the cohort and
+a cluster-tagged SAM for the input alignments. The gap and group lines are
+kept in the store per chromosome and only reformatted for chromosomes whose
+gaps or clusters changed; the cohort files are assembled by concatenating
+them. Note that cluster numbers are per chromosome, so previously emitted SAM
+files for chromosomes which were re-clustered may carry stale cluster tags.
+
+Example usage: ./gap_store.py store_dir sample_21798.06-postprocess.rg.sam
+    100 all_samples.07-cluster.tab sample_21798.07-cluster.sam
+"""
+from contextlib import nested
+import datetime
+import json
+import os
+import shutil
+import sys
+import numpy as np
+from cluster_gaps import GapTable, GapUtility, group_file_names, \
+    open_sam_input
+from cluster_utility import DbscanClusterUtility
+from instrumentation import StdErrLogger, metrics_for
+
+
+class GapStoreError(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class DuplicateSampleError(GapStoreError):
+    def __init__(self, sample):
+        super(DuplicateSampleError, self).__init__()
+        self.sample = sample
+
+    def __str__(self):
+        return repr("Sample has already been added to gap store: '{0}'". \
+            format(self.sample))
+
+
+class GapStore():
+    """Directory-backed collection of per-chromosome GapTables and their
+    cluster labels."""
+
+    _INDEX_FILE_NAME = "index.json"
+    _GAPS_SUFFIX = ".gaps.tab"
+    # (suffix, by_sample)
+    _GROUP_SUFFIXES = ((".sample-groups.tab", True),
+        (".cluster-groups.tab", False))
+    _FILE_SUFFIXES = (".npz", ".npz.tmp", _GAPS_SUFFIX) + \
+        tuple(suffix for (suffix, _) in _GROUP_SUFFIXES)
+
+    class ShuntLogger():
+        def log(self, message):
+            pass
+
+    def __init__(self, directory, logger=ShuntLogger()):
+        self._directory = directory
+        self._logger = logger
+        index_file_name = os.path.join(directory, self._INDEX_FILE_NAME)
+        if os.path.isfile(index_file_name):
+            with open(index_file_name, "r") as index_file:
+                self._index = json.load(index_file)
+            self._remove_unreferenced()
+        else:
+            self._index = {"samples": [], "chromosomes": {}}
+
+    def samples(self):
+        return sorted(self._index["samples"])
+
+    def chromosomes(self):
+        return sorted(self._index["chromosomes"])
+
+    def _save_index(self, index):
+        index_file_name = os.path.join(self._directory, self._INDEX_FILE_NAME)
+        with open(index_file_name + ".tmp", "w") as index_file:
+            json.dump(index, index_file, indent=1, sort_keys=True)
+        os.rename(index_file_name + ".tmp", index_file_name)
+
+    def _copy_index(self):
+        """Returns a copy of the index which can be updated (see _save)
+        without affecting the store until committed."""
+        return dict(self._index, samples=list(self._index["samples"]),
+            chromosomes=dict(self._index["chromosomes"]))
+
+    @staticmethod
+    def _bases(index):
+        return set(os.path.splitext(entry["file"])[0]
+            for entry in index["chromosomes"].values())
+
+    def _commit(self, index):
+        """Switches the store to index and removes the files it no longer
+        references."""
+        self._save_index(index)
+        superseded = self._bases(self._index) - self._bases(index)
+        self._index = index
+        for base in superseded:
+            for suffix in self._FILE_SUFFIXES:
+                file_name = os.path.join(self._directory, base + suffix)
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def _remove_unreferenced(self):
+        """Removes files left by a run which was interrupted before it
+        committed."""
+        referenced = self._bases(self._index)
+        for file_name in os.listdir(self._directory):
+            if file_name.endswith(self._FILE_SUFFIXES) and \
+                    file_name.split(".")[0] not in referenced:
+                os.remove(os.path.join(self._directory, file_name))
+
+    def _path(self, entry, suffix):
+        return os.path.join(self._directory,
+            os.path.splitext(entry["file"])[0] + suffix)
+
+    def _load(self, chromosome):
+        entry = self._index["chromosomes"][chromosome]
+        archive = np.load(os.path.join(self._directory, entry["file"]))
+        try:
+            return GapTable.from_arrays(archive)
+        finally:
+            archive.close()
+
+    def _save(self, index, chromosome, table):
+        """Writes table to a new archive and records it as chromosome's in
+        index (which is not yet committed); returns the entry."""
+        entries = index["chromosomes"]
+        entry = dict(entries.get(chromosome, {"labels_hash": None}))
+        # output lines are kept alongside the archive they were written from
+        entry.pop("output_hash", None)
+        file_count = index.get("file_count", 0)
+        entry["file"] = "gaps_{0}.npz".format(file_count)
+        index["file_count"] = file_count + 1
+        file_name = os.path.join(self._directory, entry["file"])
+        with open(file_name + ".tmp", "wb") as archive:
+            np.savez(archive, **table.to_arrays())
+        os.rename(file_name + ".tmp", file_name)
+        entry["gap_count"] = len(table)
+        entry["hash"] = table.content_hash()
+        entries[chromosome] = entry
+        return entry
+
+    def add(self, gap_table):
+        """Merges a GapTable into the store and returns the list of
+        chromosomes which gained gaps. Raises DuplicateSampleError if any
+        sample in the table was added previously."""
+        samples = gap_table.sample_names()
+        for sample in samples:
+            if sample in self._index["samples"]:
+                raise DuplicateSampleError(sample)
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        index = self._copy_index()
+        changed_chromosomes = []
+        sorted_gaps = gap_table.sorted()
+        for (chromosome, start, end) in sorted_gaps.chromosome_slices():
+            new_gaps = sorted_gaps.subtable(start, end)
+            if chromosome in self._index["chromosomes"]:
+                new_gaps = GapTable.concatenate(
+                    [self._load(chromosome), new_gaps]).sorted()
+            self._save(index, chromosome, new_gaps)
+            changed_chromosomes.append(chromosome)
+        index["samples"].extend(samples)
+        self._commit(index)
+        self._logger.log("added {0} gaps for {1} samples to {2} chromosomes".\
+            format(len(gap_table), len(samples), len(changed_chromosomes)))
+        return changed_chromosomes
+
+    def assign_clusters(self, cluster_utility):
+        """Clusters each chromosome whose stored labels were computed
+        against different content; returns (reclustered, reused) counts."""
+        (reclustered, reused) = (0, 0)
+        for chromosome in self.chromosomes():
+            entry = self._index["chromosomes"][chromosome]
+            if entry["labels_hash"] == entry["hash"]:
+                reused += 1
+                continue
+            gaps = self._load(chromosome)
+            cluster_utility.assign_table_clusters(gaps)
+            index = self._copy_index()
+            entry = self._save(index, chromosome, gaps)
+            entry["labels_hash"] = entry["hash"]
+            self._commit(index)
+            reclustered += 1
+        self._logger.log("reclustered {0} chromosomes; reused clusters for "
+            "{1} chromosomes".format(reclustered, reused))
+        return (reclustered, reused)
+
+    def write_outputs(self, gap_utility, gap_file_name, header_lines):
+        """Writes the gap file and its group files (see
+        cluster_gaps.group_file_names) for the whole cohort, reformatting
+        the stored lines only of chromosomes whose gaps changed since they
+        were last written; returns the number of chromosomes reformatted."""
+        # pylint: disable=protected-access
+        index = self._copy_index()
+        rewritten = 0
+        for chromosome in self.chromosomes():
+            entry = index["chromosomes"][chromosome]
+            if entry.get("output_hash") == entry["hash"]:
+                continue
+            gaps = self._load(chromosome)
+            with open(self._path(entry, self._GAPS_SUFFIX), "w") as writer:
+                gap_utility._write_gaps(gaps, writer)
+            for (suffix, by_sample) in self._GROUP_SUFFIXES:
+                with open(self._path(entry, suffix), "w") as writer:
+                    gap_utility._write_groups(gaps, writer, by_sample)
+            entry["output_hash"] = entry["hash"]
+            rewritten += 1
+        self._commit(index)
+
+        headers = [(self._GAPS_SUFFIX, lambda writer:
+                gap_utility._write_gap_header(writer, header_lines))] + \
+            [(suffix, lambda writer, by_sample=by_sample:
+                gap_utility._write_group_header(writer, by_sample))
+                for (suffix, by_sample) in self._GROUP_SUFFIXES]
+        file_names = (gap_file_name,) + group_file_names(gap_file_name)
+        for (file_name, (suffix, write_header)) in zip(file_names, headers):
+            with open(file_name, "w") as writer:
+                write_header(writer)
+                for chromosome in self.chromosomes():
+                    entry = self._index["chromosomes"][chromosome]
+                    with open(self._path(entry, suffix), "r") as reader:
+                        shutil.copyfileobj(reader, writer)
+        self._logger.log("reformatted {0} chromosomes; reused output for "
+            "{1} chromosomes".format(rewritten,
+                len(self.chromosomes()) - rewritten))
+        return rewritten
+
+    def table(self, chromosomes=None):
+        """Returns a sorted GapTable of the specified chromosomes (default
+        all chromosomes)."""
+        chromosomes = self.chromosomes() if chromosomes is None \
+            else sorted(chromosomes)
+        return GapTable.concatenate(
+            [self._load(chromosome) for chromosome in chromosomes])
+
+
+def main(store_directory, input_sam_file_name, original_read_len,
+        gap_file_name, output_sam_file_name, delimiter):
+    logger = StdErrLogger(verbose=True)
+    logger.log(" ".join(sys.argv), verbose=False)
+    header_lines = [str(datetime.datetime.today()), " ".join(sys.argv)] 
+    gap_utility = GapUtility(original_read_len, delimiter, logger)
+    store = GapStore(store_directory, logger)
+
+    metrics = metrics_for("gap_store")
+
+    logger.log("parsing sam file")
+    with metrics.stage("parse_sam") as stage, \
+            open_sam_input(input_sam_file_name, sequences=False) as sam_file:
+        gaps = gap_utility.samfile_to_gaps(stage.counted(sam_file, "lines"))
+        stage.count("gaps", len(gaps))
+
+    logger.log("adding {0} gaps to store".format(len(gaps)))
+    with metrics.stage("add_to_store"):
+        changed_chromosomes = store.add(gaps)
+
+    logger.log("clustering gaps")
+    with metrics.stage("cluster_gaps") as stage:
+        cluster_utility = DbscanClusterUtility(logger=logger, deduplication_threshold=1000)
+        (reclustered, _) = store.assign_clusters(cluster_utility)
+        stage.count("reclustered_chromosomes", reclustered)
+
+    logger.log("writing gaps and group summaries")
+    with metrics.stage("write_gaps") as stage:
+        stage.count("reformatted_chromosomes",
+            store.write_outputs(gap_utility, gap_file_name, header_lines))
+
+    logger.log("writing sam file with clusters")
+    with nested(open_sam_input(input_sam_file_name), 
+            open(output_sam_file_name,"w")) \
+            as (input_sam_file, output_sam_file):
+        gap_utility.write_sam_file(input_sam_file, 
+            store.table(changed_chromosomes), output_sam_file, header_lines)
+
+    logger.log("{0} complete".format(input_sam_file_name))
+
+if __name__ == "__main__":
+    BASENAME = os.path.basename(sys.argv[0])
+    if (len(sys.argv) != 6):
+        # pylint: disable=line-too-long
+        print ("usage: {0} [store_directory] [input_sam_file] [original_read_len] [gap_file] [output_sam_file]".format(BASENAME))
+        sys.exit()
+
+    (STORE_DIRECTORY, INPUT_SAM_FILE_NAME, ORIGINAL_READ_LEN, GAP_FILE_NAME, OUTPUT_SAM_FILE_NAME) = sys.argv[1:]
+    STORE_DIRECTORY = os.path.abspath(STORE_DIRECTORY)
+    INPUT_SAM_FILE_NAME = ",".join([os.path.abspath(FILE_NAME) for FILE_NAME in INPUT_SAM_FILE_NAME.split(",")])
+    GAP_FILE_NAME = os.path.abspath(GAP_FILE_NAME)
+    OUTPUT_SAM_FILE_NAME = os.path.abspath(OUTPUT_SAM_FILE_NAME)
+
+    main(STORE_DIRECTORY, INPUT_SAM_FILE_NAME, ORIGINAL_READ_LEN, GAP_FILE_NAME, OUTPUT_SAM_FILE_NAME, "\t")
+    print ("{0} done.".format(BASENAME))
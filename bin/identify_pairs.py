@@ -17,7 +17,9 @@ bottom.)
 Implementation: The script parses the input file, assembling a set of "read
 groups keys". A "read group" is a set of matching left and right reads and the
 set of keys define the universe of reads in the output (typically a small
-fraction of the input). Based on those keys, the program reads the file again,
+fraction of the input). Keys whose left and right alignment positions are too
+far apart (or wrongly oriented) to form any pair within the min/max distance
+are dropped at this point. Based on those keys, the program reads the file again,
 creating a hash of read groups which are then flattened to a collection of
 individual left-right pairs along with a distance (one line per pair). The
 collection of pairs is filtered on distance and written to the output file.
@@ -33,7 +35,29 @@ files, partitioning by chromosome, strand, or both. Importantly, the program
 assumes that all possible pairs exist within a single file, so each file should
 contain all alignments for a chromosome/strand. Thus, for example, you cannot
 partition the input files by chromosome region. See partition_file.py for
-details on partitioning a file.
+details on partitioning a file. Alternatively, --max-memory=[Mb] spills the
+read group keys to sorted runs on local disk (--spill-dir=[dir]) and
+intersects them with a k-way merge, so the first pass runs within the given
+memory regardless of input size (see SpilledGroupKeyBounds).
+
+The input can be SAM or BAM (recognized by content); BAM is decompressed on
+a pool of threads and the two key passes skip decoding sequences and
+qualities (see bam.py). With --bam-output the paired alignments are written
+as BAM, and with --sort-output also coordinate sorted and indexed, in place
+of separate samtools passes.
+
+The input can also be a comma-separated list of [mate=]file (e.g. the R1 and
+R2 split alignments of a sample: R1=a.sam,R2=b.sam; unlabeled inputs of a list
+are labeled R1, R2, ... by position). The inputs are read ahead concurrently
+and processed in one run as a single input whose read group keys are prefixed
+with the mate, so reads of the same name from different mates never pair;
+one .rsw and one .sam (with the union of the input headers, see merge_sam.py)
+are written for all of them, in place of a run per mate plus a merge.
+
+Reads collapsed by split_read.py --collapse-duplicates keep their duplicate
+count (;size=N) in their names, so it passes through to the output for
+cluster_gaps to weight by; the pair counts logged (and recorded in the
+write_rsw metrics) include the reads the pairs stand for.
 
 Modifications: 6/13/2013 - cgates To reduce memory consumption and improve
 performance, added step to identify common read group keys prior to building
@@ -73,13 +97,20 @@ facilitate this.
 revised to calculate gap distance correctly. """
 
 
-from datetime import datetime
+from array import array
+from contextlib import contextmanager
 import gc
+import heapq
 import os
 import re
-import resource 
+import shutil
 import sys
-import traceback
+import tempfile
+import numpy as np
+from bam import open_alignment_output, open_alignments
+from instrumentation import Metrics, StdErrLogger, metrics_for
+from merge_sam import merged_lines
+from split_read import duplicate_count
 
 
 class IdentifyPairsException(Exception):
@@ -96,22 +127,6 @@ class SplitReadParseError(IdentifyPairsException):
         return repr("Could not parse line: '{0}' ; {1}". \
             format(self.line, str(self.root_exception)))
 
-#pylint: disable=R0903
-class StdErrLogger():
-    """Writes basic utilization data to stderr"""   
-    def __init__(self, verbose = False):
-        self._verbose = verbose
-    
-    def log(self, message):
-        if (self._verbose):
-            usage = resource.getrusage(resource.RUSAGE_SELF)
-            memory_used = usage.ru_maxrss/1024
-            function_name = traceback.extract_stack()[-2:-1][0][2]
-            # pylint: disable=line-too-long
-            message = "usertime(s)={0:.0f}|systime(s)={1:.0f}|peak_memory_used(mb)={2}|{3}|{4}".\
-                format(usage.ru_utime, usage.ru_stime, memory_used, function_name, message)
-        sys.stderr.write("{0}|{1}\n".format(datetime.datetime.today(), message))
-
 #pylint: disable=W0232
 class SamFlags():
     MULTIPLE_SEGMENTS = 0x01
@@ -130,8 +145,9 @@ class SplitRead():
     """Basic data structure for an individual read"""
 
     def __init__(self, name, side, split_len, strand, chromosome, 
-            position, matches, original_read_len):
+            position, matches, original_read_len, mate=""):
         self._name = name
+        self._mate = mate
         self._side = side
         self._split_len = split_len
         self._strand = strand
@@ -153,6 +169,32 @@ class SplitRead():
             (self, other) if self._position < other._position else (other, self)
         return rightmost._position - (leftmost._position + leftmost._split_len)
 
+    def gap_fields(self, other):
+        """Returns (split_read_name, chromosome, read_start, gap_start,
+        gap_end, read_end) for the gap between this read and its pair, as
+        cluster_gaps derives it from the leftmost SAM alignment; None if the
+        reads share a position (no leftmost alignment)."""
+        if self._position == other._position:
+            return None
+        (leftmost, rightmost) = \
+            (self, other) if self._position < other._position else (other, self)
+        return (self.left_name(), self._chr, leftmost._position,
+            leftmost._position + leftmost._split_len, rightmost._position,
+            rightmost._position + \
+                (self._original_read_len - leftmost._split_len))
+
+    def gap_edge(self):
+        """Returns the position of this read's edge of the gap on a
+        strand-normalized axis, such that for an oriented pair the
+        gap_distance is the right read's gap_edge less the left read's. (The
+        gap follows the left read on the positive strand and precedes it on
+        the negative strand.)"""
+        if self._strand == "+":
+            return self._position + self._split_len \
+                if self._side == "L" else self._position
+        return -self._position \
+            if self._side == "L" else -(self._position + self._split_len)
+
     def is_oriented(self, other):
         """Returns true if other is on different side, same strand, and 
         positioned correctly relative to self"""
@@ -169,15 +211,22 @@ class SplitRead():
         """Returns a key for this read-group. A left or right split read from
         the same initial read aligning to any position on the same chromosome
         and strand would be part of the same read group. For this reason, the
-        key is always the 'left-side' key."""
+        key is always the 'left-side' key. Reads of a mate (when several mates
+        are processed together) have keys prefixed by the mate."""
         if self._side == "L":
             # pylint: disable=line-too-long
-            return "{0}|{1}|{2}|{3}|{4}".format(self._name, self._side, self._split_len, self._strand, self._chr)
+            key = "{0}|{1}|{2}|{3}|{4}".format(self._name, self._side, self._split_len, self._strand, self._chr)
         else:  
             new_side = "L"
             new_split_len = self._original_read_len - int(self._split_len)
             # pylint: disable=line-too-long
-            return "{0}|{1}|{2}|{3}|{4}".format(self._name, new_side, new_split_len, self._strand, self._chr)
+            key = "{0}|{1}|{2}|{3}|{4}".format(self._name, new_side, new_split_len, self._strand, self._chr)
+        return "{0}|{1}".format(self._mate, key) if self._mate else key
+
+    def duplicate_count(self):
+        """Returns the number of identical reads this read stands for (see
+        split_read.duplicate_count)."""
+        return duplicate_count(self._name)
 
     def left_name(self):
         """Returns the left handed name."""
@@ -196,16 +245,22 @@ class SplitRead():
     def __hash__(self):
         return self.key()
 
-    def sam_fields(self, pair):
+    def identity(self):
+        """Returns a cheap identity for this alignment within its read group
+        (with the key, equivalent to __eq__: the remaining fields follow from
+        the key and side)."""
+        return (self._side, self._position, self._matches)
+
+    def sam_fields(self, other, first):
+        """Returns (flag, pnext, tlen) for this read paired with other; first
+        if this read is the first segment (left read) of the pair."""
         flag = SamFlags.ALIGNED | SamFlags.MULTIPLE_SEGMENTS
         
-        if self == pair[0]:
-            (left, right) = (self, pair[1]) 
-            next_seg = pair[1]
+        if first:
+            (left, right) = (self, other) 
             flag |= SamFlags.FIRST_SEGMENT
         else:
-            (left, right) = (pair[0], self)
-            next_seg = pair[0]
+            (left, right) = (other, self)
             flag |= SamFlags.LAST_SEGMENT
         
         if right._position < left._position:
@@ -213,24 +268,24 @@ class SplitRead():
             if flag & SamFlags.FIRST_SEGMENT != 0 :
                 flag |= SamFlags.NEXT_REVERSE_COMPLEMENTED
         
-        return (flag, next_seg._position, next_seg._position - self._position)
+        return (flag, other._position, other._position - self._position)
 
-    def write_sam_pairs(self, read_group_pairs, line, writer, delimiter = "\t"):
-        key = self.key()
-        if not key in read_group_pairs:
+    def write_sam_pairs(self, pair_index, line, writer, delimiter = "\t",
+            read_group_tag = ""):
+        pairs = pair_index.pairs(self)
+        if not pairs:
             return
-        bits = line.split(delimiter)
+        bits = line.rstrip("\r\n").split(delimiter)
         chrom = bits[2]
         mapq  = bits[4]
         cigar = bits[5]
         seq = bits[9]
         qual = bits[10]
-        extra = bits[11:]
-        extras = " ".join(extra)
-        for pair in read_group_pairs[key]:
-            if self not in pair:
-                continue
-            (flag, pnext, tlen) = self.sam_fields(pair)
+        extras = bits[11:]
+        if read_group_tag:
+            extras.append(read_group_tag)
+        for (other, first) in pairs:
+            (flag, pnext, tlen) = self.sam_fields(other, first)
             outstring = delimiter.join([
                 self.left_name(), 
                 str(flag), 
@@ -242,11 +297,16 @@ class SplitRead():
                 str(pnext), 
                 str(tlen), 
                 seq, 
-                qual, 
-                extras])
-            writer.write(outstring)
+                qual] + extras)
+            writer.write(outstring + "\n")
                 
 
+    def leftmost_gap_fields(self, pair_index):
+        """Returns gap_fields for each pair this read belongs to where it is
+        the leftmost alignment (in the order write_sam_pairs emits them)."""
+        return [self.gap_fields(other) for (other, _) in
+            pair_index.pairs(self) if self._position < other._position]
+
     def add_to_read_groups(self, common_keys, read_groups): 
         key = self.key()
         if key in common_keys:
@@ -255,7 +315,9 @@ class SplitRead():
             group[index].append(self)
 
     def add_to_group_keys(self, group_keys):
-        group_keys[self._side].add(self.key())
+        """Records the key and gap_edge of this read in the GroupKeyBounds
+        for its side."""
+        group_keys[self._side].add(self.key(), self.gap_edge())
 
     def check_split_length(self, validator):
         validator.check_split_length(self._split_len)
@@ -284,9 +346,14 @@ class UnalignedSplitRead():
         return None
 
     #pylint: disable=W0613
-    def write_sam_pairs(self, read_group_pairs, line, writer): 
+    def write_sam_pairs(self, pair_index, line, writer, delimiter="\t",
+            read_group_tag=""): 
         pass
 
+    #pylint: disable=W0613
+    def leftmost_gap_fields(self, pair_index): 
+        return []
+
     #pylint: disable=W0613
     def add_to_read_groups(self, common_keys, read_groups): 
         pass
@@ -300,9 +367,48 @@ class UnalignedSplitRead():
         pass
         
     #pylint: disable=W0613
-    def sam_fields(self, pair):
+    def sam_fields(self, other, first):
         return None
 
+
+class PairIndex():
+    """Finds the pairs of read_group_pairs an alignment takes part in. Small
+    read groups are scanned (comparing the alignment to each pair is cheap);
+    the members of read groups with more than _SCAN_PAIRS pairs (highly
+    multi-mapped reads) are indexed by identity (see SplitRead.identity) so
+    each of their alignments costs one lookup rather than a comparison with
+    every pair of the group."""
+
+    _SCAN_PAIRS = 8
+
+    def __init__(self, read_group_pairs):
+        #Circumvents a gc bug; see modifications.
+        gc.disable()
+        self._read_group_pairs = read_group_pairs
+        self._groups = {}
+        for (key, pairs) in read_group_pairs.iteritems():
+            if len(pairs) <= self._SCAN_PAIRS:
+                continue
+            members = self._groups[key] = {}
+            for pair in pairs:
+                (left, right) = pair[0:2]
+                members.setdefault(left.identity(), []).append((right, True))
+                members.setdefault(right.identity(), []). \
+                    append((left, False))
+        gc.enable()
+
+    def pairs(self, split_read):
+        """Returns (other read, split_read is first) for each pair split_read
+        belongs to, in read group order."""
+        key = split_read.key()
+        pairs = self._read_group_pairs.get(key)
+        if not pairs:
+            return ()
+        if len(pairs) > self._SCAN_PAIRS:
+            return self._groups[key].get(split_read.identity(), ())
+        return [(pair[1], True) if split_read == pair[0] else (pair[0], False)
+            for pair in pairs if split_read in pair]
+
 class ReadLengthValidationError(IdentifyPairsException):
     pass
 
@@ -389,6 +495,13 @@ class SamSplitReadBuilder():
         self._original_read_len = original_read_len
         self._delimiter = delimiter
         self._name_re = re.compile(r"(.+)-([LR])-([\d]+)$")
+        self._mate = ""
+        self._key_prefix = ""
+
+    def set_mate(self, mate):
+        """Builds subsequent lines as reads of mate (see SplitRead.key)."""
+        self._mate = mate
+        self._key_prefix = mate + "|" if mate else ""
         
     def build(self, line):
         try:
@@ -403,24 +516,292 @@ class SamSplitReadBuilder():
                 (matches.group(1), matches.group(2), matches.group(3))
             strand = "+" if int(flag) & 16 == 0 else "-"
             return SplitRead(subname, side, int(split_len), strand, rname, \
-                int(position), None, self._original_read_len)
+                int(position), None, self._original_read_len, self._mate)
 
         except ValueError as error:
             raise SplitReadParseError(line, error)
+
+    def key(self, line):
+        """Returns the read group key of the alignment (as build(line).key()
+        would) from the raw name, flag and reference fields without building
+        a SplitRead; None if the read has not aligned."""
+        (name, flag, rname, _) = line.split(self._delimiter, 3)
+        flag = int(flag)
+        if flag & SamFlags.SEGMENT_UNMAPPED != 0:
+            return None
+        # name is [subname]-[L|R]-[split_len]
+        (name_side, _, split_len) = name.rpartition("-")
+        if name_side[-1] == "R":
+            split_len = str(self._original_read_len - int(split_len))
+        elif split_len[0] == "0":
+            split_len = str(int(split_len))
+        strand = "|+|" if flag & SamFlags.SEQ_REVERSE_COMPLEMENTED == 0 \
+            else "|-|"
+        return self._key_prefix + name_side[:-2] + "|L|" + split_len + \
+            strand + rname
             
     def is_header(self, line):
         return line.startswith("@")
 
 
-def _identify_common_group_keys(split_read_builder, validator, reader, logger):
+class GroupKeyBounds():
+    """The [min, max] gap_edge of the reads with each read group key on one
+    side (left or right). The bounds of a key are packed into a single int
+    ((min + offset) << 31 | (max + offset)), so each key costs a dict entry
+    and one int; edges must lie within +/-2**30."""
+
+    _BITS = 31
+    _OFFSET = 1 << 30
+    _MASK = (1 << _BITS) - 1
+
+    def __init__(self):
+        self._bounds = {}
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def add(self, key, edge):
+        edge += self._OFFSET
+        bounds = self._bounds.get(key)
+        if bounds is None:
+            self._bounds[key] = (edge << self._BITS) | edge
+        elif edge < bounds >> self._BITS:
+            self._bounds[key] = (edge << self._BITS) | (bounds & self._MASK)
+        elif edge > bounds & self._MASK:
+            self._bounds[key] = (bounds >> self._BITS << self._BITS) | edge
+
+    def _unpack(self, bounds):
+        return ((bounds >> self._BITS) - self._OFFSET,
+            (bounds & self._MASK) - self._OFFSET)
+
+    def get(self, key):
+        bounds = self._bounds.get(key)
+        return None if bounds is None else self._unpack(bounds)
+
+    def intersection(self, other, bounds_filter=None):
+        """Returns (the set of keys present in both self and other which pass
+        bounds_filter, count of keys excluded by bounds_filter)."""
+        common_keys = set()
+        pruned_count = 0
+        for key, left_bounds in self._bounds.iteritems():
+            right_bounds = other.get(key)
+            if right_bounds is None:
+                continue
+            if bounds_filter and not bounds_filter(self._unpack(left_bounds),
+                    right_bounds):
+                pruned_count += 1
+                continue
+            common_keys.add(key)
+        return (common_keys, pruned_count)
+
+
+class KeyHashSet():
+    """A sorted array of key hashes supporting 'key in key_hash_set'; a
+    compact (8 bytes per key) stand-in for a set of common keys. Keys whose
+    hashes collide with a member are also reported as members."""
+
+    def __init__(self, sorted_hashes):
+        self._hashes = sorted_hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, key):
+        key_hash = hash(key)
+        index = np.searchsorted(self._hashes, key_hash)
+        return index < len(self._hashes) and self._hashes[index] == key_hash
+
+    def hashes(self):
+        return self._hashes
+
+
+class KeyBloomFilter():
+    """A Bloom filter over key hashes; 'key in bloom_filter' is always true
+    for the keys it was built from and true for roughly 1.5% of other keys
+    (with the default 16 bits per key and two probes). Much cheaper than
+    building a SplitRead to test its key against the common keys."""
+
+    _BITS_PER_KEY = 16
+    _MIN_BITS = 64
+    # keys probed at once while building; bounds the transient probe arrays
+    _BLOCK_KEYS = 1 << 16
+
+    def __init__(self, key_hashes, bits_per_key=_BITS_PER_KEY):
+        key_hashes = np.asarray(key_hashes, dtype=np.int64)
+        self._bit_count = max(self._MIN_BITS, len(key_hashes) * bits_per_key)
+        bits = np.zeros((self._bit_count + 7) // 8, dtype=np.uint8)
+        for start in range(0, len(key_hashes), self._BLOCK_KEYS):
+            for probe in self._probes(
+                    key_hashes[start:start + self._BLOCK_KEYS]):
+                self._set_bits(bits, probe)
+        self._bits = bytearray(bits.data)
+
+    @staticmethod
+    def _set_bits(bits, probe):
+        """Sets the bits at the probe positions (most significant bit first
+        within each byte). Each offset within a byte is set in one pass, so
+        repeated bytes in a pass all receive the same value."""
+        offsets = probe & 7
+        for offset in range(8):
+            bits[probe[offsets == offset] >> 3] |= 0x80 >> offset
+
+    def _probes(self, key_hash):
+        """Bit positions for key_hash (an int or an array of them)."""
+        return (key_hash % self._bit_count,
+            (key_hash >> 24) % self._bit_count)
+
+    def __contains__(self, key):
+        key_hash = hash(key)
+        probe = key_hash % self._bit_count
+        if not self._bits[probe >> 3] & (0x80 >> (probe & 7)):
+            return False
+        probe = (key_hash >> 24) % self._bit_count
+        return self._bits[probe >> 3] & (0x80 >> (probe & 7)) != 0
+
+    @staticmethod
+    def from_keys(common_keys):
+        """Builds the filter from a set of keys or a KeyHashSet."""
+        if isinstance(common_keys, KeyHashSet):
+            return KeyBloomFilter(common_keys.hashes())
+        return KeyBloomFilter(np.fromiter((hash(key) for key in common_keys),
+            dtype=np.int64, count=len(common_keys)))
+
+
+def _read_run(run_file_name, block_records):
+    with open(run_file_name, "rb") as run_file:
+        while True:
+            block = np.fromfile(run_file, dtype=SpilledGroupKeyBounds.RUN_DTYPE,
+                count=block_records)
+            if not len(block):
+                break
+            for record in block.tolist():
+                yield record
+
+def _combine_run_records(records):
+    """Combines consecutive (hash, min, max) records with the same hash."""
+    current = None
+    for (key_hash, low, high) in records:
+        if current is None or current[0] != key_hash:
+            if current is not None:
+                yield tuple(current)
+            current = [key_hash, low, high]
+        else:
+            current[1] = min(current[1], low)
+            current[2] = max(current[2], high)
+    if current is not None:
+        yield tuple(current)
+
+
+class SpilledGroupKeyBounds():
+    """GroupKeyBounds for inputs whose keys do not fit in memory. Each key
+    is recorded as its hash (with its gap_edge) in a compact buffer; when
+    the buffer is full it is sorted, reduced to [min, max] bounds per hash
+    and written to spill_dir as a sorted run. intersection() k-way merges
+    the runs for each side and merge-joins the two sides, returning a
+    KeyHashSet. Distinct keys with colliding hashes are treated as one
+    (their bounds combined); this can only admit extra reads to the read
+    groups, which the pair filters then exclude.
+
+    memory_bytes bounds the buffer (and the merge blocks read back from the
+    runs); the budget includes the transient copies made while sorting."""
+
+    RUN_DTYPE = np.dtype([("hash", "<i8"), ("min", "<i8"), ("max", "<i8")])
+    _BUFFER_RECORD_BYTES = 64
+    _MERGE_RECORD_BYTES = 160
+    _MIN_BLOCK_RECORDS = 1024
+
+    def __init__(self, spill_dir, name, memory_bytes):
+        self._spill_dir = spill_dir
+        self._name = name
+        self._memory_bytes = memory_bytes
+        self._max_records = max(self._MIN_BLOCK_RECORDS,
+            memory_bytes // self._BUFFER_RECORD_BYTES)
+        self._hashes = array("l")
+        self._edges = array("l")
+        self._run_file_names = []
+        self._run_key_count = 0
+
+    def __len__(self):
+        """The number of distinct keys in each run (an upper bound on the
+        number of distinct keys)."""
+        return self._run_key_count + len(self._hashes)
+
+    def add(self, key, edge):
+        self._hashes.append(hash(key))
+        self._edges.append(edge)
+        if len(self._hashes) >= self._max_records:
+            self._spill()
+
+    def _spill(self):
+        if not len(self._hashes):
+            return
+        hashes = np.frombuffer(self._hashes, dtype=np.int_)
+        edges = np.frombuffer(self._edges, dtype=np.int_)
+        order = np.argsort(hashes, kind="mergesort")
+        (hashes, edges) = (hashes[order], edges[order])
+        starts = np.flatnonzero(np.concatenate(([True],
+            hashes[1:] != hashes[:-1])))
+        run = np.empty(len(starts), dtype=self.RUN_DTYPE)
+        run["hash"] = hashes[starts]
+        run["min"] = np.minimum.reduceat(edges, starts)
+        run["max"] = np.maximum.reduceat(edges, starts)
+        run_file_name = os.path.join(self._spill_dir, "{0}.{1}.run". \
+            format(self._name, len(self._run_file_names)))
+        run.tofile(run_file_name)
+        self._run_file_names.append(run_file_name)
+        self._run_key_count += len(run)
+        del hashes, edges, order, run
+        (self._hashes, self._edges) = (array("l"), array("l"))
+
+    def _merged_bounds(self, block_records):
+        """Yields (hash, min, max) in hash order across all runs."""
+        self._spill()
+        return _combine_run_records(heapq.merge(*[_read_run(file_name,
+            block_records) for file_name in self._run_file_names]))
+
+    def intersection(self, other, bounds_filter=None):
+        """Returns (KeyHashSet of the hashes present in both self and other
+        which pass bounds_filter, count of hashes excluded by
+        bounds_filter)."""
+        run_count = max(1, len(self._run_file_names) + \
+            len(other._run_file_names) + 2)
+        block_records = max(self._MIN_BLOCK_RECORDS, self._memory_bytes // \
+            (self._MERGE_RECORD_BYTES * run_count))
+        left = self._merged_bounds(block_records)
+        right = other._merged_bounds(block_records)
+        common_hashes = array("l")
+        pruned_count = 0
+        right_record = next(right, None)
+        for left_record in left:
+            while right_record is not None and right_record[0] < left_record[0]:
+                right_record = next(right, None)
+            if right_record is None:
+                break
+            if right_record[0] != left_record[0]:
+                continue
+            if bounds_filter and \
+                    not bounds_filter(left_record[1:], right_record[1:]):
+                pruned_count += 1
+                continue
+            common_hashes.append(left_record[0])
+        return (KeyHashSet(np.array(common_hashes, dtype=np.int64)),
+            pruned_count)
+
+
+def _identify_common_group_keys(split_read_builder, validator, reader, logger,
+        bounds_filter=None, group_keys=None):
     """Reads every line, returning the set of all read keys that appeared on
     both the left and right sides. Each key in the result identifies a "read
     group"; the reads with these keys that pass other filtering criteria will
-    appear in the output file"""
+    appear in the output file. If specified, bounds_filter excludes keys
+    whose left and right gap_edge bounds rule out any passing pair. The keys
+    are collected in group_keys (a GroupKeyBounds for each side, by
+    default)."""
 
     #Circumvents a gc bug; see modifications.
     gc.disable()
-    group_keys = { "L" : set(), "R" : set() }
+    if group_keys is None:
+        group_keys = { "L" : GroupKeyBounds(), "R" : GroupKeyBounds() }
     count = 0
 
     for line in reader:
@@ -437,8 +818,11 @@ def _identify_common_group_keys(split_read_builder, validator, reader, logger):
     
     logger.log("intersecting {0} left keys with {1} right keys".\
         format(len(group_keys["L"]), len(group_keys["R"]))) 
-    common_keys = group_keys["L"].intersection(group_keys["R"])
-    logger.log("found {0} common keys".format(len(common_keys)))
+    (common_keys, pruned_count) = group_keys["L"].intersection(
+        group_keys["R"], bounds_filter)
+    del group_keys
+    logger.log("found {0} common keys ({1} excluded by position bounds)". \
+        format(len(common_keys), pruned_count))
 
     validator.check_read_length()
 
@@ -446,10 +830,14 @@ def _identify_common_group_keys(split_read_builder, validator, reader, logger):
     return common_keys
 
 
-def _build_read_groups(common_keys, split_read_builder, reader, logger):
+def _build_read_groups(common_keys, split_read_builder, reader, logger,
+        key_filter=None):
     """Reads every line, returning a hash of read groups; each read group is a
     tuple of matching left and right reads. Only reads with key in common keys
-    are included."""
+    are included. If specified, key_filter (e.g. a KeyBloomFilter of the
+    common keys) is tested against the key derived from the raw line first,
+    skipping lines whose key is not in key_filter without building a
+    SplitRead."""
 
     #Circumvents a gc bug; see modifications.
     gc.disable()
@@ -462,6 +850,10 @@ def _build_read_groups(common_keys, split_read_builder, reader, logger):
         count += 1
         if count % 100000 == 1: 
             logger.log("processing line {0}".format(count))
+        if key_filter is not None:
+            key = split_read_builder.key(line)
+            if key is None or key not in key_filter:
+                continue
         split_read = split_read_builder.build(line)
         split_read.add_to_read_groups(common_keys, read_groups)
 
@@ -521,6 +913,19 @@ def _distance_filter(min_distance, max_distance):
 
     return filter_pair
 
+def _bounds_filter(min_distance, max_distance):
+    """Excludes a read group when the [min, max] gap_edge bounds of its left
+    and right reads show no pair could pass the distance filter. Pairs
+    passing the orientation filter have gap_distance equal to the difference
+    of their gap_edges, so groups whose only pairs are misoriented (with a
+    negative difference) are also excluded given a non-negative
+    min_distance."""
+    def filter_bounds(left_bounds, right_bounds):
+        return right_bounds[1] - left_bounds[0] >= min_distance and \
+            right_bounds[0] - left_bounds[1] <= max_distance
+
+    return filter_bounds
+
 def _orientation_filter(read1, read2):
     return read1.is_oriented(read2)
 
@@ -533,10 +938,14 @@ def _composite_filter(filter_list):
     return filter_pair
 
 def _write_rsw_pairs(all_read_group_pairs, writer, logger, delimiter="\t"):
+    """Writes each pair on a line; returns the number of pairs and the number
+    of reads they stand for (counting collapsed duplicates)."""
     count = 0
+    read_count = 0
     for read_group_pairs in all_read_group_pairs.values():
         for pair in read_group_pairs:
             count += 1
+            read_count += pair[0].duplicate_count()
             left_read = pair[0].format(delimiter)
             right_read = pair[1].format(delimiter)
             distance = str(pair[0].gap_distance(pair[1]))
@@ -545,19 +954,38 @@ def _write_rsw_pairs(all_read_group_pairs, writer, logger, delimiter="\t"):
             if count % 100000 == 1:
                 logger.log("processing pair {0}".format(count))
 
-    logger.log("processed {0} pairs".format(count))
+    logger.log("processed {0} pairs ({1} reads counting collapsed "
+        "duplicates)".format(count, read_count))
+    return (count, read_count)
 
 
 def _write_sam_pairs(read_group_pairs, reader, builder, writer, logger, \
-        delim="\t"):
+        delim="\t", read_group=None):
+    """Writes the alignments participating in pairs as SAM. If read_group
+    (an (id, sample) tuple) is specified, an @RG header line is added ahead
+    of the first @PG line (or at the end of the header) and each alignment
+    is tagged with RG:Z:id."""
     count = 0
+    read_group_tag = ""
+    read_group_line = None
+    pair_index = PairIndex(read_group_pairs)
+    if read_group:
+        read_group_tag = "RG:Z:{0}".format(read_group[0])
+        read_group_line = "@RG{0}ID:{1}{0}SM:{2}\n".format(delim, *read_group)
     for line in reader:
         count += 1
         if builder.is_header(line):
+            if read_group_line and line.startswith("@PG"):
+                writer.write(read_group_line)
+                read_group_line = None
             writer.write(line)
         else:
+            if read_group_line:
+                writer.write(read_group_line)
+                read_group_line = None
             split_read = builder.build(line)
-            split_read.write_sam_pairs(read_group_pairs, line, writer, delim)
+            split_read.write_sam_pairs(pair_index, line, writer, delim, 
+                read_group_tag)
 
         if count % 100000 == 1:
             logger.log("processing line {0}".format(count))
@@ -565,8 +993,106 @@ def _write_sam_pairs(read_group_pairs, reader, builder, writer, logger, \
     logger.log("processed {0} lines".format(count))
     
     
+def mate_inputs(input_file_name):
+    """Returns [(mate, file_name)] for a comma-separated list of
+    [mate=]file_name; unlabeled inputs of a list are labeled R1, R2, ... by
+    position. A single file name is returned with no mate ("")."""
+    specs = input_file_name.split(",")
+    if len(specs) == 1 and "=" not in specs[0]:
+        return [("", input_file_name)]
+    inputs = []
+    for (index, spec) in enumerate(specs):
+        if "=" in spec:
+            (mate, _, file_name) = spec.partition("=")
+        else:
+            (mate, file_name) = ("R{0}".format(index + 1), spec)
+        inputs.append((mate, file_name))
+    return inputs
+
+@contextmanager
+def open_split_alignments(input_file_name, builder, sequences=True):
+    """Yields the lines of the input (see mate_inputs), switching builder to
+    the mate of each input ahead of its records. Several inputs are read
+    ahead concurrently and yielded as one (see merge_sam.merged_lines)."""
+    inputs = mate_inputs(input_file_name)
+    if len(inputs) == 1:
+        builder.set_mate(inputs[0][0])
+        with open_alignments(inputs[0][1], sequences) as reader:
+            yield reader
+        return
+    mates = [mate for (mate, _) in inputs]
+    yield merged_lines([file_name for (_, file_name) in inputs],
+        sequences=sequences,
+        on_input=lambda index: builder.set_mate(mates[index]))
+
+def _spilled_group_keys(spill_dir, max_memory_mb):
+    memory_bytes = max_memory_mb * 1024 * 1024 // 2
+    return {"L": SpilledGroupKeyBounds(spill_dir, "L", memory_bytes),
+        "R": SpilledGroupKeyBounds(spill_dir, "R", memory_bytes)}
+
+def identify_read_group_pairs(original_read_len, input_file_name, min_dist,
+        max_dist, logger, metrics=None, max_memory_mb=None, spill_dir=None):
+    """Reads the SAM input (see mate_inputs) twice, returning a dict of read
+    group key to the list of (left, right) SplitRead pairs which pass the
+    distance and orientation filters. If max_memory_mb is specified, the read
+    group keys
+    are spilled to sorted runs in a temporary directory (under spill_dir,
+    default the system temp dir) rather than held in memory (see
+    SpilledGroupKeyBounds)."""
+    metrics = metrics or Metrics("identify_pairs")
+    builder = SamSplitReadBuilder(original_read_len)
+    validator = ReadLengthValidator(original_read_len)
+    
+    with metrics.stage("identify_common_group_keys") as stage:
+        run_dir = None
+        group_keys = None
+        if max_memory_mb:
+            run_dir = tempfile.mkdtemp(prefix="identify_pairs.", dir=spill_dir)
+            logger.log("spilling keys to {0}".format(run_dir))
+        try:
+            if run_dir:
+                group_keys = _spilled_group_keys(run_dir, max_memory_mb)
+            with open_split_alignments(input_file_name, builder,
+                    sequences=False) as reader:
+                common_keys = _identify_common_group_keys(builder, \
+                    validator, stage.counted(reader, "lines"), logger,
+                    _bounds_filter(min_dist, max_dist), group_keys)
+        finally:
+            if run_dir:
+                shutil.rmtree(run_dir)
+        stage.count("common_keys", len(common_keys))
+
+    with metrics.stage("build_read_groups") as stage:
+        with open_split_alignments(input_file_name, builder,
+                sequences=False) as reader:
+            read_groups = _build_read_groups(common_keys, builder, 
+                stage.counted(reader, "lines"), logger,
+                KeyBloomFilter.from_keys(common_keys))
+        stage.count("read_groups", len(read_groups))
+
+    with metrics.stage("build_pairs"):
+        read_group_pairs = _build_pairs_from_groups(read_groups, logger)
+
+    with metrics.stage("filter_pairs") as stage:
+        pair_filter = _composite_filter(\
+            [_distance_filter(min_dist, max_dist), _orientation_filter])
+        read_group_pairs = _filter_pairs(read_group_pairs, pair_filter, logger)
+        stage.count("read_groups", len(read_group_pairs))
+    return read_group_pairs
+
+def write_rsw_file(read_group_pairs, output_file_name, logger, metrics=None):
+    metrics = metrics or Metrics("identify_pairs")
+    with metrics.stage("write_rsw") as stage:
+        writer = open(output_file_name, "w")    
+        (count, read_count) = _write_rsw_pairs(read_group_pairs, writer,
+            logger)
+        writer.close()
+        stage.count("pairs", count)
+        stage.count("pair_reads", read_count)
+
 def main(original_read_len, input_file_name, output_file_name, \
-        sam_output_file_name, min_dist, max_dist):
+        sam_output_file_name, min_dist, max_dist, read_group=None,
+        max_memory_mb=None, spill_dir=None, sort_output=False):
     
     logger = StdErrLogger(True)
     logger.log("read_len:{0}, " \
@@ -574,37 +1100,27 @@ def main(original_read_len, input_file_name, output_file_name, \
         "output_file_name:{2}, " \
         "sam_output_file_name:{3}, " \
         "minimum_distance:{4}, " \
-        "maximum_distance:{5}".format(original_read_len, input_file_name, \
-            output_file_name, sam_output_file_name, min_dist, max_dist))
+        "maximum_distance:{5}, " \
+        "read_group:{6}, " \
+        "max_memory_mb:{7}, " \
+        "sort_output:{8}".format(original_read_len, input_file_name, \
+            output_file_name, sam_output_file_name, min_dist, max_dist, \
+            read_group, max_memory_mb, sort_output))
     logger.log("{0} begins".format(input_file_name))
     
+    metrics = metrics_for("identify_pairs")
     builder = SamSplitReadBuilder(original_read_len)
-    validator = ReadLengthValidator(original_read_len)
-    
-    reader = open(input_file_name, "r")
-    common_keys = _identify_common_group_keys(builder, \
-        validator, reader, logger)
-    reader.close()
-
-    reader = open(input_file_name, "r")
-    read_groups = _build_read_groups(common_keys, builder, reader, logger)
-    reader.close()  
-
-    read_group_pairs = _build_pairs_from_groups(read_groups, logger)
-
-    pair_filter = _composite_filter(\
-        [_distance_filter(min_dist, max_dist), _orientation_filter])
-    read_group_pairs = _filter_pairs(read_group_pairs, pair_filter, logger)
-     
-    writer = open(output_file_name, "w")    
-    _write_rsw_pairs(read_group_pairs, writer, logger)
-    writer.close()
-
-    reader = open(input_file_name, "r") 
-    writer = open(sam_output_file_name, "w")    
-    _write_sam_pairs(read_group_pairs, reader, builder, writer, logger)
-    writer.close()
-    reader.close()
+    read_group_pairs = identify_read_group_pairs(original_read_len, 
+        input_file_name, min_dist, max_dist, logger, metrics, max_memory_mb,
+        spill_dir)
+    write_rsw_file(read_group_pairs, output_file_name, logger, metrics)
+
+    with metrics.stage("write_sam") as stage:
+        with open_split_alignments(input_file_name, builder) as reader, \
+                open_alignment_output(sam_output_file_name, sort_output,
+                    spill_dir) as writer:
+            _write_sam_pairs(read_group_pairs, stage.counted(reader, "lines"), 
+                builder, writer, logger, read_group=read_group)
 
     logger.log("output written to {0}".format(output_file_name))
     logger.log("{0} complete".format(input_file_name))
@@ -613,28 +1129,47 @@ def main(original_read_len, input_file_name, output_file_name, \
 if __name__ == "__main__":
 
     # pylint: disable=line-too-long
-    USAGE = "usage: {0} [infile] [outfile] [read_len] [min_distance] [max_distance]".format(os.path.basename(sys.argv[0]))
-    if (len(sys.argv) != 6):
+    MAX_MEMORY_FLAG = "--max-memory="
+    SPILL_DIR_FLAG = "--spill-dir="
+    BAM_OUTPUT_FLAG = "--bam-output"
+    SORT_OUTPUT_FLAG = "--sort-output"
+    USAGE = "usage: {0} [infile (sam or bam; or a comma-separated list of [mate=]infile, e.g. R1=a.sam,R2=b.sam, paired together in one run with mates kept apart)] [outfile] [read_len] [min_distance] [max_distance] [read_group_id read_group_sample (optional; adds @RG and RG:Z: tags to sam output)] [{1}Mb (spill read group keys to disk to stay within this memory)] [{2}directory for spilled keys and sort runs (default system temp dir)] [{3} (write paired alignments as [outfile].bam rather than [outfile].sam)] [{4} (coordinate sort the bam output and write a .bai index)]".format(os.path.basename(sys.argv[0]), MAX_MEMORY_FLAG, SPILL_DIR_FLAG, BAM_OUTPUT_FLAG, SORT_OUTPUT_FLAG)
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith(MAX_MEMORY_FLAG) and not arg.startswith(SPILL_DIR_FLAG) and arg not in (BAM_OUTPUT_FLAG, SORT_OUTPUT_FLAG)]
+    if (len(ARGS) not in (5, 7)):
         print (USAGE)
         sys.exit() 
 
-    (INFILE, OUTFILE, ORIGINAL_READ_LEN, MIN_DISTANCE, MAX_DISTANCE) = sys.argv[1:]
-    INFILE = os.path.abspath(INFILE)
+    (INFILE, OUTFILE, ORIGINAL_READ_LEN, MIN_DISTANCE, MAX_DISTANCE) = ARGS[0:5]
+    READ_GROUP = tuple(ARGS[5:7]) if len(ARGS) == 7 else None
+    MAX_MEMORY_MB = None
+    SPILL_DIR = None
+    for ARG in sys.argv[1:]:
+        if ARG.startswith(MAX_MEMORY_FLAG):
+            MAX_MEMORY_MB = ARG[len(MAX_MEMORY_FLAG):]
+        elif ARG.startswith(SPILL_DIR_FLAG):
+            SPILL_DIR = os.path.abspath(ARG[len(SPILL_DIR_FLAG):])
+    INFILE = ",".join(["{0}={1}".format(MATE, os.path.abspath(FILE_NAME)) if MATE else os.path.abspath(FILE_NAME) for (MATE, FILE_NAME) in mate_inputs(INFILE)])
     OUTFILE = os.path.abspath(OUTFILE)
-    SAM_OUTFILE = "{0}.sam".format(os.path.splitext(OUTFILE)[0])
+    BAM_OUTPUT = BAM_OUTPUT_FLAG in sys.argv[1:]
+    SORT_OUTPUT = SORT_OUTPUT_FLAG in sys.argv[1:]
+    SAM_OUTFILE = "{0}.{1}".format(os.path.splitext(OUTFILE)[0], "bam" if BAM_OUTPUT else "sam")
 
     # check params
     try:
         MIN_DISTANCE = int(MIN_DISTANCE)
         MAX_DISTANCE = int(MAX_DISTANCE)
         ORIGINAL_READ_LEN = int(ORIGINAL_READ_LEN)
+        if MAX_MEMORY_MB is not None:
+            MAX_MEMORY_MB = int(MAX_MEMORY_MB)
         if MAX_DISTANCE <= MIN_DISTANCE:
             raise ValueError("max distance must be greater than min distance")
+        if SORT_OUTPUT and not BAM_OUTPUT:
+            raise ValueError("{0} requires {1}".format(SORT_OUTPUT_FLAG, BAM_OUTPUT_FLAG))
     except ValueError as error:
         print (str(error))
         print (USAGE)
         sys.exit()  
 
     # pylint: disable=line-too-long
-    main(ORIGINAL_READ_LEN, INFILE, OUTFILE, SAM_OUTFILE, MIN_DISTANCE, MAX_DISTANCE) 
+    main(ORIGINAL_READ_LEN, INFILE, OUTFILE, SAM_OUTFILE, MIN_DISTANCE, MAX_DISTANCE, READ_GROUP, MAX_MEMORY_MB, SPILL_DIR, SORT_OUTPUT) 
     print ("done.")
@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+
+"""
+instrumentation.py
+Shared logging and performance metrics for the pipeline scripts.
+
+StdErrLogger writes progress messages to stderr, optionally prefixed with
+cpu times, peak memory and the calling function. Metrics records wall time,
+call counts, record counts (throughput) and peak resident memory for each
+named stage of a run. Resident memory is sampled on a background thread so
+each stage reports its own peak rather than the process high-water mark.
+
+When the RSW_METRICS_DIR environment variable names a directory, metrics_for()
+starts the memory sampler and writes a JSON summary of the run to
+[RSW_METRICS_DIR]/[script].[timestamp].[pid].json at exit, so production runs
+can be compared over time. Otherwise metrics are collected (cheaply) but not
+written.
+"""
+import atexit
+from contextlib import contextmanager
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+METRICS_DIR_ENV = "RSW_METRICS_DIR"
+
+def _peak_rss_mb():
+    """Process high-water mark resident memory (Mb; ru_maxrss is Kb on
+    Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+def _current_rss_mb():
+    """Current resident memory (Mb), or the high-water mark where /proc is
+    not available."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (IOError, OSError, ValueError, IndexError):
+        return _peak_rss_mb()
+
+
+class StdErrLogger():
+    """Writes messages to stderr; if verbose, prefixed with cpu times, peak
+    memory and the calling function."""
+    def __init__(self, verbose=False):
+        self._verbose = verbose
+
+    def log(self, message, verbose=None):
+        verbose = self._verbose if verbose is None else verbose
+        if verbose:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            # pylint: disable=protected-access
+            function_name = sys._getframe(1).f_code.co_name
+            message = "usertime(s)={0:.0f}|systime(s)={1:.0f}|"\
+                "peak_memory_used(mb)={2}|{3}|{4}". \
+                format(usage.ru_utime, usage.ru_stime, usage.ru_maxrss // 1024,
+                    function_name, message)
+        sys.stderr.write("{0}|{1}\n".format(datetime.datetime.today(), message))
+
+
+class PeakMemorySampler():
+    """Samples resident memory on a daemon thread, tracking the peak since
+    the last reset."""
+
+    def __init__(self, interval=0.5):
+        self._interval = interval
+        self._peak = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _sample(self):
+        while not self._stopped.is_set():
+            self._peak = max(self._peak, _current_rss_mb())
+            self._stopped.wait(self._interval)
+
+    def reset(self):
+        """Returns the peak since the last reset and starts a new period."""
+        (peak, self._peak) = (max(self._peak, _current_rss_mb()), 0)
+        return peak
+
+
+class Stage():
+    """Accumulated timings and record counts for one named stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.counts = {}
+        self.peak_rss_mb = 0
+
+    def count(self, name, increment=1):
+        self.counts[name] = self.counts.get(name, 0) + increment
+
+    def counted(self, iterable, name):
+        """Iterates iterable, counting items as name."""
+        count = 0
+        try:
+            for item in iterable:
+                count += 1
+                yield item
+        finally:
+            self.count(name, count)
+
+    def summary(self):
+        rates = {}
+        for (name, count) in self.counts.items():
+            if self.seconds > 0:
+                rates[name + "_per_second"] = round(count / self.seconds, 1)
+        return {"seconds": round(self.seconds, 3), "calls": self.calls,
+            "counts": dict(self.counts), "rates": rates,
+            "peak_rss_mb": self.peak_rss_mb}
+
+
+class Metrics():
+    """Per-stage timers and counters for a run (see module doc)."""
+
+    def __init__(self, name, sampler=None, clock=time.time):
+        self.name = name
+        self._sampler = sampler
+        self._clock = clock
+        self._start = clock()
+        self._stages = {}
+        self._stage_names = []
+        self._counts = {}
+
+    def _stage(self, name):
+        if name not in self._stages:
+            self._stages[name] = Stage(name)
+            self._stage_names.append(name)
+        return self._stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as stage name; yields the Stage so the
+        block can count records."""
+        stage = self._stage(name)
+        if self._sampler:
+            self._sampler.reset()
+        start = self._clock()
+        try:
+            yield stage
+        finally:
+            stage.seconds += self._clock() - start
+            stage.calls += 1
+            peak = self._sampler.reset() if self._sampler else _peak_rss_mb()
+            stage.peak_rss_mb = max(stage.peak_rss_mb, peak)
+
+    def count(self, name, increment=1):
+        self._counts[name] = self._counts.get(name, 0) + increment
+
+    def summary(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {"name": self.name,
+            "argv": sys.argv,
+            "start": datetime.datetime.fromtimestamp(self._start).isoformat(),
+            "wall_seconds": round(self._clock() - self._start, 3),
+            "user_seconds": round(usage.ru_utime, 3),
+            "system_seconds": round(usage.ru_stime, 3),
+            "peak_rss_mb": usage.ru_maxrss // 1024,
+            "counts": dict(self._counts),
+            "stages": [dict(stage=name, **self._stages[name].summary())
+                for name in self._stage_names]}
+
+    def write_json(self, file_name):
+        if self._sampler:
+            self._sampler.stop()
+        with open(file_name, "w") as metrics_file:
+            json.dump(self.summary(), metrics_file, indent=1, sort_keys=True)
+            metrics_file.write("\n")
+
+
+def metrics_for(name, environ=os.environ, at_exit=atexit.register):
+    """Returns Metrics for a run of the named script; writes them as JSON at
+    exit if RSW_METRICS_DIR is set."""
+    metrics_dir = environ.get(METRICS_DIR_ENV)
+    if not metrics_dir:
+        return Metrics(name)
+    sampler = PeakMemorySampler()
+    sampler.start()
+    metrics = Metrics(name, sampler)
+    if not os.path.isdir(metrics_dir):
+        os.makedirs(metrics_dir)
+    file_name = os.path.join(metrics_dir, "{0}.{1}.{2}.json".format(name,
+        time.strftime("%Y%m%d%H%M%S"), os.getpid()))
+    at_exit(metrics.write_json, file_name)
+    return metrics
@@ -0,0 +1,309 @@
+#! /usr/bin/env python
+
+"""
+job_server.py
+Runs identify_pairs, cluster_gaps and transcript_to_gene_symbol jobs from a
+long-lived local daemon, so that each job does not pay again for importing
+NumPy/scikit-learn and loading the transcript to gene symbol mapping.
+
+The daemon (serve) imports those scripts' modules once, loads any mapping
+files named with --gene-map= (see transcript_to_gene_symbol.parse_gene_map)
+and listens on a Unix socket. Each job submitted is run in a process forked
+from the daemon, so it starts with everything already loaded but its own
+globals, working directory, environment and exit handlers (e.g. the
+RSW_METRICS_DIR summary). At most --workers jobs run at once; further
+submissions wait in the socket backlog.
+
+The client (submit) sends the job's script arguments with its working
+directory and environment, streams the job's output (stdout and stderr,
+interleaved) back to stdout and exits with the job's exit status. It imports
+nothing heavy, so it starts as quickly as python does. The job's output and
+then its exit status come back as frames (a one byte kind and a four byte
+length, then the payload), so output may contain any bytes.
+
+Example usage:
+    ./job_server.py serve /tmp/rsw.sock --workers=8 --gene-map=mapping.txt &
+    ./job_server.py submit /tmp/rsw.sock cluster_gaps Sample_A.sam 50
+        Sample_A.07-cluster.tab Sample_A.07-cluster.bam
+"""
+import errno
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import traceback
+from instrumentation import StdErrLogger
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+JOBS = {"identify_pairs": "identify_pairs.py",
+    "cluster_gaps": "cluster_gaps.py",
+    "transcript_to_gene_symbol": "transcript_to_gene_symbol.py"}
+_DEFAULT_WORKERS = 4
+_BACKLOG = 128
+_BLOCK_SIZE = 64 * 1024
+# kind, payload length
+_FRAME_HEADER = struct.Struct(">cI")
+_OUTPUT_FRAME = b"o"
+_STATUS_FRAME = b"s"
+
+
+class JobServerError(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class ServerRunningError(JobServerError):
+    def __init__(self, socket_file_name):
+        super(ServerRunningError, self).__init__()
+        self.socket_file_name = socket_file_name
+
+    def __str__(self):
+        return repr("A job server is already listening on [{0}]". \
+            format(self.socket_file_name))
+
+class UnknownJobError(JobServerError):
+    def __init__(self, job):
+        super(UnknownJobError, self).__init__()
+        self.job = job
+
+    def __str__(self):
+        return repr("Unknown job [{0}]; expected one of: {1}". \
+            format(self.job, ", ".join(sorted(JOBS))))
+
+
+def job_script(job):
+    """Returns the script path for a job name (e.g. cluster_gaps or
+    cluster_gaps.py)."""
+    name = job[:-len(".py")] if job.endswith(".py") else job
+    if name not in JOBS:
+        raise UnknownJobError(job)
+    return os.path.join(BIN_DIR, JOBS[name])
+
+def preload(gene_map_file_names=()):
+    """Imports the job modules (and so their dependencies) and loads the
+    gene maps into this process, to be inherited by forked jobs. Returns the
+    globals each job script is run with: the registry of the loaded maps as
+    PRELOADED_GENE_MAPS (the one the imported modules also use, see
+    transcript_to_gene_symbol.parse_gene_map)."""
+    # pylint: disable=unused-variable
+    import cluster_gaps
+    import identify_pairs
+    import transcript_to_gene_symbol
+    for file_name in gene_map_file_names:
+        transcript_to_gene_symbol.parse_gene_map(file_name)
+    return {"PRELOADED_GENE_MAPS": transcript_to_gene_symbol.GENE_MAPS}
+
+def _native(value):
+    """Returns a decoded JSON string as the native str type."""
+    if sys.version_info[0] < 3:
+        return value.encode("utf-8")
+    return value
+
+def _read_request(connection):
+    reader = connection.makefile("rb")
+    try:
+        request = json.loads(reader.readline().decode("utf-8"))
+    finally:
+        reader.close()
+    return {"job": _native(request["job"]),
+        "args": [_native(arg) for arg in request["args"]],
+        "cwd": _native(request["cwd"]),
+        "environ": dict((_native(name), _native(value)) for (name, value)
+            in request["environ"].items())}
+
+def _run_job(request, init_globals=None):
+    """Runs the requested script as __main__ in this process (with
+    init_globals, see preload); returns its exit status."""
+    import atexit
+    import runpy
+    try:
+        try:
+            script = job_script(request["job"])
+            os.environ.clear()
+            os.environ.update(request["environ"])
+            os.chdir(request["cwd"])
+            sys.argv = [script] + request["args"]
+            runpy.run_path(script, init_globals, run_name="__main__")
+            status = 0
+        except SystemExit as error:
+            if error.code is None or isinstance(error.code, int):
+                status = error.code or 0
+            else:
+                sys.stderr.write("{0}\n".format(error.code))
+                status = 1
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc()
+            status = 1
+        # pylint: disable=protected-access
+        atexit._run_exitfuncs()
+    except Exception: # pylint: disable=broad-except
+        traceback.print_exc()
+        status = 1
+    return status
+
+def _send_frame(connection, kind, payload):
+    connection.sendall(_FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+def _exit_status(wait_status):
+    if os.WIFSIGNALED(wait_status):
+        return 128 + os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+def _fork_job(listener, connection, init_globals):
+    """Forks a process which runs the job on connection in a process of its
+    own (with stdout and stderr on a pipe), relaying the job's output and
+    then its exit status to the connection as frames."""
+    pid = os.fork()
+    if pid:
+        connection.close()
+        return pid
+    status = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        listener.close()
+        request = _read_request(connection)
+        (read_fd, write_fd) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        job_pid = os.fork()
+        if not job_pid:
+            job_status = 1
+            try:
+                os.close(read_fd)
+                connection.close()
+                os.dup2(write_fd, 1)
+                os.dup2(write_fd, 2)
+                os.close(write_fd)
+                job_status = _run_job(request, init_globals)
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(job_status) # pylint: disable=protected-access
+        os.close(write_fd)
+        for block in iter(lambda: os.read(read_fd, _BLOCK_SIZE), b""):
+            _send_frame(connection, _OUTPUT_FRAME, block)
+        status = _exit_status(os.waitpid(job_pid, 0)[1])
+        _send_frame(connection, _STATUS_FRAME, str(status).encode("ascii"))
+    finally:
+        os._exit(status) # pylint: disable=protected-access
+
+def _listen(socket_file_name):
+    if os.path.exists(socket_file_name):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_file_name)
+            raise ServerRunningError(socket_file_name)
+        except socket.error:
+            os.remove(socket_file_name)
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_file_name)
+    listener.listen(_BACKLOG)
+    return listener
+
+def _reap(children, block):
+    while children:
+        try:
+            (pid, _) = os.waitpid(-1, 0 if block else os.WNOHANG)
+        except OSError as error:
+            if error.errno == errno.EINTR:
+                continue
+            if error.errno == errno.ECHILD:
+                children.clear()
+                return
+            raise
+        if not pid:
+            return
+        children.discard(pid)
+        if block:
+            return
+
+def serve(socket_file_name, workers=_DEFAULT_WORKERS, gene_map_file_names=(),
+        logger=None):
+    """Preloads the job modules and runs jobs submitted to the socket until
+    terminated (SIGTERM or SIGINT)."""
+    init_globals = preload(gene_map_file_names)
+    listener = _listen(socket_file_name)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if logger:
+        logger.log("listening on [{0}] with {1} workers".format(
+            socket_file_name, workers))
+    children = set()
+    try:
+        while True:
+            try:
+                (connection, _) = listener.accept()
+            except socket.error as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            _reap(children, False)
+            while len(children) >= workers:
+                _reap(children, True)
+            children.add(_fork_job(listener, connection, init_globals))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.remove(socket_file_name)
+        _reap(children, False)
+        if logger:
+            logger.log("stopped; {0} jobs still running".format(
+                len(children)))
+
+def submit(socket_file_name, job, args, writer, cwd=None, environ=None):
+    """Runs job with args on the server, writing its output to writer as it
+    arrives; returns the job's exit status."""
+    job_script(job)
+    request = {"job": job, "args": list(args),
+        "cwd": cwd or os.getcwd(),
+        "environ": dict(os.environ if environ is None else environ)}
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_file_name)
+        connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        reader = connection.makefile("rb")
+        try:
+            while True:
+                header = reader.read(_FRAME_HEADER.size)
+                if len(header) < _FRAME_HEADER.size:
+                    return 1
+                (kind, length) = _FRAME_HEADER.unpack(header)
+                payload = reader.read(length)
+                if kind == _STATUS_FRAME:
+                    return int(payload.decode("ascii"))
+                writer.write(payload)
+                writer.flush()
+        finally:
+            reader.close()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    BASENAME = os.path.basename(sys.argv[0])
+    WORKERS_FLAG = "--workers="
+    GENE_MAP_FLAG = "--gene-map="
+    if len(sys.argv) >= 3 and sys.argv[1] == "serve":
+        WORKERS = _DEFAULT_WORKERS
+        GENE_MAP_FILE_NAMES = []
+        for ARG in sys.argv[3:]:
+            if ARG.startswith(WORKERS_FLAG):
+                WORKERS = int(ARG[len(WORKERS_FLAG):])
+            elif ARG.startswith(GENE_MAP_FLAG):
+                GENE_MAP_FILE_NAMES.append(
+                    os.path.abspath(ARG[len(GENE_MAP_FLAG):]))
+        serve(os.path.abspath(sys.argv[2]), WORKERS, GENE_MAP_FILE_NAMES,
+            StdErrLogger())
+        sys.exit()
+
+    if len(sys.argv) >= 4 and sys.argv[1] == "submit":
+        WRITER = getattr(sys.stdout, "buffer", sys.stdout)
+        sys.exit(submit(sys.argv[2], sys.argv[3], sys.argv[4:], WRITER))
+
+    # pylint: disable=line-too-long
+    print ("usage: {0} serve [socket_file] [{1}N (default {2})] [{3}mapping datafile ...]".format(BASENAME, WORKERS_FLAG, _DEFAULT_WORKERS, GENE_MAP_FLAG))
+    print ("   or: {0} submit [socket_file] [{1}] [script args ...]".format(BASENAME, " | ".join(sorted(JOBS))))
+    sys.exit()
@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+
+"""
+merge_sam.py
+Merges N SAM files into one, replacing the cp/grep merge in 06-postprocess.sh.
+
+The merged header is the union of the input headers: the first @HD line,
+then @SQ, @RG and any other header lines (e.g. @CO) in first-seen order with
+exact duplicates removed. @PG lines are dropped because program ids from
+different inputs would collide. Alignment records are streamed either
+concatenated in input order or, with --sorted, as a k-way merge (using a heap)
+of coordinate-sorted inputs, ordered by @SQ order and then position. Runs of
+spaces in records are converted to tabs (identify_pairs output written before
+its optional fields were tab-separated joined them with spaces).
+
+Each input is read on its own thread into a bounded queue of line blocks so
+that file reads overlap with merging. merged_lines() exposes the same merge as
+a line iterator so consumers (e.g. cluster_gaps.py) can read several inputs
+as one virtual file without writing the merged file. Inputs may be BAM files
+(see bam.py); the merged output is SAM.
+
+Example usage: ./merge_sam.py [--sorted] merged.sam sampleA.sam sampleB.sam
+"""
+import heapq
+import os
+import re
+import sys
+import threading
+from bam import BamError, BamReader, is_bam
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class MergeSamError(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class UnsortedInputError(MergeSamError):
+    def __init__(self, file_name, line):
+        super(UnsortedInputError, self).__init__()
+        self.file_name = file_name
+        self.line = line
+
+    def __str__(self):
+        return repr("Input [{0}] is not coordinate sorted at: '{1}'". \
+            format(self.file_name, self.line))
+
+
+class PrefetchingReader():
+    """Iterates the lines of a file while a background thread reads ahead
+    in blocks of lines. BAM files are read as SAM lines (see bam.BamReader);
+    sequences=False skips decoding their SEQ and QUAL."""
+
+    _BLOCK_SIZE_HINT = 4 * 1024 * 1024
+    _QUEUE_BLOCKS = 4
+    _END = None
+
+    def __init__(self, file_name, sequences=True):
+        self.file_name = file_name
+        self._sequences = sequences
+        self._blocks = queue.Queue(maxsize=self._QUEUE_BLOCKS)
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        try:
+            if is_bam(self.file_name):
+                for lines in BamReader(self.file_name). \
+                        line_blocks(self._sequences):
+                    self._blocks.put(lines)
+            else:
+                with open(self.file_name, "r") as reader:
+                    while True:
+                        lines = reader.readlines(self._BLOCK_SIZE_HINT)
+                        if not lines:
+                            break
+                        self._blocks.put(lines)
+        except (IOError, OSError, BamError) as error:
+            self._blocks.put(error)
+        self._blocks.put(self._END)
+
+    def __iter__(self):
+        while True:
+            block = self._blocks.get()
+            if block is self._END:
+                return
+            if isinstance(block, Exception):
+                raise block
+            for line in block:
+                yield line
+
+
+def _split_header(lines):
+    """Returns (header_lines, record_iterator) for an iterator of lines."""
+    lines = iter(lines)
+    header_lines = []
+    for line in lines:
+        if not line.startswith("@"):
+            return (header_lines, _chain([line], lines))
+        header_lines.append(line)
+    return (header_lines, iter([]))
+
+def _chain(first, rest):
+    for line in first:
+        yield line
+    for line in rest:
+        yield line
+
+def merge_headers(header_line_lists):
+    """Returns the union of several SAM headers (see module doc)."""
+    hd_lines = []
+    sq_lines = []
+    rg_lines = []
+    other_lines = []
+    seen = set()
+    for header_lines in header_line_lists:
+        for line in header_lines:
+            if not line.endswith("\n"):
+                line += "\n"
+            if line in seen or line.startswith("@PG"):
+                continue
+            seen.add(line)
+            if line.startswith("@HD"):
+                hd_lines.append(line)
+            elif line.startswith("@SQ"):
+                sq_lines.append(line)
+            elif line.startswith("@RG"):
+                rg_lines.append(line)
+            else:
+                other_lines.append(line)
+    return hd_lines[:1] + sq_lines + rg_lines + other_lines
+
+_SPACES_RE = re.compile(" +")
+
+def _normalized(records):
+    for line in records:
+        if " " in line:
+            line = _SPACES_RE.sub("\t", line)
+        yield line
+
+def _reference_order(header_lines):
+    order = {}
+    for line in header_lines:
+        if line.startswith("@SQ"):
+            for field in line.rstrip("\r\n").split("\t")[1:]:
+                if field.startswith("SN:"):
+                    order.setdefault(field[3:], len(order))
+    return order
+
+def _coordinate_keyed(records, input_index, reference_order, file_name):
+    """Yields ((reference_index, reference, position), input_index, line).
+    References missing from @SQ sort after known references (by name), and
+    unmapped records (reference '*') sort last."""
+    unknown_index = len(reference_order)
+    previous_key = (-1, "", -1)
+    for line in records:
+        fields = line.split("\t", 4)
+        reference = fields[2]
+        if reference == "*":
+            key = (unknown_index + 1, "", 0)
+        elif reference in reference_order:
+            key = (reference_order[reference], "", int(fields[3]))
+        else:
+            key = (unknown_index, reference, int(fields[3]))
+        if key < previous_key:
+            raise UnsortedInputError(file_name, line)
+        previous_key = key
+        yield (key, input_index, line)
+
+def merged_lines(file_names, coordinate_sorted=False, sequences=True,
+        on_input=None):
+    """Yields the merged header followed by the merged records of the
+    specified SAM (or BAM) files. Unless coordinate_sorted, on_input (if
+    specified) is called with the index of each input before its records are
+    yielded."""
+    readers = [PrefetchingReader(file_name, sequences)
+        for file_name in file_names]
+    headers_and_records = [_split_header(reader) for reader in readers]
+    header_lines = merge_headers([header for (header, _)
+        in headers_and_records])
+    for line in header_lines:
+        yield line
+
+    if not coordinate_sorted:
+        for (index, (_, records)) in enumerate(headers_and_records):
+            if on_input:
+                on_input(index)
+            for line in _normalized(records):
+                yield line
+        return
+
+    reference_order = _reference_order(header_lines)
+    keyed_inputs = [_coordinate_keyed(_normalized(records), index,
+            reference_order, reader.file_name)
+        for (index, ((_, records), reader)) in
+            enumerate(zip(headers_and_records, readers))]
+    for (_, _, line) in heapq.merge(*keyed_inputs):
+        yield line
+
+def merge(file_names, writer, coordinate_sorted=False):
+    count = 0
+    for line in merged_lines(file_names, coordinate_sorted):
+        if not line.startswith("@"):
+            count += 1
+        writer.write(line)
+    return count
+
+
+if __name__ == "__main__":
+    SORTED_FLAG = "--sorted"
+    ARGS = [arg for arg in sys.argv[1:] if arg != SORTED_FLAG]
+    if (len(ARGS) < 2):
+        # pylint: disable=line-too-long
+        print ("usage: {0} [{1} (k-way merge of coordinate sorted inputs)] [output_sam_file] [input_sam_file ...]".format(os.path.basename(sys.argv[0]), SORTED_FLAG))
+        sys.exit()
+
+    OUTPUT_FILE_NAME = ARGS[0]
+    INPUT_FILE_NAMES = ARGS[1:]
+    for INPUT_FILE_NAME in INPUT_FILE_NAMES:
+        if not os.path.isfile(INPUT_FILE_NAME):
+            raise ValueError("infile [{0}] does not exist".format(INPUT_FILE_NAME))
+
+    with open(OUTPUT_FILE_NAME, "w") as OUTPUT_FILE:
+        COUNT = merge(INPUT_FILE_NAMES, OUTPUT_FILE, SORTED_FLAG in sys.argv[1:])
+    print ("merged {0} alignments from {1} files".format(COUNT, len(INPUT_FILE_NAMES)))
+    print ("done.")
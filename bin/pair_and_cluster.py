@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+
+"""
+pair_and_cluster.py
+Runs identify_pairs, read group tagging, merging and cluster_gaps in a single
+process, from the split alignment SAM of each sample read to clustered gaps.
+
+Pairs are identified for each input as identify_pairs does (two passes over
+the input). A third pass appends the gap of each pair straight from its
+SplitReads to a GapTable and spools the paired alignments (tagged with the
+sample read group) to an unnamed temporary file beside the output SAM, so
+memory does not grow with the cohort and the intermediate pair SAM, the
+read-grouped SAM and the merged SAM are never written or re-parsed. Gaps are appended in the
+order cluster_gaps would read them from the merged SAM, so results (including
+cluster numbers) match the multi-step pipeline. The gaps for all inputs are
+clustered together; the gap and group files and a single cluster-tagged SAM
+are then written as by cluster_gaps. The .rsw pairs for each input are written
+alongside the input ([input base].rsw).
+
+Example usage: ./pair_and_cluster.py 100 2 39999 all_samples.07-cluster.tab
+    all_samples.07-cluster.sam
+    Sample_A=Sample_A_R1.04-bowtie_align_splits_to_transcriptome.sam
+    Sample_A=Sample_A_R2.04-bowtie_align_splits_to_transcriptome.sam
+"""
+from contextlib import nested
+import datetime
+from itertools import chain
+import os
+import sys
+import tempfile
+from bam import open_alignments
+from cluster_gaps import GapTableBuilder, GapUtility, group_file_names
+from cluster_utility import DbscanClusterUtility
+from identify_pairs import PairIndex, SamSplitReadBuilder, identify_read_group_pairs, \
+    write_rsw_file
+from instrumentation import StdErrLogger, metrics_for
+from merge_sam import merge_headers
+from transcript_to_gene_symbol import parse_gene_map
+
+
+class _CountingWriter():
+    """Writes lines written by SplitRead.write_sam_pairs to writer, counting
+    them."""
+    def __init__(self, writer):
+        self._writer = writer
+        self.count = 0
+
+    def write(self, line):
+        self._writer.write(line)
+        self.count += 1
+
+
+def rsw_file_name(input_file_name):
+    return "{0}.rsw".format(os.path.splitext(input_file_name)[0])
+
+def read_group_line(sample, delimiter="\t"):
+    return "@RG{0}ID:{1}{0}SM:{1}\n".format(delimiter, sample)
+
+def header_lines(file_name):
+    lines = []
+    with open_alignments(file_name, sequences=False) as reader:
+        for line in reader:
+            if not line.startswith("@"):
+                break
+            lines.append(line)
+    return lines
+
+def pair_alignments(sample, input_file_name, read_group_pairs,
+        original_read_len, gap_builder, writer, delimiter="\t"):
+    """Appends the gap of each pair to gap_builder and writes the paired
+    alignments tagged with RG:Z:sample to writer, as identify_pairs followed
+    by merge_sam would write them; returns the number of alignments."""
+    builder = SamSplitReadBuilder(original_read_len, delimiter)
+    read_group_tag = "RG:Z:{0}".format(sample)
+    counting_writer = _CountingWriter(writer)
+    pair_index = PairIndex(read_group_pairs)
+    with open_alignments(input_file_name) as reader:
+        for line in reader:
+            if builder.is_header(line):
+                continue
+            split_read = builder.build(line)
+            split_read.write_sam_pairs(pair_index, line, counting_writer,
+                delimiter, read_group_tag)
+            for fields in split_read.leftmost_gap_fields(pair_index):
+                gap_builder.append(sample, *fields)
+    return counting_writer.count
+
+def main(inputs, original_read_len, min_dist, max_dist, gap_file_name,
+        output_sam_file_name, gene_map_file_name=None):
+    """inputs is a list of (sample, split_alignment_sam_file_name)."""
+    logger = StdErrLogger(verbose=True)
+    logger.log(" ".join(sys.argv), verbose=False)
+    comment_lines = [str(datetime.datetime.today()), " ".join(sys.argv)]
+    gene_map = None
+    if gene_map_file_name:
+        logger.log("loading gene symbol mapping")
+        gene_map = parse_gene_map(gene_map_file_name)
+    delimiter = "\t"
+    gap_utility = GapUtility(original_read_len, delimiter, logger, gene_map)
+    metrics = metrics_for("pair_and_cluster")
+
+    samples = []
+    for (sample, _) in inputs:
+        if sample not in samples:
+            samples.append(sample)
+    read_group_lines = [read_group_line(sample, delimiter)
+        for sample in samples]
+    for line in read_group_lines:
+        gap_utility.process_sam_header_line(line)
+    sam_header_lines = merge_headers([header_lines(input_file_name)
+        for (_, input_file_name) in inputs] + [read_group_lines])
+
+    # paired alignments are spooled to disk until the clusters are known
+    with tempfile.TemporaryFile(dir=os.path.dirname(output_sam_file_name)) \
+            as alignment_file:
+        gap_builder = GapTableBuilder()
+        for (sample, input_file_name) in inputs:
+            logger.log("identifying pairs in {0}".format(input_file_name))
+            read_group_pairs = identify_read_group_pairs(original_read_len,
+                input_file_name, min_dist, max_dist, logger, metrics)
+            write_rsw_file(read_group_pairs, rsw_file_name(input_file_name),
+                logger, metrics)
+            logger.log("building gaps from {0}".format(input_file_name))
+            with metrics.stage("pair_alignments") as stage:
+                stage.count("alignments", pair_alignments(sample,
+                    input_file_name, read_group_pairs, original_read_len,
+                    gap_builder, alignment_file, delimiter))
+            del read_group_pairs
+
+        gaps = gap_builder.build()
+        del gap_builder
+        logger.log("sorting {0} gaps".format(len(gaps)))
+        with metrics.stage("sort_gaps"):
+            gaps = GapUtility.sort_gaps(gaps)
+
+        logger.log("clustering gaps")
+        with metrics.stage("cluster_gaps") as stage:
+            cluster_utility = DbscanClusterUtility(logger=logger, deduplication_threshold=1000)
+            cluster_utility.assign_table_clusters(gaps)
+            stage.count("gaps", len(gaps))
+
+        logger.log("writing {0} gaps to file".format(len(gaps)))
+        (sample_group_file_name, cluster_group_file_name) = \
+            group_file_names(gap_file_name)
+        with metrics.stage("write_gaps"), \
+                nested(open(gap_file_name, "w"),
+                open(sample_group_file_name, "w"),
+                open(cluster_group_file_name, "w")) \
+                as (gap_file, sample_group_file, cluster_group_file):
+            gap_utility.write_gap_file(gaps, gap_file, comment_lines)
+            gap_utility.write_group_file(gaps, sample_group_file,
+                by_sample=True)
+            gap_utility.write_group_file(gaps, cluster_group_file,
+                by_sample=False)
+
+        logger.log("writing sam file with clusters")
+        alignment_file.seek(0)
+        with metrics.stage("write_sam"), \
+                open(output_sam_file_name, "w") as output_sam_file:
+            gap_utility.write_sam_file(chain(sam_header_lines, alignment_file),
+                gaps, output_sam_file, comment_lines)
+
+    logger.log("{0} complete".format(gap_file_name))
+
+if __name__ == "__main__":
+    BASENAME = os.path.basename(sys.argv[0])
+    GENE_MAP_FLAG = "--gene-map="
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith(GENE_MAP_FLAG)]
+    if (len(ARGS) < 6 or not all("=" in arg for arg in ARGS[5:])):
+        # pylint: disable=line-too-long
+        print ("usage: {0} [original_read_len] [min_distance] [max_distance] [gap_file] [output_sam_file] [sample=split_alignment_sam_file ...] [{1}mapping datafile (append gene_symbol column)]".format(BASENAME, GENE_MAP_FLAG))
+        sys.exit()
+
+    (ORIGINAL_READ_LEN, MIN_DISTANCE, MAX_DISTANCE) = [int(ARG) for ARG in ARGS[0:3]]
+    if MAX_DISTANCE <= MIN_DISTANCE:
+        raise ValueError("max distance must be greater than min distance")
+    GAP_FILE_NAME = os.path.abspath(ARGS[3])
+    OUTPUT_SAM_FILE_NAME = os.path.abspath(ARGS[4])
+    INPUTS = []
+    for ARG in ARGS[5:]:
+        (SAMPLE, INPUT_FILE_NAME) = ARG.split("=", 1)
+        if not os.path.isfile(INPUT_FILE_NAME):
+            raise ValueError("infile [{0}] does not exist".format(INPUT_FILE_NAME))
+        INPUTS.append((SAMPLE, os.path.abspath(INPUT_FILE_NAME)))
+    GENE_MAP_FILE_NAME = None
+    for ARG in sys.argv[1:]:
+        if ARG.startswith(GENE_MAP_FLAG):
+            GENE_MAP_FILE_NAME = os.path.abspath(ARG[len(GENE_MAP_FLAG):])
+
+    main(INPUTS, ORIGINAL_READ_LEN, MIN_DISTANCE, MAX_DISTANCE, GAP_FILE_NAME, OUTPUT_SAM_FILE_NAME, GENE_MAP_FILE_NAME)
+    print ("{0} done.".format(BASENAME))
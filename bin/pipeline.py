@@ -0,0 +1,392 @@
+#! /usr/bin/env python
+
+"""
+pipeline.py
+Runs the readsplitwalk stages (01-bowtie-transcriptome through 08-genes) for
+many samples from one driver.
+
+Each stage of each sample read is a Task with explicit input and output files;
+a task depends on whichever tasks produce its inputs, so the stages form a
+DAG. A task is skipped when all of its outputs exist and are newer than all of
+its inputs (and no upstream task ran). Ready tasks are started concurrently as
+long as the sum of their declared processors and memory fits within a global
+budget, so many samples progress at once without oversubscribing the host. A
+task that fails prevents its dependents from running; unrelated tasks carry
+on. Each task's output is written to logs/[task name].log.
+
+The bowtie executable can be replaced (e.g. with a stub in tests) via
+--bowtie=[command]. --collapse-duplicates collapses identical reads before
+splitting (see split_read.py); cluster_gaps weights the collapsed reads by
+their duplicate counts. --filter-reads drops low complexity, poly-A, N-rich
+and low quality reads before splitting (with per-filter counts in
+[read].03-split_reads.filter_stats.tab).
+
+Example usage: ./pipeline.py 100 4 --cpus=16 --memory=64000
+    Sample_21798 Sample_21799
+"""
+import glob
+import multiprocessing
+import os
+import shlex
+import subprocess
+import sys
+import time
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+from instrumentation import StdErrLogger
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+TRANSCRIPTOME_INDEX = "/ccmb/BioinfCore/SoftwareDev/bowtie1/mm_GRCm38_cDNA/mm_GRCm38_cDNA"
+GENOME_INDEX = "/ccmb/CoreBA/BioinfCore/Common/DATA/BowtieData/mm9/bowtie1/mm9"
+TRANSCRIPT_MAPPING_FILE = os.path.join(BIN_DIR, "..", "reference_data",
+    "ensembl_GRCm38-p1_cDNA_gene_mapping.txt")
+MIN_DISTANCE = 2
+MAX_DISTANCE = 39999
+ALL_SAMPLES_PREFIX = "all_samples_merged"
+
+# rough per-task resident memory (Mb); bowtie holds the reference index
+_BOWTIE_MEMORY = 4000
+_SCRIPT_MEMORY = 1000
+_IDENTIFY_PAIRS_MEMORY = 16000
+_CLUSTER_MEMORY = 16000
+
+
+class PipelineError(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class DuplicateOutputError(PipelineError):
+    def __init__(self, output_file_name):
+        super(DuplicateOutputError, self).__init__()
+        self.output_file_name = output_file_name
+
+    def __str__(self):
+        return repr("More than one task produces output: '{0}'". \
+            format(self.output_file_name))
+
+class CyclicDependencyError(PipelineError):
+    def __init__(self, task_names):
+        super(CyclicDependencyError, self).__init__()
+        self.task_names = task_names
+
+    def __str__(self):
+        return repr("Tasks have cyclic dependencies: '{0}'". \
+            format(", ".join(self.task_names)))
+
+
+class Task():
+    """One or more commands (each a list of arguments) run in sequence which
+    read the input files and write the output files."""
+
+    def __init__(self, name, commands, inputs, outputs, processors=1,
+            memory=_SCRIPT_MEMORY):
+        self.name = name
+        self.commands = commands
+        self.inputs = inputs
+        self.outputs = outputs
+        self.processors = processors
+        self.memory = memory
+
+    def is_up_to_date(self, working_dir):
+        """True if every output exists and none is older than any input."""
+        output_times = []
+        for output in self.outputs:
+            path = os.path.join(working_dir, output)
+            if not os.path.exists(path):
+                return False
+            output_times.append(os.path.getmtime(path))
+        input_times = [os.path.getmtime(os.path.join(working_dir, input_name))
+            for input_name in self.inputs
+            if os.path.exists(os.path.join(working_dir, input_name))]
+        return not input_times or min(output_times) >= max(input_times)
+
+
+class Pipeline():
+    """A DAG of Tasks run under a processor and memory (Mb) budget."""
+
+    _POLL_INTERVAL = 0.5
+
+    def __init__(self, tasks, processors, memory, working_dir=".",
+            logger=StdErrLogger()):
+        self._tasks = tasks
+        self._processors = processors
+        self._memory = memory
+        self._working_dir = working_dir
+        self._logger = logger
+        self._dependencies = self._build_dependencies(tasks)
+        self._order = self._topological_order()
+
+    @staticmethod
+    def _build_dependencies(tasks):
+        producers = {}
+        for task in tasks:
+            for output in task.outputs:
+                if output in producers:
+                    raise DuplicateOutputError(output)
+                producers[output] = task.name
+        dependencies = {}
+        for task in tasks:
+            dependencies[task.name] = sorted(set(
+                [producers[input_name] for input_name in task.inputs
+                    if input_name in producers]))
+        return dependencies
+
+    def _topological_order(self):
+        order = []
+        placed = set()
+        remaining = [task.name for task in self._tasks]
+        while remaining:
+            ready = [name for name in remaining
+                if all(dep in placed for dep in self._dependencies[name])]
+            if not ready:
+                raise CyclicDependencyError(remaining)
+            order.extend(ready)
+            placed.update(ready)
+            remaining = [name for name in remaining if name not in placed]
+        return order
+
+    def dependencies(self, task_name):
+        return self._dependencies[task_name]
+
+    def order(self):
+        return list(self._order)
+
+    def stale_tasks(self):
+        """Returns the names (in run order) of tasks which would run: those
+        which are out of date or downstream of a task which would run."""
+        tasks = dict([(task.name, task) for task in self._tasks])
+        stale = []
+        for name in self._order:
+            if any(dep in stale for dep in self._dependencies[name]) or \
+                    not tasks[name].is_up_to_date(self._working_dir):
+                stale.append(name)
+        return stale
+
+    def _requirements(self, task):
+        return (min(task.processors, self._processors),
+            min(task.memory, self._memory))
+
+    def _start(self, task):
+        log_dir = os.path.join(self._working_dir, "logs")
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        log_file = open(os.path.join(log_dir, task.name + ".log"), "w")
+        script = " && ".join([" ".join([quote(arg) for arg in command])
+            for command in task.commands])
+        self._logger.log("starting {0}".format(task.name))
+        return (subprocess.Popen(script, shell=True, cwd=self._working_dir,
+            stdout=log_file, stderr=subprocess.STDOUT), log_file)
+
+    def run(self):
+        """Runs stale tasks (see stale_tasks) respecting dependencies and the
+        budget. Returns (completed, skipped, failed) lists of task names;
+        tasks downstream of a failure are neither run nor reported."""
+        tasks = dict([(task.name, task) for task in self._tasks])
+        stale = set(self.stale_tasks())
+        skipped = [name for name in self._order if name not in stale]
+        done = set(skipped)
+        completed = []
+        failed = []
+        blocked = set()
+        pending = [name for name in self._order if name in stale]
+        running = {}
+        (free_processors, free_memory) = (self._processors, self._memory)
+        while pending or running:
+            for name in list(pending):
+                dependencies = self._dependencies[name]
+                if any(dep in failed or dep in blocked for dep in dependencies):
+                    pending.remove(name)
+                    blocked.add(name)
+                    continue
+                if not all(dep in done for dep in dependencies):
+                    continue
+                (processors, memory) = self._requirements(tasks[name])
+                if processors > free_processors or memory > free_memory:
+                    continue
+                pending.remove(name)
+                running[name] = self._start(tasks[name])
+                free_processors -= processors
+                free_memory -= memory
+            if not running:
+                break
+            time.sleep(self._POLL_INTERVAL)
+            for name in list(running):
+                (process, log_file) = running[name]
+                if process.poll() is None:
+                    continue
+                log_file.close()
+                del running[name]
+                (processors, memory) = self._requirements(tasks[name])
+                free_processors += processors
+                free_memory += memory
+                if process.returncode == 0:
+                    self._logger.log("finished {0}".format(name))
+                    done.add(name)
+                    completed.append(name)
+                else:
+                    self._logger.log("{0} failed ({1}); see logs/{0}.log". \
+                        format(name, process.returncode))
+                    failed.append(name)
+        return (completed, skipped, failed)
+
+
+def _script(name):
+    return [sys.executable, os.path.join(BIN_DIR, name)]
+
+def _sort_by_cluster(gap_file_name, sorted_file_name):
+    """Returns a command writing the gap file in chromosome/cluster/sample
+    order, its # header lines first."""
+    return ["sh", "-c", "(grep '^#' {0}; grep -v '^#' {0} | "
+        "LC_ALL=C sort -k1,1 -k2,2n -k3,3) > {1}".format(
+            quote(gap_file_name), quote(sorted_file_name))]
+
+def read_tasks(read_name, split_margin, bowtie_command, bowtie_processors,
+        collapse_duplicates=False, filter_reads=False):
+    """Returns the per-read tasks (01 to 04) for [read_name].fastq."""
+    stage = lambda name: "{0}.{1}".format(read_name, name)
+    bowtie_args = bowtie_command + ["-t", "-k", "11", "-m", "10", "--best",
+        "-p", str(bowtie_processors)]
+    split_options = (["--collapse-duplicates"] if collapse_duplicates else []) \
+        + (["--filter"] if filter_reads else [])
+    split_outputs = [stage("03-split_reads.fastq")] + \
+        ([stage("03-split_reads.filter_stats.tab")] if filter_reads else [])
+    return [
+        Task(stage("01-bowtie-transcriptome"),
+            [bowtie_args + ["-v", "2", "--sam", TRANSCRIPTOME_INDEX,
+                "-q", read_name + ".fastq",
+                "--un", stage("01-bowtie-transcriptome.fastq"),
+                stage("01-bowtie-transcriptome.tmp.sam")]],
+            [read_name + ".fastq"], [stage("01-bowtie-transcriptome.fastq")],
+            bowtie_processors, _BOWTIE_MEMORY),
+        Task(stage("02-bowtie-genome"),
+            [bowtie_args + ["-v", "2", GENOME_INDEX,
+                "-q", stage("01-bowtie-transcriptome.fastq"),
+                "--un", stage("02-bowtie-genome.fastq"),
+                stage("02-bowtie-genome.tmp.bowtie")]],
+            [stage("01-bowtie-transcriptome.fastq")],
+            [stage("02-bowtie-genome.fastq")],
+            bowtie_processors, _BOWTIE_MEMORY),
+        Task(stage("03-split_reads"),
+            [_script("split_read.py") + [stage("02-bowtie-genome.fastq"),
+                stage("03-split_reads.fastq"), str(split_margin)] +
+                split_options],
+            [stage("02-bowtie-genome.fastq")], split_outputs),
+        Task(stage("04-bowtie_align_splits_to_transcriptome"),
+            [bowtie_args + ["-v", "1", "--sam", TRANSCRIPTOME_INDEX,
+                "-q", stage("03-split_reads.fastq"),
+                stage("04-bowtie_align_splits_to_transcriptome.sam")]],
+            [stage("03-split_reads.fastq")],
+            [stage("04-bowtie_align_splits_to_transcriptome.sam")],
+            bowtie_processors, _BOWTIE_MEMORY)]
+
+def pair_tasks(sample_name, read_len):
+    """Returns the per-sample identify_pairs task (05), which pairs the R1
+    and R2 split alignments in one run."""
+    stage = lambda name: "{0}.{1}".format(sample_name, name)
+    mate_sams = ["{0}_{1}.04-bowtie_align_splits_to_transcriptome.sam".
+        format(sample_name, read) for read in ["R1", "R2"]]
+    return [
+        Task(stage("05-identify_pairs_transcriptome"),
+            [_script("identify_pairs.py") + [
+                ",".join("{0}={1}".format(read, mate_sam) for (read, mate_sam)
+                    in zip(["R1", "R2"], mate_sams)),
+                stage("05-identify_pairs_transcriptome.rsw"), str(read_len),
+                str(MIN_DISTANCE), str(MAX_DISTANCE), sample_name,
+                sample_name]],
+            mate_sams,
+            [stage("05-identify_pairs_transcriptome.rsw"),
+                stage("05-identify_pairs_transcriptome.sam")],
+            1, _IDENTIFY_PAIRS_MEMORY)]
+
+def cohort_tasks(pair_sam_file_names, read_len):
+    """Returns the cohort tasks (06 to 08) over all identify_pairs output."""
+    stage = lambda name: "{0}.{1}".format(ALL_SAMPLES_PREFIX, name)
+    # 08-genes annotates the gap file in chromosome/cluster/sample order
+    cluster_tabs = [stage("07-cluster.sorted.tab"),
+        stage("07-cluster.sample-groups.tab"),
+        stage("07-cluster.cluster-groups.tab")]
+    cluster_outputs = [stage("07-cluster.tab")] + cluster_tabs + \
+        [stage("07-cluster.sorted.bam"), stage("07-cluster.sorted.bam.bai")]
+    gene_outputs = [stage("08-genes.tab"), stage("08-genes.sample-groups.tab"),
+        stage("08-genes.cluster-groups.tab")]
+    return [
+        Task(stage("06-postprocess"),
+            [_script("merge_sam.py") + [stage("06-postprocess.sam")] +
+                pair_sam_file_names],
+            pair_sam_file_names, [stage("06-postprocess.sam")]),
+        Task(stage("07-cluster"),
+            [_script("cluster_gaps.py") + [stage("06-postprocess.sam"),
+                str(read_len), stage("07-cluster.tab"),
+                stage("07-cluster.sorted.bam"),
+                "--gene-map=" + TRANSCRIPT_MAPPING_FILE, "--sort-output"],
+                _sort_by_cluster(stage("07-cluster.tab"),
+                    stage("07-cluster.sorted.tab"))],
+            [stage("06-postprocess.sam")], cluster_outputs, 1, _CLUSTER_MEMORY),
+        Task(stage("08-genes"),
+            # cluster_gaps already appended gene symbols; link, don't rewrite
+            [["ln", "-f", cluster_tab, gene_output] for
+                (cluster_tab, gene_output) in zip(cluster_tabs, gene_outputs)],
+            cluster_tabs, gene_outputs)]
+
+def build_tasks(sample_names, read_len, split_margin, bowtie_command=None,
+        bowtie_processors=2, collapse_duplicates=False, filter_reads=False):
+    """Returns all tasks for samples with [sample]_R1.fastq and
+    [sample]_R2.fastq inputs. R1 and R2 are paired in one identify_pairs run
+    per sample, which tags alignments with the sample as read group."""
+    bowtie_command = bowtie_command or ["bowtie"]
+    tasks = []
+    pair_sam_file_names = []
+    for sample_name in sample_names:
+        for read in ["R1", "R2"]:
+            read_name = "{0}_{1}".format(sample_name, read)
+            tasks.extend(read_tasks(read_name, split_margin, bowtie_command,
+                bowtie_processors, collapse_duplicates, filter_reads))
+        tasks.extend(pair_tasks(sample_name, read_len))
+        pair_sam_file_names.append(
+            sample_name + ".05-identify_pairs_transcriptome.sam")
+    tasks.extend(cohort_tasks(pair_sam_file_names, read_len))
+    return tasks
+
+def _physical_memory():
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") \
+            // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return _CLUSTER_MEMORY
+
+
+if __name__ == "__main__":
+    BASENAME = os.path.basename(sys.argv[0])
+    OPTIONS = dict([arg[2:].split("=", 1) if "=" in arg else (arg[2:], "")
+        for arg in sys.argv[1:] if arg.startswith("--")])
+    ARGS = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if (len(ARGS) < 2):
+        # pylint: disable=line-too-long
+        print ("usage: {0} [read_len] [split_margin] [sample_name ... (default all Sample_*_R1.fastq)] [--cpus=N] [--memory=Mb] [--bowtie_processors=N] [--bowtie=command] [--collapse-duplicates] [--filter-reads] [--dry-run]".format(BASENAME))
+        sys.exit()
+
+    (READ_LEN, SPLIT_MARGIN) = (int(ARGS[0]), int(ARGS[1]))
+    SAMPLE_NAMES = ARGS[2:] or [FILE_NAME[:-len("_R1.fastq")]
+        for FILE_NAME in sorted(glob.glob("Sample_*_R1.fastq"))]
+    TASKS = build_tasks(SAMPLE_NAMES, READ_LEN, SPLIT_MARGIN,
+        shlex.split(OPTIONS.get("bowtie", "bowtie")),
+        int(OPTIONS.get("bowtie_processors", 2)),
+        "collapse-duplicates" in OPTIONS, "filter-reads" in OPTIONS)
+    PIPELINE = Pipeline(TASKS,
+        int(OPTIONS.get("cpus", multiprocessing.cpu_count())),
+        int(OPTIONS.get("memory", _physical_memory())))
+
+    if "dry-run" in OPTIONS:
+        for TASK_NAME in PIPELINE.stale_tasks():
+            print (TASK_NAME)
+        sys.exit()
+
+    (COMPLETED, SKIPPED, FAILED) = PIPELINE.run()
+    print ("{0} tasks completed, {1} up to date, {2} failed".format(
+        len(COMPLETED), len(SKIPPED), len(FAILED)))
+    if FAILED:
+        print ("failed: {0}".format(", ".join(FAILED)))
+        sys.exit(1)
+    print ("{0} done.".format(BASENAME))
@@ -1,8 +1,44 @@
 #! /usr/bin/env python
 
+"""
+split_read.py
+Splits each read of a fastq file at every position at least split_margin from
+either end, emitting a left and right stanza for each split (named
+[read]-L-[left length] and [read]-R-[right length]).
+
+With --collapse-duplicates, reads with identical sequences are first collapsed
+to a single representative whose header carries the number of reads it stands
+for as ;size=N (see DuplicateCollapser), so amplified libraries are split and
+aligned once per distinct sequence. identify_pairs passes the count through in
+the read names and cluster_gaps weights each gap by it (see duplicate_count).
+--max-memory=[Mb] bounds the sequences held in memory while collapsing by
+spilling to hash partitions on local disk (--spill-dir=[dir]).
+
+With --filter, reads unlikely to produce uniquely aligning splits (low
+complexity, poly-A tails, N-rich or low quality; see ReadFilter) are dropped
+before splitting and the number of reads failing each filter is written to
+[outfile root].filter_stats.tab. --min-entropy=, --max-poly-a=,
+--max-n-fraction= and --min-mean-quality= adjust the thresholds (and imply
+--filter).
+"""
 import os
 import re
+import shutil
 import sys
+import tempfile
+import numpy as np
+
+DUPLICATE_COUNT_TAG = ";size="
+_DUPLICATE_COUNT_RE = re.compile(r";size=(\d+)")
+
+def duplicate_count(name):
+    """Returns the number of identical reads a read (or split read) name
+    stands for: N if collapsed to ;size=N by DuplicateCollapser, otherwise
+    1."""
+    if DUPLICATE_COUNT_TAG not in name:
+        return 1
+    return int(_DUPLICATE_COUNT_RE.search(name).group(1))
+
 
 #pylint: disable=line-too-long
 class FQStanza(object):
@@ -36,6 +72,209 @@ class FQStanza(object):
         return "{0}\n{1}\n{2}\n{3}".format(self.main_header, self.seq, self.score_header, self.score)
 
 
+class ReadFilter(object):
+    """Drops reads unlikely to produce uniquely aligning splits: low
+    complexity (Shannon entropy of the A/C/G/T composition below min_entropy
+    bits), a 3' poly-A (or 5' poly-T) run longer than max_poly_a of the read,
+    more than max_n_fraction N bases, or a mean base quality (phred, from the
+    score string less quality_offset) below min_mean_quality. A threshold of
+    None disables its filter; empty reads are always dropped.
+
+    Reads are scored a block at a time with numpy over the concatenated
+    sequences and scores. counts holds the number of reads failing each
+    filter (a read may fail several) alongside the input and passed
+    totals."""
+
+    FILTERS = ["entropy", "poly_a", "n_fraction", "mean_quality"]
+    _BLOCK_SIZE = 10000
+    _BASES = "ACGT"
+
+    def __init__(self, min_entropy=1.0, max_poly_a=0.5, max_n_fraction=0.1,
+            min_mean_quality=20, quality_offset=33):
+        self.thresholds = {"entropy": min_entropy, "poly_a": max_poly_a,
+            "n_fraction": max_n_fraction, "mean_quality": min_mean_quality}
+        self._quality_offset = quality_offset
+        self.counts = dict([(name, 0) for name in
+            ["input", "passed"] + self.FILTERS])
+
+    def filter(self, stanzas):
+        """Yields the stanzas passing every filter."""
+        block = []
+        for stanza in stanzas:
+            block.append(stanza)
+            if len(block) == self._BLOCK_SIZE:
+                for passed in self._filter_block(block):
+                    yield passed
+                block = []
+        for passed in self._filter_block(block):
+            yield passed
+
+    def _filter_block(self, block):
+        if not block:
+            return []
+        failures = self.failures(block)
+        passing = np.array([len(stanza.seq) > 0 for stanza in block])
+        for name in self.FILTERS:
+            if name in failures:
+                self.counts[name] += int(failures[name].sum())
+                passing &= ~failures[name]
+        self.counts["input"] += len(block)
+        self.counts["passed"] += int(passing.sum())
+        return [stanza for (stanza, passed) in zip(block, passing) if passed]
+
+    def failures(self, stanzas):
+        """Returns a dict of enabled filter name to a boolean array of the
+        stanzas failing it."""
+        lengths = np.array([len(stanza.seq) for stanza in stanzas])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        ends = starts + lengths
+        # a trailing sentinel keeps reduceat indexes valid for empty reads
+        seqs = np.frombuffer("".join([stanza.seq for stanza in stanzas]).
+            upper() + "\0", dtype=np.uint8)
+        positions = np.arange(len(seqs))
+        read_lengths = np.maximum(lengths, 1).astype(np.float64)
+        thresholds = self.thresholds
+        failures = {}
+        if thresholds["entropy"] is not None:
+            base_counts = np.array([np.add.reduceat(seqs == ord(base), starts)
+                for base in self._BASES], dtype=np.float64)
+            totals = np.maximum(base_counts.sum(axis=0), 1)
+            fractions = base_counts / totals
+            logs = np.log2(np.where(fractions > 0, fractions, 1))
+            entropy = -(fractions * logs).sum(axis=0)
+            failures["entropy"] = entropy < thresholds["entropy"]
+        if thresholds["poly_a"] is not None:
+            # last non-A at or before each read's end; first non-T from its
+            # start
+            last_non_a = np.maximum.accumulate(
+                np.where(seqs == ord("A"), -1, positions))[ends - 1]
+            tail = ends - np.maximum(last_non_a + 1, starts)
+            first_non_t = np.minimum.accumulate(
+                np.where(seqs == ord("T"), len(seqs), positions)[::-1])[::-1]
+            head = np.minimum(first_non_t[starts], ends) - starts
+            failures["poly_a"] = np.maximum(head, tail) > \
+                thresholds["poly_a"] * lengths
+        if thresholds["n_fraction"] is not None:
+            n_counts = np.add.reduceat(seqs == ord("N"), starts)
+            failures["n_fraction"] = n_counts / read_lengths > \
+                thresholds["n_fraction"]
+        if thresholds["mean_quality"] is not None:
+            scores = np.frombuffer("".join([stanza.score[0:len(stanza.seq)]
+                for stanza in stanzas]) + chr(self._quality_offset),
+                dtype=np.uint8).astype(np.int64) - self._quality_offset
+            mean_quality = np.add.reduceat(scores, starts) / read_lengths
+            failures["mean_quality"] = mean_quality < \
+                thresholds["mean_quality"]
+        return failures
+
+    def write_stats(self, writer):
+        """Writes the reads failing each filter (with its threshold)."""
+        writer.write("#filter\tthreshold\treads\n")
+        writer.write("input\t\t{0}\n".format(self.counts["input"]))
+        for name in self.FILTERS:
+            threshold = self.thresholds[name]
+            writer.write("{0}\t{1}\t{2}\n".format(name,
+                "" if threshold is None else threshold, self.counts[name]))
+        writer.write("passed\t\t{0}\n".format(self.counts["passed"]))
+
+
+class DuplicateCollapser(object):
+    """Collapses reads with identical sequences to one representative (the
+    first read with each sequence) whose main header carries the number of
+    reads it stands for as ;size=N; unique reads pass through unchanged. A
+    read already carrying a count contributes that count.
+
+    Distinct sequences are held in memory up to memory_bytes (estimated; no
+    limit if None). Past that, the reads are partitioned by a hash of their
+    sequence into spill files (in a temporary directory under spill_dir) and
+    each partition is collapsed in turn, repartitioning with a different hash
+    should one still not fit. Representatives are yielded in order of first
+    appearance (within each partition if spilled)."""
+
+    _STANZA_OVERHEAD_BYTES = 400
+    _PARTITIONS = 64
+    _MAX_DEPTH = 4
+
+    def __init__(self, memory_bytes=None, spill_dir=None):
+        self._memory_bytes = memory_bytes
+        self._spill_dir = spill_dir
+        self.read_count = 0
+        self.distinct_count = 0
+
+    def collapse(self, stanzas):
+        return self._collapse(stanzas, 0)
+
+    def _collapse(self, stanzas, depth):
+        stanzas = iter(stanzas)
+        entries = {}
+        first_seen = []
+        size = 0
+        for stanza in stanzas:
+            count = duplicate_count(stanza.main_header)
+            entry = entries.get(stanza.seq)
+            if entry is not None:
+                entry[1] += count
+                continue
+            entry = entries[stanza.seq] = [stanza, count]
+            first_seen.append(entry)
+            size += self._STANZA_OVERHEAD_BYTES + len(stanza.main_header) + \
+                len(stanza.seq) + len(stanza.score_header) + len(stanza.score)
+            if self._memory_bytes and size > self._memory_bytes and \
+                    depth < self._MAX_DEPTH:
+                entries.clear()
+                for collapsed in self._collapse_spilled(first_seen, stanzas,
+                        depth):
+                    yield collapsed
+                return
+        for (stanza, count) in first_seen:
+            self.read_count += count
+            self.distinct_count += 1
+            yield self._counted(stanza, count)
+
+    def _collapse_spilled(self, first_seen, stanzas, depth):
+        """Partitions first_seen (emptied as it is written) and the remaining
+        stanzas to spill files and collapses each partition."""
+        run_dir = tempfile.mkdtemp(prefix="split_read.", dir=self._spill_dir)
+        try:
+            file_names = [os.path.join(run_dir, "{0}.fastq".format(i))
+                for i in range(self._PARTITIONS)]
+            partitions = [open(file_name, "w") for file_name in file_names]
+            sizes = [0] * self._PARTITIONS
+            def spill(stanza):
+                partition = hash((depth, stanza.seq)) % self._PARTITIONS
+                partitions[partition].write(str(stanza))
+                partitions[partition].write("\n")
+                sizes[partition] += 1
+            for (stanza, count) in first_seen:
+                spill(self._counted(stanza, count))
+            del first_seen[:]
+            for stanza in stanzas:
+                spill(stanza)
+            for partition in partitions:
+                partition.close()
+            for (file_name, size) in zip(file_names, sizes):
+                if not size:
+                    continue
+                with open(file_name, "r") as reader:
+                    for collapsed in self._collapse(
+                            stanza_generator(reader, "@"), depth + 1):
+                        yield collapsed
+                os.remove(file_name)
+        finally:
+            shutil.rmtree(run_dir)
+
+    @staticmethod
+    def _counted(stanza, count):
+        if count == 1 and DUPLICATE_COUNT_TAG not in stanza.main_header:
+            return stanza
+        main_header = _DUPLICATE_COUNT_RE.sub("", stanza.main_header)
+        if count > 1:
+            main_header = "{0}{1}{2}".format(main_header, DUPLICATE_COUNT_TAG,
+                count)
+        return FQStanza(main_header, stanza.seq, stanza.score_header,
+            stanza.score)
+
+
 def build_splits(in_stanza, split_margin):
     stanzas = []
     for split_position in range(split_margin, (len(in_stanza.seq)-split_margin)+1):
@@ -69,30 +308,71 @@ def stanza_generator(reader, stanza_delimiter):
 
 
 
-def main(infilen, outfilen, split_margin):
+def filter_stats_file_name(output_file_name):
+    return "{0}.filter_stats.tab".format(os.path.splitext(output_file_name)[0])
+
+
+def main(infilen, outfilen, split_margin, collapse_duplicates=False,
+        max_memory_mb=None, spill_dir=None, read_filter=None):
     infile = open(infilen, "r")
     outfile = open(outfilen, "w")
     stanza_gen = stanza_generator(infile, "@")
+    if read_filter:
+        stanza_gen = read_filter.filter(stanza_gen)
+    collapser = None
+    if collapse_duplicates:
+        memory_bytes = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+        collapser = DuplicateCollapser(memory_bytes, spill_dir)
+        stanza_gen = collapser.collapse(stanza_gen)
     write_stanzas(stanza_gen, outfile, split_margin)        
     infile.close()
     outfile.close()
+    if read_filter:
+        with open(filter_stats_file_name(outfilen), "w") as stats_file:
+            read_filter.write_stats(stats_file)
+        print ("filtered {0} reads to {1}".format(read_filter.counts["input"],
+            read_filter.counts["passed"]))
+    if collapser:
+        print ("collapsed {0} reads to {1} distinct sequences". \
+            format(collapser.read_count, collapser.distinct_count))
 
 
 
 if __name__ == "__main__":
 
-    if (len(sys.argv)  < 4 or len(sys.argv) > 5):
-        print ("usage: {0} [infile] [outfile] [split_margin]". \
-            format(os.path.basename(sys.argv[0])))
+    # pylint: disable=line-too-long
+    COLLAPSE_FLAG = "--collapse-duplicates"
+    MAX_MEMORY_FLAG = "--max-memory="
+    SPILL_DIR_FLAG = "--spill-dir="
+    FILTER_FLAG = "--filter"
+    FILTER_THRESHOLD_FLAGS = {"--min-entropy=": "min_entropy", "--max-poly-a=": "max_poly_a", "--max-n-fraction=": "max_n_fraction", "--min-mean-quality=": "min_mean_quality"}
+    USAGE = "usage: {0} [infile] [outfile] [split_margin] [{1} (split each distinct sequence once; headers carry ;size=[count])] [{2}Mb (spill to disk while collapsing to stay within this memory)] [{3}directory for spill files (default system temp dir)] [{4} (drop low complexity, poly-A, N-rich and low quality reads; counts to [outfile root].filter_stats.tab)] [--min-entropy=bits (default 1.0)] [--max-poly-a=fraction of read (default 0.5)] [--max-n-fraction=fraction (default 0.1)] [--min-mean-quality=phred (default 20)]".format(os.path.basename(sys.argv[0]), COLLAPSE_FLAG, MAX_MEMORY_FLAG, SPILL_DIR_FLAG, FILTER_FLAG)
+    OPTION_FLAGS = [MAX_MEMORY_FLAG, SPILL_DIR_FLAG] + list(FILTER_THRESHOLD_FLAGS)
+    ARGS = [arg for arg in sys.argv[1:] if not any(arg.startswith(flag) for flag in OPTION_FLAGS) and arg not in (COLLAPSE_FLAG, FILTER_FLAG)]
+    if len(ARGS) != 3:
+        print (USAGE)
         sys.exit(1) 
 
 
-    INFILENAME = sys.argv[1]
-    OUTFILENAME = sys.argv[2]
-    SPLIT_MARGIN = int(sys.argv[3])
+    INFILENAME = ARGS[0]
+    OUTFILENAME = ARGS[1]
+    SPLIT_MARGIN = int(ARGS[2])
+    COLLAPSE_DUPLICATES = COLLAPSE_FLAG in sys.argv[1:]
+    MAX_MEMORY_MB = None
+    SPILL_DIR = None
+    FILTER_THRESHOLDS = {}
+    for ARG in sys.argv[1:]:
+        if ARG.startswith(MAX_MEMORY_FLAG):
+            MAX_MEMORY_MB = int(ARG[len(MAX_MEMORY_FLAG):])
+        elif ARG.startswith(SPILL_DIR_FLAG):
+            SPILL_DIR = os.path.abspath(ARG[len(SPILL_DIR_FLAG):])
+        for (FLAG, THRESHOLD) in FILTER_THRESHOLD_FLAGS.items():
+            if ARG.startswith(FLAG):
+                FILTER_THRESHOLDS[THRESHOLD] = float(ARG[len(FLAG):])
+    READ_FILTER = ReadFilter(**FILTER_THRESHOLDS) if FILTER_THRESHOLDS or FILTER_FLAG in sys.argv[1:] else None
     
     if not os.path.isfile(INFILENAME):
         raise ValueError("infile [{0}] does not exist".format(INFILENAME))
 
-    main(INFILENAME, OUTFILENAME, SPLIT_MARGIN)
-    print ("done.")
\ No newline at end of file
+    main(INFILENAME, OUTFILENAME, SPLIT_MARGIN, COLLAPSE_DUPLICATES, MAX_MEMORY_MB, SPILL_DIR, READ_FILTER)
+    print ("done.")
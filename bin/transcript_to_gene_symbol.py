@@ -1,60 +1,200 @@
 #! /usr/bin/env python
+"""Appends a gene symbol column to a tab-separated file based on a transcript
+id column.
+
+The transcript -> gene symbol mapping is compiled once into a marshal cache
+alongside the mapping file ([mapping datafile].cache). The cache records the
+mapping file's mtime, size and sha1; it is used as-is while mtime and size
+match, re-validated by hash if they don't, and rebuilt when the content
+changed (or the cache is unreadable).
+
+Many files can be annotated in one process (--batch), loading the mapping
+once and processing the files concurrently in a thread pool. Loaded mappings
+are kept in a registry (GENE_MAPS unless another is given, e.g. the one a
+job_server.py daemon preloads and passes to its jobs) and only loaded again if
+their file changes; one since removed is still served from the registry."""
+import glob
+import hashlib
+import marshal
+from multiprocessing.pool import ThreadPool
 import sys, os
 
-def parse_gene_map(infile_name):
+_CACHE_SUFFIX = ".cache"
+_CACHE_VERSION = 1
+NOT_FOUND = "Not found."
+_WRITE_BLOCK_LINES = 10000
+_DEFAULT_THREADS = 4
+# mapping file name -> ((mtime, size), gene_map) loaded by this process
+GENE_MAPS = {}
+
+def _parse_gene_map(infile):
     # transcipt -> gene_symbol
-    infile = file(infile_name)
     gene_map = {}
-    for line in infile.readlines():
+    for line in infile:
         line = line.strip()
         bits = line.split("\t")
         if len(bits) < 3:
-            print "No gene symbol for transcript: '{0}'".format(line)
+            print ("No gene symbol for transcript: '{0}'".format(line))
             gene_map[bits[0]] = ""
             continue
         gene_map[bits[0]] = bits[2]
-    infile.close()
     return gene_map
-    
+
+def _file_hash(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, "rb") as infile:
+        for block in iter(lambda: infile.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _read_cache(cache_file_name):
+    """Returns (header, gene_map) or (None, None) if the cache is missing or
+    unreadable."""
+    try:
+        with open(cache_file_name, "rb") as cache_file:
+            header = marshal.load(cache_file)
+            if header[0] != _CACHE_VERSION:
+                return (None, None)
+            return (header, marshal.load(cache_file))
+    except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
+        return (None, None)
+
+def _write_cache(cache_file_name, header, gene_map):
+    try:
+        with open(cache_file_name + ".tmp", "wb") as cache_file:
+            marshal.dump(header, cache_file)
+            marshal.dump(gene_map, cache_file)
+        os.rename(cache_file_name + ".tmp", cache_file_name)
+    except (IOError, OSError):
+        pass
+
+def parse_gene_map(infile_name, gene_maps=None):
+    """Returns the transcript -> gene symbol map of the mapping file, from the
+    gene_maps registry (default GENE_MAPS) if loaded there already; adds the
+    maps it loads to the registry."""
+    if gene_maps is None:
+        gene_maps = GENE_MAPS
+    loaded = gene_maps.get(os.path.abspath(infile_name))
+    try:
+        stat = os.stat(infile_name)
+    except OSError:
+        if loaded is None:
+            raise
+        return loaded[1]
+    (mtime, size) = (stat.st_mtime, stat.st_size)
+    if loaded is not None and loaded[0] == (mtime, size):
+        return loaded[1]
+    gene_map = _load_gene_map(infile_name, mtime, size)
+    gene_maps[os.path.abspath(infile_name)] = ((mtime, size), gene_map)
+    return gene_map
+
+def _load_gene_map(infile_name, mtime, size):
+    cache_file_name = infile_name + _CACHE_SUFFIX
+    (header, gene_map) = _read_cache(cache_file_name)
+    if header is not None and header[1:3] == (mtime, size):
+        return gene_map
+
+    file_hash = _file_hash(infile_name)
+    if header is None or header[3] != file_hash:
+        with open(infile_name, "r") as infile:
+            gene_map = _parse_gene_map(infile)
+    _write_cache(cache_file_name, (_CACHE_VERSION, mtime, size, file_hash),
+        gene_map)
+    return gene_map
+
+
+class AnnotationStats():
+    """Counts of mapped/missed transcripts for one annotated file."""
+    def __init__(self, input_file_name):
+        self.input_file_name = input_file_name
+        self.total_lines = 0
+        self.missed_lines = 0
+        self.mapped_keys = set()
+        self.missed_keys = set()
+
+    def summary(self):
+        return ["{0} total transcript lines".format(self.total_lines),
+            "{0} mapped transcripts".format(len(self.mapped_keys)),
+            "{0} missed transcript lines".format(self.missed_lines),
+            "{0} missed transcript IDs".format(len(self.missed_keys))]
+
+def annotate_file(input_file_name, output_file_name, transcript_index,
+        gene_map):
+    """Writes each line of the input with its gene symbol appended and
+    returns AnnotationStats."""
+    stats = AnnotationStats(input_file_name)
+    with open(input_file_name, "r") as transcript_file:
+        with open(output_file_name, "w") as outfile:
+            lines = []
+            for line in transcript_file:
+                line = line.strip()
+                stats.total_lines += 1
+                transcript_id = line.split("\t")[transcript_index]
+                gene_sym = gene_map.get(transcript_id)
+                if gene_sym is None:
+                    gene_sym = NOT_FOUND
+                    stats.missed_lines += 1
+                    stats.missed_keys.add(transcript_id)
+                else:
+                    stats.mapped_keys.add(transcript_id)
+                lines.append(line + "\t" + gene_sym + "\n")
+                if len(lines) == _WRITE_BLOCK_LINES:
+                    outfile.writelines(lines)
+                    lines = []
+            outfile.writelines(lines)
+    return stats
+
+def annotate_files(file_name_pairs, transcript_index, gene_map,
+        threads=_DEFAULT_THREADS):
+    """Annotates each (input, output) pair concurrently; returns a list of
+    AnnotationStats in the same order."""
+    pool = ThreadPool(max(1, min(threads, len(file_name_pairs))))
+    try:
+        return pool.map(lambda pair: annotate_file(pair[0], pair[1],
+            transcript_index, gene_map), file_name_pairs)
+    finally:
+        pool.close()
+
+def batch_file_name_pairs(specs):
+    """Expands 'infile=outfile' pairs and bare file names/globs (written to
+    '<root>.genes<ext>') into a list of (input, output) pairs."""
+    pairs = []
+    for spec in specs:
+        if "=" in spec:
+            pairs.append(tuple(spec.split("=", 1)))
+            continue
+        input_file_names = sorted(glob.glob(spec))
+        if not input_file_names:
+            raise ValueError("infile [{0}] does not exist".format(spec))
+        for input_file_name in input_file_names:
+            (root, ext) = os.path.splitext(input_file_name)
+            pairs.append((input_file_name, "{0}.genes{1}".format(root, ext)))
+    return pairs
+
 
 if __name__ == '__main__':
-    
+    # job_server.py runs this script with the registry of the mappings it
+    # preloaded as PRELOADED_GENE_MAPS
+    GENE_MAP_REGISTRY = globals().get("PRELOADED_GENE_MAPS")
+
+    BATCH_FLAG = "--batch"
+    if len(sys.argv) >= 5 and sys.argv[1] == BATCH_FLAG:
+        TRANSCRIPT_INDEX = int(sys.argv[2])
+        GENE_MAP = parse_gene_map(sys.argv[3], GENE_MAP_REGISTRY)
+        FILE_NAME_PAIRS = batch_file_name_pairs(sys.argv[4:])
+        for STATS in annotate_files(FILE_NAME_PAIRS, TRANSCRIPT_INDEX, GENE_MAP):
+            for LINE in STATS.summary():
+                print ("{0}: {1}".format(STATS.input_file_name, LINE))
+        print ("done.")
+        sys.exit()
+
     if (len(sys.argv) != 5):
-        print "usage: {0} [tsv transcript infile] [transcript_column_zero_based] [mapping datafile] [outfile]".format(os.path.basename(sys.argv[0]))
+        print ("usage: {0} [tsv transcript infile] [transcript_column_zero_based] [mapping datafile] [outfile]".format(os.path.basename(sys.argv[0])))
+        print ("   or: {0} {1} [transcript_column_zero_based] [mapping datafile] [infile=outfile | infile_glob (writes <root>.genes<ext>)] ...".format(os.path.basename(sys.argv[0]), BATCH_FLAG))
         sys.exit()
-            
-    transcript_filename = sys.argv[1]
-    transcript_index = int(sys.argv[2])
-    mapping_data = sys.argv[3]
-    outfile_name = sys.argv[4]
-    
-    transcript_file = file(transcript_filename)
-    outfile = file(outfile_name, "w")
-    
-    gene_map = parse_gene_map(mapping_data)
-    
-    missed_lines = 0
-    total_transcript_lines = 0
-    missed_keys = set()
-    mapped_keys = set()
-    for line in transcript_file.readlines():
-        line = line.strip()
-        total_transcript_lines += 1
-        bits = line.split("\t")
-        transcript_id = bits[transcript_index]
-        gene_sym = "Not found."
-        if transcript_id in gene_map:
-            gene_sym = gene_map[transcript_id]
-            mapped_keys.add(transcript_id)
-        else:
-            missed_lines += 1
-            missed_keys.add(transcript_id)
-            #print "No transcript mapping: {0}".format(transcript_id)
-        outstr = "{0}\t{1}\n".format(line, gene_sym)
-        outfile.write(outstr)
-    outfile.close()
-    print "{0} total transcript lines".format(total_transcript_lines)
-    print "{0} mapped transcripts".format(len(mapped_keys))
-    print "{0} missed transcript lines".format(missed_lines)
-    print "{0} missed transcript IDs".format(len(missed_keys))
-    print "done."
+
+    (TRANSCRIPT_FILE_NAME, TRANSCRIPT_INDEX, MAPPING_DATA, OUTFILE_NAME) = sys.argv[1:]
+    STATS = annotate_file(TRANSCRIPT_FILE_NAME, OUTFILE_NAME, int(TRANSCRIPT_INDEX), parse_gene_map(MAPPING_DATA, GENE_MAP_REGISTRY))
+    for LINE in STATS.summary():
+        print (LINE)
+    print ("done.")
@@ -0,0 +1,33 @@
+import unittest
+from io import BytesIO
+from bin.add_readgroup_to_sam import add_read_group
+
+
+class AddReadGroupTestCase(unittest.TestCase):
+
+    def test_add_read_group_insertsHeaderBeforeProgramLine(self):
+        reader = BytesIO(b"@HD\tVN:1.0\n@SQ\tSN:chr1\n@PG\tID:bowtie\nread1\t0\tchr1\nread2\t0\tchr1\n")
+        writer = BytesIO()
+
+        add_read_group(reader, writer, "rg1", "sampleA")
+
+        self.assertEqual(b"@HD\tVN:1.0\n@SQ\tSN:chr1\n@RG\tID:rg1\tSM:sampleA\n@PG\tID:bowtie\n"
+            b"read1\t0\tchr1\tRG:Z:rg1\nread2\t0\tchr1\tRG:Z:rg1\n", writer.getvalue())
+
+    def test_add_read_group_insertsHeaderWhenNoProgramLine(self):
+        reader = BytesIO(b"@SQ\tSN:chr1\nread1\t0\tchr1\n")
+        writer = BytesIO()
+
+        add_read_group(reader, writer, "rg1", "sampleA")
+
+        self.assertEqual(b"@SQ\tSN:chr1\n@RG\tID:rg1\tSM:sampleA\nread1\t0\tchr1\tRG:Z:rg1\n", writer.getvalue())
+
+    def test_add_read_group_tagsLinesSpanningBlocks(self):
+        lines = [("read{0}\t0\tchr1\t{0}".format(i)).encode() for i in range(100)]
+        reader = BytesIO(b"@PG\tID:bowtie\n" + b"\r\n".join(lines))
+        writer = BytesIO()
+
+        add_read_group(reader, writer, "rg1", "sampleA", block_size=7)
+
+        expected_lines = [b"@RG\tID:rg1\tSM:sampleA", b"@PG\tID:bowtie"] + [line + b"\tRG:Z:rg1" for line in lines]
+        self.assertEqual(b"\n".join(expected_lines) + b"\n", writer.getvalue())
@@ -0,0 +1,333 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from bin.bam import BamFormatError, BamReader, BamWriter, BgzfReader, BgzfWriter, is_bam, open_alignments, \
+    open_alignment_output, _reg2bin
+from bin.cluster_gaps import open_sam_input
+from bin.merge_sam import merged_lines
+
+SAM_HEADER = ["@HD\tVN:1.0\tSO:unsorted\n", "@SQ\tSN:chr1\tLN:1000\n", "@SQ\tSN:chr2\tLN:2000\n"]
+
+SAM_RECORDS = [
+    "read1\t99\tchr1\t10\t30\t5M2D3M\t=\t40\t45\tACGTNACGT\tIIIII####\tNM:i:2\tXS:A:+\tRG:Z:sampleA\n",
+    "read2\t147\tchr1\t40\t0\t8M\tchr2\t7\t-45\tACGTACGT\t*\tXC:i:-3\tXL:i:70000\tXB:B:s,1,-2,3\tXF:f:1.5\n",
+    "read3\t4\t*\t0\t0\t*\t*\t0\t0\t*\t*\n"]
+
+_CIGAR_OPS = "MIDNSHP=X"
+_SEQ_CODES = "=ACMGRSVTWYHKDBN"
+_TAG_TYPES = {"s": "<h", "i": "<i", "f": "<f"}
+
+
+def _tag_bytes(field):
+    (tag, tag_type, value) = field.split(":", 2)
+    if tag_type == "Z":
+        return tag + "Z" + value + "\0"
+    if tag_type == "A":
+        return tag + "A" + value
+    if tag_type == "f":
+        return tag + "f" + struct.pack("<f", float(value))
+    if tag_type == "B":
+        values = value.split(",")
+        return tag + "B" + values[0] + struct.pack("<i", len(values) - 1) + \
+            "".join(struct.pack(_TAG_TYPES[values[0]], int(item)) for item in values[1:])
+    value = int(value)
+    if 0 <= value < 256:
+        return tag + "C" + struct.pack("<B", value)
+    return tag + "i" + struct.pack("<i", value)
+
+def _record_bytes(line, references):
+    fields = line.rstrip("\n").split("\t")
+    (name, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual) = fields[:11]
+    ref_id = references.index(rname) if rname != "*" else -1
+    next_ref_id = {"*": -1, "=": ref_id}.get(rnext, references.index(rnext) if rnext in references else -1)
+    cigar_ops = []
+    if cigar != "*":
+        number = ""
+        for char in cigar:
+            if char.isdigit():
+                number += char
+            else:
+                cigar_ops.append(int(number) << 4 | _CIGAR_OPS.index(char))
+                number = ""
+    seq = "" if seq == "*" else seq
+    codes = [_SEQ_CODES.index(base) for base in seq] + [0]
+    packed = "".join(chr(codes[i] << 4 | codes[i + 1]) for i in range(0, len(seq), 2))
+    quals = "\xff" * len(seq) if qual == "*" else "".join(chr(ord(char) - 33) for char in qual)
+    body = struct.pack("<iiBBHHHiiii", ref_id, int(pos) - 1, len(name) + 1, int(mapq), 0,
+            len(cigar_ops), int(flag), len(seq), next_ref_id, int(pnext) - 1, int(tlen)) + \
+        name + "\0" + "".join(struct.pack("<I", op) for op in cigar_ops) + packed + quals + \
+        "".join(_tag_bytes(field) for field in fields[11:])
+    return struct.pack("<i", len(body)) + body
+
+def _bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return "\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0" + struct.pack("<H", len(compressed) + 25) + \
+        compressed + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+def write_bam(file_name, header_lines, records, references=("chr1", "chr2"), block_size=65280):
+    """Writes SAM text lines as a BAM file, in BGZF blocks of at most block_size bytes."""
+    text = "".join(header_lines)
+    data = "BAM\1" + struct.pack("<i", len(text)) + text + struct.pack("<i", len(references)) + \
+        "".join(struct.pack("<i", len(name) + 1) + name + "\0" + struct.pack("<i", 1000) for name in references) + \
+        "".join(_record_bytes(line, list(references)) for line in records)
+    with open(file_name, "wb") as bam_file:
+        for start in range(0, len(data), block_size):
+            bam_file.write(_bgzf_block(data[start:start + block_size]))
+        bam_file.write(_bgzf_block(""))
+
+
+class BamReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bam_file_name = os.path.join(self.directory, "input.bam")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lines(self):
+        write_bam(self.bam_file_name, SAM_HEADER, SAM_RECORDS)
+
+        self.assertEqual(SAM_HEADER + SAM_RECORDS, list(BamReader(self.bam_file_name).lines()))
+
+    def test_lines_recordsSpanningBlocks(self):
+        records = [SAM_RECORDS[0].replace("read1", "read{0}".format(i)) for i in range(500)]
+        write_bam(self.bam_file_name, SAM_HEADER, records, block_size=100)
+
+        self.assertEqual(SAM_HEADER + records, list(BamReader(self.bam_file_name, threads=3).lines()))
+
+    def test_lines_withoutSequences(self):
+        write_bam(self.bam_file_name, SAM_HEADER, SAM_RECORDS[0:1])
+
+        actual = list(BamReader(self.bam_file_name).lines(sequences=False))[-1].split("\t")
+
+        self.assertEqual(["read1", "99", "chr1", "10"], actual[0:4])
+        self.assertEqual(["NNNNNNNNN", "*", "NM:i:2"], actual[9:12])
+
+    def test_lines_addsReferencesMissingFromHeaderText(self):
+        write_bam(self.bam_file_name, ["@HD\tVN:1.0\n", "@CO\tfoo\n"], [])
+
+        self.assertEqual(["@HD\tVN:1.0\n", "@SQ\tSN:chr1\tLN:1000\n", "@SQ\tSN:chr2\tLN:1000\n", "@CO\tfoo\n"],
+            list(BamReader(self.bam_file_name).lines()))
+
+    def test_lines_raisesOnTruncatedFile(self):
+        write_bam(self.bam_file_name, SAM_HEADER, SAM_RECORDS)
+        with open(self.bam_file_name, "rb") as bam_file:
+            data = bam_file.read()
+        with open(self.bam_file_name, "wb") as bam_file:
+            bam_file.write(data[:-40])
+
+        self.assertRaises(BamFormatError, list, BamReader(self.bam_file_name).lines())
+
+    def test_bgzf_batches(self):
+        write_bam(self.bam_file_name, SAM_HEADER, SAM_RECORDS * 50, block_size=64)
+
+        batches = list(BgzfReader(self.bam_file_name, threads=2, batch_blocks=4).batches())
+
+        self.assertTrue(len(batches) > 1)
+        self.assertEqual("BAM\1", batches[0][0:4])
+
+    def test_is_bam(self):
+        write_bam(self.bam_file_name, SAM_HEADER, SAM_RECORDS)
+        sam_file_name = os.path.join(self.directory, "input.sam")
+        with open(sam_file_name, "w") as sam_file:
+            sam_file.writelines(SAM_HEADER + SAM_RECORDS)
+
+        self.assertTrue(is_bam(self.bam_file_name))
+        self.assertFalse(is_bam(sam_file_name))
+
+    def test_open_alignments(self):
+        write_bam(self.bam_file_name, SAM_HEADER, SAM_RECORDS)
+        sam_file_name = os.path.join(self.directory, "input.sam")
+        with open(sam_file_name, "w") as sam_file:
+            sam_file.writelines(SAM_HEADER + SAM_RECORDS)
+
+        with open_alignments(self.bam_file_name) as bam_lines, open_alignments(sam_file_name) as sam_lines:
+            self.assertEqual(list(sam_lines), list(bam_lines))
+
+    def test_open_sam_input_mergesBamAndSam(self):
+        write_bam(self.bam_file_name, SAM_HEADER, SAM_RECORDS[0:1])
+        sam_file_name = os.path.join(self.directory, "input.sam")
+        with open(sam_file_name, "w") as sam_file:
+            sam_file.writelines(SAM_HEADER + SAM_RECORDS[1:])
+
+        with open_sam_input(",".join([self.bam_file_name, sam_file_name])) as lines:
+            actual = list(lines)
+
+        self.assertEqual(SAM_HEADER + SAM_RECORDS, actual)
+        self.assertEqual(actual, list(merged_lines([self.bam_file_name, sam_file_name])))
+
+
+def read_index(file_name):
+    """Returns [(bins, linear index)] for each reference of a .bai file."""
+    with open(file_name, "rb") as index_file:
+        data = index_file.read()
+    assert data[0:4] == "BAI\1"
+    (reference_count,) = struct.unpack_from("<i", data, 4)
+    (offset, references) = (8, [])
+    for _ in range(reference_count):
+        (bin_count,) = struct.unpack_from("<i", data, offset)
+        (offset, bins) = (offset + 4, {})
+        for _ in range(bin_count):
+            (bin_number, chunk_count) = struct.unpack_from("<Ii", data, offset)
+            bins[bin_number] = [struct.unpack_from("<QQ", data, offset + 8 + 16 * i) for i in range(chunk_count)]
+            offset += 8 + 16 * chunk_count
+        (window_count,) = struct.unpack_from("<i", data, offset)
+        linear = list(struct.unpack_from("<{0}Q".format(window_count), data, offset + 4))
+        offset += 4 + 8 * window_count
+        references.append((bins, linear))
+    return references
+
+def inflate_with_offsets(file_name):
+    """Returns (inflated data, {block address: offset of the block in the inflated data})."""
+    (reader, data, offsets) = (BgzfReader(file_name), "", {})
+    with open(file_name, "rb") as bam_file:
+        while True:
+            address = bam_file.tell()
+            block = reader._read_block(bam_file)
+            if block is None:
+                return (data, offsets)
+            offsets[address] = len(data)
+            data += zlib.decompress(block[1], -15)
+
+def overlapping_bins(start, end):
+    """Bins which may hold alignments overlapping [start, end) (see the SAM specification)."""
+    end -= 1
+    bins = [0]
+    for (shift, first) in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(first + (start >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+class BamWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bam_file_name = os.path.join(self.directory, "output.bam")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, lines, **kwargs):
+        writer = BamWriter(self.bam_file_name, **kwargs)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+        return list(BamReader(self.bam_file_name).lines())
+
+    def test_write_roundTrips(self):
+        self.assertEqual(SAM_HEADER + SAM_RECORDS, self._write(SAM_HEADER + SAM_RECORDS))
+        self.assertFalse(os.path.exists(self.bam_file_name + ".bai"))
+
+    def test_write_splitsTextIntoLines(self):
+        text = "".join(SAM_HEADER + SAM_RECORDS)
+
+        self.assertEqual(SAM_HEADER + SAM_RECORDS, self._write([text[0:30], text[30:200], text[200:]]))
+
+    def test_write_acceptsSpaceSeparatedTags(self):
+        line = "read1\t0\tchr1\t10\t255\t3M\t*\t0\t0\tACG\tIII\tXA:i:0 MD:Z:3\tRG:Z:a\n"
+
+        actual = self._write(SAM_HEADER + [line])
+
+        self.assertEqual("read1\t0\tchr1\t10\t255\t3M\t*\t0\t0\tACG\tIII\tXA:i:0\tMD:Z:3\tRG:Z:a\n", actual[-1])
+
+    def test_write_raisesOnUnknownReference(self):
+        writer = BamWriter(self.bam_file_name)
+
+        self.assertRaises(BamFormatError, writer.write, SAM_HEADER[0] + SAM_RECORDS[0].replace("chr1", "chr9"))
+
+    def test_write_sorted(self):
+        records = ["r{0}\t0\tchr{1}\t{2}\t255\t5M\t*\t0\t0\tACGTA\tIIIII\n".format(i, 2 - i % 2, 1000 - i)
+            for i in range(100)] + [SAM_RECORDS[2]]
+
+        actual = self._write(SAM_HEADER + records, sort=True)
+
+        self.assertEqual("@HD\tVN:1.0\tSO:coordinate\n", actual[0])
+        fields = [line.split("\t") for line in actual[3:]]
+        self.assertEqual(sorted(records), sorted(actual[3:]))
+        self.assertEqual(["chr1"] * 50 + ["chr2"] * 50 + ["*"], [field[2] for field in fields])
+        self.assertEqual(sorted(int(field[3]) for field in fields[0:50]), [int(field[3]) for field in fields[0:50]])
+
+    def test_write_sortedSpillsRuns(self):
+        records = ["r{0}\t0\tchr1\t{1}\t255\t5M\t*\t0\t0\tACGTA\tIIIII\n".format(i, (i * 7919) % 10000 + 1)
+            for i in range(40000)]
+        writer = BamWriter(self.bam_file_name, sort=True, max_memory_mb=1, spill_dir=self.directory)
+        writer.write("".join(SAM_HEADER + records))
+        run_count = len(writer._run_file_names)
+        writer.close()
+
+        actual = list(BamReader(self.bam_file_name).lines())[3:]
+
+        self.assertTrue(run_count > 1)
+        self.assertEqual(sorted(records), sorted(actual))
+        positions = [int(line.split("\t")[3]) for line in actual]
+        self.assertEqual(sorted(positions), positions)
+        self.assertEqual(["output.bam", "output.bam.bai"], sorted(os.listdir(self.directory)))
+
+    def test_write_sortedIndex(self):
+        alignments = [("r{0}".format(i), i % 2, (i * 7919) % 200000, 50 + (i * 37) % 40000) for i in range(3000)]
+        records = ["{0}\t0\tchr{1}\t{2}\t255\t{3}M\t*\t0\t0\t*\t*\n".format(name, reference_id + 1, position + 1, length)
+            for (name, reference_id, position, length) in alignments]
+        self._write(SAM_HEADER + records, sort=True)
+        references = read_index(self.bam_file_name + ".bai")
+        (data, offsets) = inflate_with_offsets(self.bam_file_name)
+        inflated_offset = lambda virtual_offset: offsets[virtual_offset >> 16] + (virtual_offset & 0xffff)
+
+        for (reference_id, query_start, query_end) in [(0, 0, 100), (0, 5000, 90000), (1, 150000, 150001)]:
+            (bins, linear) = references[reference_id]
+            minimum_offset = linear[query_start >> 14]
+            found = set()
+            for bin_number in overlapping_bins(query_start, query_end):
+                for (start, end) in bins.get(bin_number, []):
+                    if end <= minimum_offset:
+                        continue
+                    (offset, stop) = (inflated_offset(start), inflated_offset(end))
+                    while offset < stop:
+                        (block_size, name_len) = (struct.unpack_from("<i", data, offset)[0], ord(data[offset + 12]))
+                        found.add(data[offset + 36:offset + 35 + name_len])
+                        offset += 4 + block_size
+            expected = set(name for (name, alignment_reference_id, position, length) in alignments
+                if alignment_reference_id == reference_id and position < query_end and position + length > query_start)
+
+            self.assertTrue(expected)
+            self.assertEqual(expected, found & expected)
+            self.assertTrue(len(found) < len(alignments) / 2)
+
+    def test_reg2bin(self):
+        self.assertEqual(4681, _reg2bin(0, 1))
+        self.assertEqual(4681 + 1, _reg2bin(16384, 16400))
+        self.assertEqual(585, _reg2bin(16000, 17000))
+        self.assertEqual(0, _reg2bin(0, 1 << 29))
+        self.assertEqual(4680, _reg2bin(-1, 0))
+
+    def test_bgzf_writer(self):
+        writer = BgzfWriter(self.bam_file_name, threads=2, batch_blocks=2)
+        writer.write("BAM\1" + "x" * 200000)
+        offset = writer.tell()
+        writer.write("y")
+        writer.close()
+
+        (data, offsets) = inflate_with_offsets(self.bam_file_name)
+        virtual_offset = writer.virtual_offset(offset)
+
+        self.assertEqual(3, offset >> 16)
+        self.assertEqual("BAM\1" + "x" * 200000 + "y", data)
+        self.assertEqual(200004, offsets[virtual_offset >> 16] + (virtual_offset & 0xffff))
+
+    def test_open_alignment_output(self):
+        sam_file_name = os.path.join(self.directory, "output.sam")
+        for file_name in (sam_file_name, self.bam_file_name):
+            with open_alignment_output(file_name) as writer:
+                writer.write("".join(SAM_HEADER + SAM_RECORDS))
+
+        self.assertFalse(is_bam(sam_file_name))
+        with open_alignments(sam_file_name) as sam_lines, open_alignments(self.bam_file_name) as bam_lines:
+            self.assertEqual(list(sam_lines), list(bam_lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from bin.benchmark import SyntheticData, compare, run_stage, read_baseline, write_results, _split_read_stage
+from bin.cluster_gaps import GapUtility
+from bin.identify_pairs import SamSplitReadBuilder
+from bin.split_read import stanza_generator
+
+
+class SyntheticDataTestCase(unittest.TestCase):
+
+    def test_write_fastq(self):
+        writer = StringIO()
+        SyntheticData(read_len=10).write_fastq(writer, 3)
+
+        stanzas = list(stanza_generator(StringIO(writer.getvalue()), "@"))
+
+        self.assertEqual(3, len(stanzas))
+        self.assertEqual("@read0_1:N:0:ACGT", stanzas[0].main_header)
+        self.assertEqual(10, len(stanzas[2].seq))
+
+    def test_write_fastq_reproducible(self):
+        (writer1, writer2, writer3) = (StringIO(), StringIO(), StringIO())
+        SyntheticData(seed=1).write_fastq(writer1, 5)
+        SyntheticData(seed=1).write_fastq(writer2, 5)
+        SyntheticData(seed=2).write_fastq(writer3, 5)
+
+        self.assertEqual(writer1.getvalue(), writer2.getvalue())
+        self.assertNotEqual(writer1.getvalue(), writer3.getvalue())
+
+    def test_write_split_alignments(self):
+        writer = StringIO()
+        data = SyntheticData(transcript_count=3)
+        data.write_split_alignments(writer, 200)
+        builder = SamSplitReadBuilder(data.read_len)
+
+        lines = [line for line in writer.getvalue().splitlines(True) if not builder.is_header(line)]
+        split_reads = [builder.build(line) for line in lines]
+        keys = {"L": set(), "R": set()}
+        for split_read in split_reads:
+            if split_read.key():
+                keys[split_read._side].add(split_read.key())
+
+        self.assertEqual(200, len(keys["L"]))
+        self.assertTrue(0 < len(keys["L"] & keys["R"]) < 200)
+        self.assertTrue(any(split_read.key() is None for split_read in split_reads))
+        self.assertTrue(len(lines) - 200 > len(keys["R"]))
+
+    def test_write_pair_alignments(self):
+        writer = StringIO()
+        data = SyntheticData()
+        data.write_pair_alignments(writer, 100, samples=("A", "B"))
+        gap_utility = GapUtility(data.read_len, "\t", MockLogger())
+
+        gaps = gap_utility.samfile_to_gaps(writer.getvalue().splitlines(True))
+
+        self.assertEqual(100, len(gaps))
+        self.assertEqual(["A", "B"], sorted(gaps.sample_names()))
+        self.assertTrue(all(gap.gap_width() > 0 for gap in gaps))
+
+
+class CompareTestCase(unittest.TestCase):
+
+    @staticmethod
+    def result(stage="identify_pairs", scale=1000, seconds=10, peak_rss_mb=100):
+        return {"stage": stage, "scale": scale, "seconds": seconds, "peak_rss_mb": peak_rss_mb}
+
+    def test_compare_withinTolerance(self):
+        self.assertEqual([], compare([self.result(seconds=12, peak_rss_mb=120)], [self.result()], tolerance=0.25))
+
+    def test_compare_slower(self):
+        regressions = compare([self.result(seconds=13)], [self.result()], tolerance=0.25)
+        self.assertEqual(["identify_pairs|scale=1000|seconds=13 (baseline 10)"], regressions)
+
+    def test_compare_moreMemory(self):
+        regressions = compare([self.result(peak_rss_mb=200)], [self.result()], tolerance=0.25)
+        self.assertEqual(["identify_pairs|scale=1000|peak_rss_mb=200 (baseline 100)"], regressions)
+
+    def test_compare_ignoresSmallAbsoluteDifferences(self):
+        self.assertEqual([], compare([self.result(seconds=0.2, peak_rss_mb=8)], [self.result(seconds=0.1, peak_rss_mb=4)]))
+
+    def test_compare_ignoresResultsMissingFromBaseline(self):
+        self.assertEqual([], compare([self.result(scale=10, seconds=100)], [self.result()]))
+
+
+class RunStageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_run_stage(self):
+        result = run_stage("split_read", _split_read_stage, 10, self.working_dir)
+
+        self.assertEqual(("split_read", 10), (result["stage"], result["scale"]))
+        self.assertTrue(result["seconds"] > 0)
+        self.assertTrue(result["peak_rss_mb"] > 0)
+        self.assertTrue(os.path.getsize(os.path.join(self.working_dir, "split_read.10", "split_reads.fastq")) > 0)
+
+    def test_write_results_readBaseline(self):
+        file_name = os.path.join(self.working_dir, "baseline.json")
+        results = [CompareTestCase.result()]
+
+        write_results(results, file_name)
+
+        self.assertEqual(results, read_baseline(file_name))
+        self.assertEqual([], read_baseline(os.path.join(self.working_dir, "missing.json")))
+
+
+class MockLogger():
+    def log(self, message):
+        pass
+
+if __name__ == "__main__":
+    unittest.main()
@@ -145,6 +145,48 @@ class ClusterUtilityTestCase(unittest.TestCase):
         #plot_clusters("ENSMUST00000012259", gaps, cluster_utility._dbscan)
 
 
+class AssignTableClustersTestCase(unittest.TestCase):
+
+    def test_assign_table_clusters_clustersEachChromosome(self):
+        table = MockGapTable(
+            ["chrA"] * 4 + ["chrB"] * 3,
+            [42, 42, 42, 900, 10, 11, 12], 5)
+        cluster_utility = DbscanClusterUtility()
+
+        cluster_utility.assign_table_clusters(table)
+
+        self.assertEqual([0, 0, 0, -1, 0, 0, 0], table.cluster.tolist())
+
+    def test_assign_table_clusters_deduplicatesAboveThreshold(self):
+        starts = [42] * 20 + [43] * 20 + [500]
+        table = MockGapTable(["chrA"] * len(starts), starts, 5)
+        cluster_utility = DbscanClusterUtility(deduplication_threshold=10)
+
+        cluster_utility.assign_table_clusters(table)
+
+        self.assertEqual([0] * 40 + [-1], table.cluster.tolist())
+
+    def test_assign_table_clusters_weighted(self):
+        table = MockGapTable(["chrA"] * 3, [42, 43, 900], 5, weights=[2, 1, 1])
+        cluster_utility = DbscanClusterUtility()
+
+        cluster_utility.assign_table_clusters(table)
+
+        self.assertEqual([0, 0, -1], table.cluster.tolist())
+
+    def test_assign_table_clusters_weightedMatchesExpanded(self):
+        starts = [42] * 20 + [43] * 20 + [500]
+        expanded = MockGapTable(["chrA"] * len(starts), starts, 5)
+        collapsed = MockGapTable(["chrA"] * 3, [42, 43, 500], 5, weights=[20, 20, 1])
+        cluster_utility = DbscanClusterUtility(deduplication_threshold=10)
+
+        cluster_utility.assign_table_clusters(expanded)
+        cluster_utility.assign_table_clusters(collapsed)
+
+        self.assertEqual([0, 0, -1], collapsed.cluster.tolist())
+        self.assertEqual(expanded.cluster[[0, 20, 40]].tolist(), collapsed.cluster.tolist())
+
+
 def plot_clusters(title, gaps, dbscan):
     """Renders the clusters to GUI. 
     Note this will not work in a headless environ but could be adapted 
@@ -199,6 +241,33 @@ class MockGap():
     def gap_width(self):
         return self._gap_width
 
+class MockGapTable():
+
+    def __init__(self, chromosomes, gap_starts, gap_width, weights=None):
+        import numpy as np
+        self._chromosomes = chromosomes
+        self.gap_start = np.array(gap_starts)
+        self._gap_width = np.array([gap_width] * len(gap_starts))
+        self.cluster = np.array([-1] * len(gap_starts))
+        self.weight = np.array(weights or [1] * len(gap_starts))
+
+    def gap_width(self):
+        return self._gap_width
+
+    def is_weighted(self):
+        return any(self.weight != 1)
+
+    def chromosome_count(self):
+        return len(set(self._chromosomes))
+
+    def chromosome_slices(self):
+        start = 0
+        for end in range(1, len(self._chromosomes) + 1):
+            if end == len(self._chromosomes) or \
+                    self._chromosomes[end] != self._chromosomes[start]:
+                yield (self._chromosomes[start], start, end)
+                start = end
+
 class MockLogger():
     def log(self, message):
         pass
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from bin.cluster_gaps import Gap, GapTableBuilder, GapUtility, group_file_names
+from bin.gap_store import GapStore, DuplicateSampleError
+
+
+class GapStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add_persistsGapsByChromosome(self):
+        gaps = [Gap("sampleA", "read1-L-1", "chrom2", 0, 10, 20, 64),
+            Gap("sampleA", "read2-L-1", "chrom1", 0, 12, 26, 64)]
+
+        changed = GapStore(self.directory).add(init_table(gaps))
+
+        store = GapStore(self.directory)
+        self.assertEqual(["chrom1", "chrom2"], sorted(changed))
+        self.assertEqual(["chrom1", "chrom2"], store.chromosomes())
+        self.assertEqual(["sampleA"], store.samples())
+        self.assertEqual([gaps[1], gaps[0]], list(store.table()))
+        self.assertEqual([gaps[0]], list(store.table(["chrom2"])))
+
+    def test_add_mergesNewSampleIntoExistingChromosome(self):
+        store = GapStore(self.directory)
+        store.add(init_table([Gap("sampleA", "read1-L-1", "chrom1", 0, 10, 20, 64)]))
+
+        changed = store.add(init_table([Gap("sampleB", "read1-L-1", "chrom1", 0, 5, 20, 64)]))
+
+        self.assertEqual(["chrom1"], changed)
+        self.assertEqual(["sampleB", "sampleA"], [gap.sample for gap in store.table()])
+        self.assertEqual(["sampleA", "sampleB"], store.samples())
+
+    def test_add_raisesOnDuplicateSample(self):
+        store = GapStore(self.directory)
+        store.add(init_table([Gap("sampleA", "read1-L-1", "chrom1", 0, 10, 20, 64)]))
+
+        self.assertRaises(DuplicateSampleError, store.add, 
+            init_table([Gap("sampleA", "read2-L-1", "chrom2", 0, 10, 20, 64)]))
+
+    def test_add_interruptedLeavesStoreUnchanged(self):
+        store = GapStore(self.directory)
+        store.add(init_table([Gap("sampleA", "read1-L-1", "chrom1", 0, 10, 20, 64),
+            Gap("sampleA", "read2-L-1", "chrom2", 0, 10, 20, 64)]))
+        files = sorted(os.listdir(self.directory))
+        sampleB = init_table([Gap("sampleB", "read1-L-1", "chrom1", 0, 5, 20, 64),
+            Gap("sampleB", "read2-L-1", "chrom2", 0, 5, 20, 64)])
+        original_save = store._save
+        def failing_save(index, chromosome, table):
+            if chromosome == "chrom2":
+                raise IOError("disk full")
+            return original_save(index, chromosome, table)
+        store._save = failing_save
+
+        self.assertRaises(IOError, store.add, sampleB)
+
+        store = GapStore(self.directory)
+        self.assertEqual(["sampleA"], store.samples())
+        self.assertEqual(2, len(store.table()))
+        store.add(sampleB)
+        self.assertEqual(4, len(store.table()))
+        self.assertEqual(len(files), len(os.listdir(self.directory)))
+
+    def test_assign_clusters_reclustersOnlyChangedChromosomes(self):
+        store = GapStore(self.directory)
+        store.add(init_table([Gap("sampleA", "read1-L-1", "chrom1", 0, 10, 20, 64),
+            Gap("sampleA", "read2-L-1", "chrom2", 0, 10, 20, 64)]))
+        cluster_utility = MockClusterUtility()
+        self.assertEqual((2, 0), store.assign_clusters(cluster_utility))
+
+        store = GapStore(self.directory)
+        store.add(init_table([Gap("sampleB", "read1-L-1", "chrom2", 0, 10, 20, 64)]))
+        self.assertEqual((1, 1), store.assign_clusters(cluster_utility))
+
+        self.assertEqual([["chrom1"], ["chrom2"], ["chrom2"]], cluster_utility.chromosomes)
+        self.assertEqual([1, 3, 3], [gap.cluster for gap in store.table()])
+        self.assertEqual((0, 2), GapStore(self.directory).assign_clusters(cluster_utility))
+
+    def test_write_outputs_matchesCohortOutputAndReusesUnchangedChromosomes(self):
+        store = GapStore(self.directory)
+        store.add(init_table([Gap("sampleA", "read1-L-1", "chrom1", 0, 10, 20, 64),
+            Gap("sampleA", "read2-L-1", "chrom2", 0, 10, 20, 64)]))
+        store.assign_clusters(MockClusterUtility())
+        gap_utility = GapUtility(50, "\t", MockLogger())
+        gap_file_name = os.path.join(self.directory, "output", "cohort.tab")
+        os.makedirs(os.path.dirname(gap_file_name))
+
+        self.assertEqual(2, store.write_outputs(gap_utility, gap_file_name, ["header"]))
+        self.assertEqual(0, store.write_outputs(gap_utility, gap_file_name, ["header"]))
+        store.add(init_table([Gap("sampleB", "read1-L-1", "chrom2", 0, 5, 20, 64)]))
+        store.assign_clusters(MockClusterUtility())
+        self.assertEqual(1, store.write_outputs(gap_utility, gap_file_name, ["header"]))
+
+        (gap_writer, sample_group_writer, cluster_group_writer) = (StringIO(), StringIO(), StringIO())
+        gap_utility.write_gap_file(store.table(), gap_writer, ["header"])
+        gap_utility.write_group_file(store.table(), sample_group_writer, by_sample=True)
+        gap_utility.write_group_file(store.table(), cluster_group_writer, by_sample=False)
+        for (file_name, writer) in zip((gap_file_name,) + group_file_names(gap_file_name), [gap_writer, sample_group_writer, cluster_group_writer]):
+            with open(file_name) as output_file:
+                self.assertEqual(writer.getvalue(), output_file.read())
+        self.assertEqual(2 + 3, len(gap_writer.getvalue().splitlines()))
+
+
+def init_table(gaps):
+    builder = GapTableBuilder()
+    for gap in gaps:
+        builder.append(gap.sample, gap._split_read_name, gap.chromosome,
+            gap._read_start, gap.gap_start, gap._gap_end, gap._read_end)
+    return builder.build()
+
+class MockClusterUtility():
+    """Assigns each chromosome's gaps a cluster numbered by call order."""
+    def __init__(self):
+        self.chromosomes = []
+
+    def assign_table_clusters(self, gap_table):
+        self.chromosomes.append([chromosome for (chromosome, _, _) in gap_table.chromosome_slices()])
+        gap_table.cluster[:] = len(self.chromosomes)
+
+class MockLogger():
+    def log(self, message):
+        pass
@@ -1,5 +1,9 @@
+import os
+import shutil
+import tempfile
 import unittest
-from bin.identify_pairs import BowtieSplitReadBuilder, LegacySplitReadBuilder, ReadLengthValidator, ReadLengthValidationError, SamSplitReadBuilder, SplitRead, _build_read_groups, _write_rsw_pairs, _write_sam_pairs, _build_pairs_from_groups, _identify_common_group_keys, _filter_pairs, _distance_filter, _orientation_filter, _composite_filter
+import numpy as np
+from bin.identify_pairs import BowtieSplitReadBuilder, LegacySplitReadBuilder, ReadLengthValidator, ReadLengthValidationError, PairIndex, SamSplitReadBuilder, SplitRead, _build_read_groups, _write_rsw_pairs, _write_sam_pairs, _build_pairs_from_groups, _identify_common_group_keys, _filter_pairs, _distance_filter, _orientation_filter, _composite_filter, _bounds_filter, GroupKeyBounds, SpilledGroupKeyBounds, KeyHashSet, KeyBloomFilter, identify_read_group_pairs, mate_inputs, open_split_alignments
 
 
 class LegacySplitReadBuilderTestCase(unittest.TestCase):
@@ -61,6 +65,31 @@ class SamSplitReadBuilderTestCase(unittest.TestCase):
     def test_build_raisesOnMalformedInput(self):
         builder = BowtieSplitReadBuilder(30,"|")
         self.assertRaises(Exception, builder.build, "name|L|10")
+
+    def test_key(self):
+        builder = SamSplitReadBuilder(30, "|")
+        lines = ["hw1:name-L-10|16|chr|100|25|cigar|*|0|0|GCAGT|DDDCC@|NM:i:0  X0:i:1",
+            "hw1:name-R-20|16|chr|100|25|cigar|*|0|0|GCAGT|DDDCC@|NM:i:0  X0:i:1",
+            "hw1-L-2:name-L-010|0|chr|100|25|cigar|*|0|0|GCAGT|DDDCC@\n",
+            "hw1:name-R-7|0|chr|100|25|cigar|*|0|0|GCAGT|DDDCC@\n"]
+
+        for line in lines:
+            self.assertEqual(builder.build(line).key(), builder.key(line))
+        self.assertEqual("hw1:name|L|10|-|chr", builder.key(lines[1]))
+
+    def test_key_prefixedByMate(self):
+        builder = SamSplitReadBuilder(30, "|")
+        line = "hw1:name-R-20|16|chr|100|25|cigar|*|0|0|GCAGT|DDDCC@|NM:i:0  X0:i:1"
+
+        builder.set_mate("R2")
+        self.assertEqual("R2|hw1:name|L|10|-|chr", builder.key(line))
+        self.assertEqual(builder.build(line).key(), builder.key(line))
+        builder.set_mate("")
+        self.assertEqual("hw1:name|L|10|-|chr", builder.key(line))
+
+    def test_key_unalignedIsNone(self):
+        builder = SamSplitReadBuilder(30, "|")
+        self.assertEqual(None, builder.key("hw1:name-R-20|4|*|0|0|*|*|0|0|GCAGT|DDDCC@\n"))
         
         
 class SplitReadTestCase(unittest.TestCase):
@@ -89,12 +118,37 @@ class SplitReadTestCase(unittest.TestCase):
         self.assertEqual(15, srL2.gap_distance(srR2))
         self.assertEqual(15, srR2.gap_distance(srL2))
         
+    def test_gap_edge(self):
+        srL1 = SplitRead(**initParams({'position':25, 'split_len':60, 'strand':"+", 'side':"L", 'original_read_len':200}))
+        srR1 = SplitRead(**initParams({'position':100, 'split_len':40, 'strand':"+", 'side':"R", 'original_read_len':200}))
+        self.assertEqual(srL1.gap_distance(srR1), srR1.gap_edge() - srL1.gap_edge())
+
+        srL2 = SplitRead(**initParams({'position':100, 'split_len':40, 'strand':"-", 'side':"L", 'original_read_len':200}))
+        srR2 = SplitRead(**initParams({'position':55, 'split_len':30, 'strand':"-", 'side':"R", 'original_read_len':200}))
+        self.assertEqual(srL2.gap_distance(srR2), srR2.gap_edge() - srL2.gap_edge())
+
+    def test_gap_edge_misorientedPairIsNegative(self):
+        left = SplitRead(**initParams({'side':"L", 'position': 100, 'split_len':10, 'strand':"+"}))
+        right = SplitRead(**initParams({'side':"R", 'position': 50, 'strand':"+"}))
+        self.assertTrue(right.gap_edge() - left.gap_edge() < 0)
+
+        left = SplitRead(**initParams({'side':"L", 'position': 50, 'strand':"-"}))
+        right = SplitRead(**initParams({'side':"R", 'position': 100, 'split_len':10, 'strand':"-"}))
+        self.assertTrue(right.gap_edge() - left.gap_edge() < 0)
+
     def test_key_leftKeyPassesThrough(self):
         read_len = 30
         builder = LegacySplitReadBuilder(read_len, "-")
         split_read = builder.build("name-L-10-strand-chr-100-seq-quality-5-foo-bar\n")
         self.assertEqual("name|L|10|strand|chr", split_read.key())
 
+    def test_key_mateKeepsMatesDistinct(self):
+        params = {'name': "name", 'side': "L", 'split_len': 10, 'strand': "+", 'chromosome': "chr", 'position': 100, 'matches': None, 'original_read_len': 30}
+        read1 = SplitRead(mate="R1", **params)
+        read2 = SplitRead(mate="R2", **params)
+        self.assertEqual("R1|name|L|10|+|chr", read1.key())
+        self.assertNotEqual(read1.key(), read2.key())
+
     def test_key_rightKeySwitchesSideAndSplitLength(self):
         read_len = 30
         builder = LegacySplitReadBuilder(read_len, "-")
@@ -147,6 +201,72 @@ class SplitReadTestCase(unittest.TestCase):
         self.assertEqual("readA-L-10", left.left_name())
         self.assertEqual("readA-L-10", right.left_name())
         
+    def test_gap_fields(self):
+        left = SplitRead(**initParams({'name':'readA', 'side':"L", 'split_len': 10, 'chromosome': "chr1", 'position': 100, 'original_read_len': 33}))
+        right = SplitRead(**initParams({'name':'readA', 'side':"R", 'split_len': 23, 'chromosome': "chr1", 'position': 150, 'original_read_len': 33}))
+        self.assertEqual(("readA-L-10", "chr1", 100, 110, 150, 173), left.gap_fields(right))
+        self.assertEqual(("readA-L-10", "chr1", 100, 110, 150, 173), right.gap_fields(left))
+
+    def test_gap_fields_rightSideLeftmost(self):
+        left = SplitRead(**initParams({'name':'readA', 'side':"L", 'split_len': 10, 'strand': "-", 'position': 150, 'original_read_len': 33}))
+        right = SplitRead(**initParams({'name':'readA', 'side':"R", 'split_len': 23, 'strand': "-", 'position': 100, 'original_read_len': 33}))
+        self.assertEqual(("readA-L-10", "chr", 100, 123, 150, 160), left.gap_fields(right))
+
+    def test_gap_fields_samePositionReturnsNone(self):
+        left = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 100}))
+        right = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 100}))
+        self.assertEqual(None, left.gap_fields(right))
+
+    def test_leftmost_gap_fields(self):
+        left = SplitRead(**initParams({'name':'readA', 'side':"L", 'split_len': 10, 'position': 100, 'original_read_len': 33}))
+        right1 = SplitRead(**initParams({'name':'readA', 'side':"R", 'split_len': 23, 'position': 150, 'original_read_len': 33}))
+        right2 = SplitRead(**initParams({'name':'readA', 'side':"R", 'split_len': 23, 'position': 50, 'original_read_len': 33}))
+        read_group_pairs = {left.key(): [(left, right1), (left, right2)]}
+
+        pair_index = PairIndex(read_group_pairs)
+
+        self.assertEqual([left.gap_fields(right1)], left.leftmost_gap_fields(pair_index))
+        self.assertEqual([], right1.leftmost_gap_fields(pair_index))
+        self.assertEqual([right2.gap_fields(left)], right2.leftmost_gap_fields(pair_index))
+        self.assertEqual([], left.leftmost_gap_fields(PairIndex({})))
+
+
+    def test_identity(self):
+        split_read = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 10}))
+        same_read = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 10}))
+        other_position = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 11}))
+        other_side = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 10, 'split_len': 33 - 10}))
+
+        self.assertEqual(split_read.identity(), same_read.identity())
+        self.assertEqual(split_read.key(), other_side.key())
+        self.assertNotEqual(split_read.identity(), other_position.identity())
+        self.assertNotEqual(split_read.identity(), other_side.identity())
+
+    def test_duplicate_count(self):
+        self.assertEqual(1, SplitRead(**initParams({'name':'readA'})).duplicate_count())
+        self.assertEqual(12, SplitRead(**initParams({'name':'readA;size=12'})).duplicate_count())
+
+    def test_pair_index(self):
+        left = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 100, 'split_len': 33 - 10}))
+        right1 = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 150}))
+        right2 = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 50}))
+        other = SplitRead(**initParams({'name':'readB', 'side':"L", 'position': 100}))
+        pair_index = PairIndex({left.key(): [(left, right1), (left, right2)]})
+
+        self.assertEqual([(right1, True), (right2, True)], pair_index.pairs(left))
+        self.assertEqual([(left, False)], pair_index.pairs(right2))
+        self.assertFalse(pair_index.pairs(other))
+
+    def test_pair_index_indexesLargeReadGroups(self):
+        left1 = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 100, 'split_len': 33 - 10}))
+        left2 = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 200, 'split_len': 33 - 10}))
+        rights = [SplitRead(**initParams({'name':'readA', 'side':"R", 'position': position})) for position in range(10, 100)]
+        pairs = [(left, right) for left in (left1, left2) for right in rights]
+        pair_index = PairIndex({left1.key(): pairs})
+        copy_of_right = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 42}))
+
+        self.assertEqual([(right, True) for right in rights], pair_index.pairs(left2))
+        self.assertEqual([(left1, False), (left2, False)], pair_index.pairs(copy_of_right))
 
     def test_write_sam_pairs_skipsOrphanedLines(self):
         writer = MockWriter()
@@ -158,7 +278,7 @@ class SplitReadTestCase(unittest.TestCase):
         read_group_pairs = {read_group_key:[(leftA, rightA, 5)]}
 
         split_read_from_file = SplitRead(**initParams({'name':'readB', 'side':"L", 'position': 10}))
-        split_read_from_file.write_sam_pairs(read_group_pairs, "line", writer)
+        split_read_from_file.write_sam_pairs(PairIndex(read_group_pairs), "line", writer)
         
         self.assertEqual(0, len(writer.lines()))
 
@@ -172,7 +292,7 @@ class SplitReadTestCase(unittest.TestCase):
         read_group_pairs = {read_group_key:[(leftA, rightA, 5)]}
 
         split_read_from_file = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 999}))
-        split_read_from_file.write_sam_pairs(read_group_pairs, "line\t"*12, writer)
+        split_read_from_file.write_sam_pairs(PairIndex(read_group_pairs), "line\t"*12, writer)
         
         self.assertEqual(0, len(writer.lines()))
         
@@ -187,7 +307,7 @@ class SplitReadTestCase(unittest.TestCase):
         read_group_pairs = {read_group_key:[(leftA5, rightA10), (leftA5, rightA15)]}
 
         split_read_from_file = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 5}))
-        split_read_from_file.write_sam_pairs(read_group_pairs, stub_line+"\n", writer, "|")
+        split_read_from_file.write_sam_pairs(PairIndex(read_group_pairs), stub_line+"\n", writer, "|")
         
         actual_lines = writer.lines()
         self.assertEqual(2, len(actual_lines))
@@ -202,15 +322,39 @@ class SplitReadTestCase(unittest.TestCase):
         read_group_pairs = {read_group_key:[(left_read, right_read)]}
 
         first_split_read_from_file = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 5000, 'split_len':15, 'original_read_len':100}))
-        first_split_read_from_file.write_sam_pairs(read_group_pairs, input_line+"\n", writer,"|")
+        first_split_read_from_file.write_sam_pairs(PairIndex(read_group_pairs), input_line+"\n", writer,"|")
         second_split_read_from_file = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 5200, 'split_len':85, 'original_read_len':100}))
-        second_split_read_from_file.write_sam_pairs(read_group_pairs, input_line+"\n", writer,"|")
+        second_split_read_from_file.write_sam_pairs(PairIndex(read_group_pairs), input_line+"\n", writer,"|")
         
         actual_lines = writer.lines()
         self.assertEqual(2, len(actual_lines))
         self.assertEqual("readA-L-15|67|chr12|5000|255|42M|=|5200|200|TCACC|DDDDD|XA:i:0", actual_lines[0])
         self.assertEqual("readA-L-15|131|chr12|5200|255|42M|=|5000|-200|TCACC|DDDDD|XA:i:0", actual_lines[1])
 
+    def test_write_sam_pairs_appendsReadGroupTag(self):
+        writer = MockWriter()
+        input_line = "readA|147|chr12|5|255|42M|*|0|0|TCACC|DDDDD|XA:i:0|MD:Z:5"
+        left_read = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 5000, 'split_len':15, 'original_read_len':100}))
+        right_read = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 5200, 'split_len':85, 'original_read_len':100}))
+        read_group_pairs = {left_read.key():[(left_read, right_read)]}
+
+        left_read.write_sam_pairs(PairIndex(read_group_pairs), input_line+"\n", writer, "|", "RG:Z:rg1")
+
+        self.assertEqual(["readA-L-15|67|chr12|5000|255|42M|=|5200|200|TCACC|DDDDD|XA:i:0|MD:Z:5|RG:Z:rg1"], writer.lines())
+
+    def test_write_sam_pairs_appendsReadGroupTagWithoutOptionalFields(self):
+        writer = MockWriter()
+        input_line = "readA|147|chr12|5|255|42M|*|0|0|TCACC|DDDDD"
+        left_read = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 5000, 'split_len':15, 'original_read_len':100}))
+        right_read = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 5200, 'split_len':85, 'original_read_len':100}))
+        read_group_pairs = {left_read.key():[(left_read, right_read)]}
+
+        left_read.write_sam_pairs(PairIndex(read_group_pairs), input_line+"\r\n", writer, "|", "RG:Z:rg1")
+        left_read.write_sam_pairs(PairIndex(read_group_pairs), input_line+"\n", writer, "|")
+
+        self.assertEqual("readA-L-15|67|chr12|5000|255|42M|=|5200|200|TCACC|DDDDD|RG:Z:rg1\n"
+            "readA-L-15|67|chr12|5000|255|42M|=|5200|200|TCACC|DDDDD\n", "".join(writer._content))
+
     def test_write_sam_pairs_writesNegativeStrandSamLines(self):
         writer = MockWriter()
         input_line = "readA|147|chr12|5|255|42M|*|0|0|TCACC|DDDDD|XA:i:0"
@@ -221,9 +365,9 @@ class SplitReadTestCase(unittest.TestCase):
         read_group_pairs = {read_group_key:[(left_read, right_read)]}
 
         first_split_read_from_file = SplitRead(**initParams({'name':'readA', 'side':"L", 'position': 5200, 'split_len':15, 'original_read_len':100}))
-        first_split_read_from_file.write_sam_pairs(read_group_pairs, input_line+"\n", writer,"|")
+        first_split_read_from_file.write_sam_pairs(PairIndex(read_group_pairs), input_line+"\n", writer,"|")
         second_split_read_from_file = SplitRead(**initParams({'name':'readA', 'side':"R", 'position': 5000, 'split_len':85, 'original_read_len':100}))
-        second_split_read_from_file.write_sam_pairs(read_group_pairs, input_line+"\n", writer,"|")
+        second_split_read_from_file.write_sam_pairs(PairIndex(read_group_pairs), input_line+"\n", writer,"|")
         
         actual_lines = writer.lines()
         self.assertEqual(2, len(actual_lines))
@@ -258,18 +402,171 @@ class SplitReadTestCase(unittest.TestCase):
         self.assertEqual(([left10, left15], [right30]), read_groups[read_group_key])
 
     def test_add_to_group_keys(self):
-        group_keys = {'L':set(), 'R':set()}
+        group_keys = {'L':GroupKeyBounds(), 'R':GroupKeyBounds()}
         readA10 = SplitRead(**initParams({'name':'readA', 'side':"L", 'position':10}))
         readA15 = SplitRead(**initParams({'name':'readA', 'side':"L", 'position':15}))
+        readA12 = SplitRead(**initParams({'name':'readA', 'side':"L", 'position':12}))
         readB30 = SplitRead(**initParams({'name':'readB', 'side':"R", 'position':30}))
         
         readA10.add_to_group_keys(group_keys)
         readA15.add_to_group_keys(group_keys)
+        readA12.add_to_group_keys(group_keys)
         readB30.add_to_group_keys(group_keys)
         
-        self.assertEqual(2, len(group_keys))
-        self.assertEqual(set([readA10.key(), readA15.key()]), group_keys["L"])
-        self.assertEqual(set([readB30.key()]), group_keys["R"])
+        self.assertEqual((1, 1), (len(group_keys["L"]), len(group_keys["R"])))
+        self.assertEqual((20, 25), group_keys["L"].get(readA10.key()))
+        self.assertEqual((30, 30), group_keys["R"].get(readB30.key()))
+
+
+class GroupKeyBoundsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    @staticmethod
+    def add_keys(left, right):
+        for i in range(3000):
+            left.add("key{0}".format(i), i)
+            left.add("key{0}".format(i), i + 5)
+            if i % 3 == 0:
+                right.add("key{0}".format(i), i + 10)
+            if i % 3 == 1:
+                right.add("key{0}".format(i), i + 1000)
+        right.add("rightOnly", 0)
+
+    def test_add_packsNegativeAndLargeEdges(self):
+        bounds = GroupKeyBounds()
+        for edge in [7, -3, 250000000, 0]:
+            bounds.add("key", edge)
+
+        self.assertEqual((-3, 250000000), bounds.get("key"))
+        self.assertEqual(None, bounds.get("missing"))
+
+    def test_intersection(self):
+        (left, right) = (GroupKeyBounds(), GroupKeyBounds())
+        self.add_keys(left, right)
+
+        (common_keys, pruned_count) = left.intersection(right, _bounds_filter(2, 100))
+
+        self.assertEqual(set("key{0}".format(i) for i in range(0, 3000, 3)), common_keys)
+        self.assertEqual(1000, pruned_count)
+
+    def test_intersection_noFilter(self):
+        (left, right) = (GroupKeyBounds(), GroupKeyBounds())
+        self.add_keys(left, right)
+
+        (common_keys, pruned_count) = left.intersection(right)
+
+        self.assertEqual((2000, 0), (len(common_keys), pruned_count))
+
+    def test_spilled_intersection_matchesInMemory(self):
+        (left, right) = (GroupKeyBounds(), GroupKeyBounds())
+        self.add_keys(left, right)
+        spilled_left = SpilledGroupKeyBounds(self.spill_dir, "L", 1024 * 64)
+        spilled_right = SpilledGroupKeyBounds(self.spill_dir, "R", 1024 * 64)
+        self.add_keys(spilled_left, spilled_right)
+
+        (expected_keys, expected_pruned_count) = left.intersection(right, _bounds_filter(2, 100))
+        (common_keys, pruned_count) = spilled_left.intersection(spilled_right, _bounds_filter(2, 100))
+
+        self.assertTrue(len(os.listdir(self.spill_dir)) > 2)
+        self.assertEqual(expected_pruned_count, pruned_count)
+        self.assertEqual(len(expected_keys), len(common_keys))
+        for key in expected_keys:
+            self.assertTrue(key in common_keys)
+        self.assertFalse("key1" in common_keys)
+        self.assertFalse("rightOnly" in common_keys)
+
+    def test_spilled_combinesBoundsAcrossRuns(self):
+        (left, right) = (SpilledGroupKeyBounds(self.spill_dir, "L", 0), SpilledGroupKeyBounds(self.spill_dir, "R", 0))
+        left.add("key", 500)
+        for i in range(2000):
+            left.add("filler{0}".format(i), 0)
+        left.add("key", 100)
+        right.add("key", 550)
+
+        (common_keys, pruned_count) = left.intersection(right, _bounds_filter(2, 100))
+
+        self.assertEqual((1, 0), (len(common_keys), pruned_count))
+        self.assertTrue("key" in common_keys)
+
+    def test_key_bloom_filter(self):
+        keys = set("key{0}".format(i) for i in range(1000))
+        bloom_filter = KeyBloomFilter.from_keys(keys)
+
+        for key in keys:
+            self.assertTrue(key in bloom_filter)
+        false_positives = sum(1 for i in range(10000) if "other{0}".format(i) in bloom_filter)
+        self.assertTrue(false_positives < 500, false_positives)
+
+    def test_key_bloom_filter_fromKeyHashSet(self):
+        key_hash_set = KeyHashSet(np.array(sorted([hash("a"), hash("b")]), dtype=np.int64))
+        bloom_filter = KeyBloomFilter.from_keys(key_hash_set)
+
+        self.assertTrue("a" in bloom_filter)
+        self.assertTrue("b" in bloom_filter)
+        self.assertFalse("c" in KeyBloomFilter.from_keys(set()))
+
+    def test_key_hash_set(self):
+        key_hash_set = KeyHashSet(np.array(sorted([hash("a"), hash("b")]), dtype=np.int64))
+
+        self.assertEqual(2, len(key_hash_set))
+        self.assertTrue("a" in key_hash_set)
+        self.assertTrue("b" in key_hash_set)
+        self.assertFalse("c" in key_hash_set)
+        self.assertFalse("c" in KeyHashSet(np.array([], dtype=np.int64)))
+
+
+class IdentifyReadGroupPairsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_file_name = os.path.join(self.directory, "input.sam")
+        line = "read{0}-{1}-{2}\t0\tchr{3}\t{4}\t255\t{2}M\t*\t0\t0\t{5}\t{5}\n"
+        with open(self.input_file_name, "w") as input_file:
+            input_file.write("@HD\tVN:1.0\n")
+            for i in range(2000):
+                input_file.write(line.format(i, "L", 8, i % 7, 100 + i, "A" * 8))
+                if i % 4 != 0:
+                    input_file.write(line.format(i, "R", 12, i % 7, 100 + i + (i % 300), "C" * 12))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_mate_inputs(self):
+        self.assertEqual([("", "a.sam")], mate_inputs("a.sam"))
+        self.assertEqual([("R1", "a.sam")], mate_inputs("R1=a.sam"))
+        self.assertEqual([("R1", "a.sam"), ("R2", "b.sam")], mate_inputs("R1=a.sam,R2=b.sam"))
+        self.assertEqual([("R1", "a.sam"), ("R2", "b.sam")], mate_inputs("a.sam,b.sam"))
+
+    def test_open_split_alignments_setsMatePerInput(self):
+        builder = SamSplitReadBuilder(20)
+        with open_split_alignments("R1={0},R2={0}".format(self.input_file_name), builder) as reader:
+            keys = [builder.key(line) for line in reader if not builder.is_header(line)]
+
+        self.assertEqual(len(keys) // 2, len([key for key in keys if key.startswith("R1|")]))
+        self.assertEqual("R2|read1999|L|8|+|chr4", keys[-1])
+
+    def test_identify_read_group_pairs_jointMatesPairSeparately(self):
+        single = identify_read_group_pairs(20, self.input_file_name, 2, 200, MockLogger())
+
+        joint = identify_read_group_pairs(20, "R1={0},R2={0}".format(self.input_file_name), 2, 200, MockLogger())
+
+        self.assertEqual(2 * len(single), len(joint))
+        for mate in ["R1", "R2"]:
+            self.assertEqual(sorted(single), sorted(key[len(mate) + 1:] for key in joint if key.startswith(mate + "|")))
+
+    def test_identify_read_group_pairs_spilledMatchesInMemory(self):
+        expected = identify_read_group_pairs(20, self.input_file_name, 2, 200, MockLogger())
+
+        actual = identify_read_group_pairs(20, self.input_file_name, 2, 200, MockLogger(), max_memory_mb=1, spill_dir=self.directory)
+
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(expected, actual)
+        self.assertEqual(["input.sam"], os.listdir(self.directory))
 
 
 class ReadLengthValidatorTestCase(unittest.TestCase):
@@ -333,6 +630,18 @@ class IdentifyPairsTestCase(unittest.TestCase):
 
         self.assertEqual(0, len(group_keys))
 
+    def test_identify_common_group_keys_excludesKeysOutOfBounds(self):
+        near_left = MockSplitRead("near", "L", gap_edge=100)
+        near_right = MockSplitRead("near", "R", gap_edge=110)
+        far_left = MockSplitRead("far", "L", gap_edge=100)
+        far_right = MockSplitRead("far", "R", gap_edge=500)
+        builder = MockSplitReadBuilder({'read1': near_left, 'read2': near_right, 'read3': far_left, 'read4': far_right})
+        reader = ["read1", "read2", "read3", "read4"]
+
+        group_keys = _identify_common_group_keys(builder, MockValidator(), reader, MockLogger(), _bounds_filter(2, 100))
+
+        self.assertEqual(set(["near"]), group_keys)
+
     def test_build_read_groups_twoDistinctReads(self):
         read1 = MockSplitRead("key1", "L")
         read2 = MockSplitRead("key2", "R")
@@ -346,6 +655,17 @@ class IdentifyPairsTestCase(unittest.TestCase):
         self.assertEqual(([read1],[]), pairs["key1"])
         self.assertEqual(([],[read2]), pairs["key2"])
 
+    def test_build_read_groups_keyFilterSkipsLines(self):
+        read1 = MockSplitRead("key1", "L")
+        read2 = MockSplitRead("key2", "R")
+        split_read_builder = MockSplitReadBuilder({'read1':read1, 'read2':read2, 'unaligned':MockSplitRead(None, "L")})
+        reader = ["read1", "read2", "unaligned"]
+
+        pairs = _build_read_groups(set(["key1", "key2"]), split_read_builder, reader, MockLogger(), set(["key1"]))
+
+        self.assertEqual({"key1": ([read1], [])}, pairs)
+        self.assertEqual(["read1"], split_read_builder.built_lines)
+
     def test_build_read_groups_skipsHeaderLines(self):
         read1 = MockSplitRead("key1", "L")
         read2 = MockSplitRead("key1", "L")
@@ -359,12 +679,13 @@ class IdentifyPairsTestCase(unittest.TestCase):
 
     def test_write_rsw_pairs(self):
         writer = MockWriter()
-        leftA = MockSplitRead("key1", "L", "leftA", "leftFormattedRead", 5)
-        rightA = MockSplitRead("key1", "L", "rightA", "rightFormattedRead")     
+        leftA = MockSplitRead("key1", "L", "leftA", "leftFormattedRead", 5, duplicate_count=3)
+        rightA = MockSplitRead("key1", "L", "rightA", "rightFormattedRead", duplicate_count=3)     
         pairs = {'key1': [(leftA, rightA)]}
         
-        _write_rsw_pairs(pairs, writer, MockLogger(), "|")  
+        counts = _write_rsw_pairs(pairs, writer, MockLogger(), "|")  
         
+        self.assertEqual((1, 3), counts)
         self.assertEqual(1, len(writer.lines()))
         self.assertEqual(["leftFormattedRead|rightFormattedRead|5"], writer.lines())
 
@@ -382,6 +703,26 @@ class IdentifyPairsTestCase(unittest.TestCase):
         self.assertEqual("@header1", actual_lines[0])
         self.assertEqual("@header2", actual_lines[1])
 
+    def test_write_sam_pairs_addsReadGroup(self):
+        reader = ["@HD\n", "@PG\n", "line1\n"]
+        read1 = MockSplitRead("key1", "L")
+        builder = MockSplitReadBuilder({'line1': read1}, set(["@HD", "@PG"]))
+        writer = MockWriter()
+
+        _write_sam_pairs({}, reader, builder, writer, MockLogger(), "|", ("rg1", "sampleA"))
+
+        self.assertEqual(["@HD", "@RG|ID:rg1|SM:sampleA", "@PG"], writer.lines())
+        self.assertEqual("RG:Z:rg1", read1.read_group_tag)
+
+    def test_write_sam_pairs_addsReadGroupWithoutProgramHeader(self):
+        reader = ["@HD\n", "line1\n"]
+        builder = MockSplitReadBuilder({'line1': MockSplitRead("key1", "L")}, set(["@HD"]))
+        writer = MockWriter()
+
+        _write_sam_pairs({}, reader, builder, writer, MockLogger(), "|", ("rg1", "sampleA"))
+
+        self.assertEqual(["@HD", "@RG|ID:rg1|SM:sampleA"], writer.lines())
+
     def test_write_sam_pairs(self):
         reader = ["line1\n", "line2\n"]
         read1 = MockSplitRead("key1", "L")
@@ -459,6 +800,18 @@ class IdentifyPairsTestCase(unittest.TestCase):
         self.assertEqual(False, _orientation_filter(left1, right))
         self.assertEqual(True, _orientation_filter(left2, right))
 
+    def test_bounds_filter(self):
+        filter = _bounds_filter(5, 10)
+
+        self.assertEqual(True, filter([100, 100], [105, 105]))
+        self.assertEqual(True, filter([100, 100], [110, 110]))
+        self.assertEqual(False, filter([100, 100], [104, 104]))
+        self.assertEqual(False, filter([100, 100], [111, 111]))
+        self.assertEqual(True, filter([90, 100], [104, 104]))
+        self.assertEqual(True, filter([100, 110], [80, 106]))
+        self.assertEqual(False, filter([100, 110], [80, 104]))
+        self.assertEqual(False, filter([100, 110], [121, 130]))
+
     def test_composite_filter(self):
         def filter1(read1, read2):
             return read1 == read1.upper()
@@ -504,14 +857,16 @@ class MockPairRowFormatter():
 
         
 class MockSplitRead():
-    def __init__(self, key, side, name = "name", format = "format", distance=42, split_len=33):
+    def __init__(self, key, side, name = "name", format = "format", distance=42, split_len=33, gap_edge=0, duplicate_count=1):
         
         self._key = key
+        self._duplicate_count = duplicate_count
         self._name = name
         self._side = side
         self._format = format
         self._distance = distance
         self.split_len = split_len
+        self._gap_edge = gap_edge
         self.write_sam_pairs_called = 0
         self._is_oriented = False
 
@@ -524,14 +879,18 @@ class MockSplitRead():
     def key(self):
         return self._key
 
+    def duplicate_count(self):
+        return self._duplicate_count
+
     def __repr__(self):
         return self._name
 
     def is_oriented(self, other):       
         return self._is_oriented
 
-    def write_sam_pairs(self, read_group_pairs, line, writer, delimiter):
+    def write_sam_pairs(self, read_group_pairs, line, writer, delimiter, read_group_tag=""):
         self.write_sam_pairs_called += 1
+        self.read_group_tag = read_group_tag
 
     def add_to_read_groups(self, common_keys, read_groups):
         read_group = read_groups.setdefault(self._key, ([], [])) 
@@ -539,7 +898,7 @@ class MockSplitRead():
         read_group[index].append(self)
         
     def add_to_group_keys(self, group_keys):
-        group_keys[self._side].add(self._key)
+        group_keys[self._side].add(self._key, self._gap_edge)
         
     def check_split_length(self, validator): 
         pass
@@ -548,9 +907,14 @@ class MockSplitReadBuilder():
     def __init__(self, split_reads, headers=set()):
         self._split_reads = split_reads
         self._headers = headers 
+        self.built_lines = []
     def build(self, line):
+        self.built_lines.append(line.rstrip())
         return self._split_reads[line.rstrip()]
 
+    def key(self, line):
+        return self._split_reads[line.rstrip()].key()
+
     def is_header(self, line):
         return line.rstrip() in self._headers
 
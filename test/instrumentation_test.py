@@ -0,0 +1,172 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from bin.instrumentation import Metrics, PeakMemorySampler, Stage, StdErrLogger, metrics_for, METRICS_DIR_ENV
+
+
+class StdErrLoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_stderr = sys.stderr
+        sys.stderr = MockWriter()
+
+    def tearDown(self):
+        sys.stderr = self.original_stderr
+
+    def test_log(self):
+        StdErrLogger().log("hoopy frood")
+        self.assertTrue(sys.stderr.value().endswith("|hoopy frood\n"))
+        self.assertNotIn("peak_memory_used", sys.stderr.value())
+
+    def test_log_verboseIncludesUsageAndCaller(self):
+        StdErrLogger(verbose=True).log("hoopy frood")
+        self.assertIn("peak_memory_used(mb)=", sys.stderr.value())
+        self.assertIn("|test_log_verboseIncludesUsageAndCaller|hoopy frood\n", sys.stderr.value())
+
+    def test_log_verboseOverride(self):
+        StdErrLogger(verbose=True).log("hoopy frood", verbose=False)
+        self.assertNotIn("peak_memory_used", sys.stderr.value())
+
+
+class StageTestCase(unittest.TestCase):
+
+    def test_count(self):
+        stage = Stage("foo")
+        stage.count("lines")
+        stage.count("lines", 41)
+        self.assertEqual({"lines": 42}, stage.counts)
+
+    def test_counted(self):
+        stage = Stage("foo")
+        self.assertEqual(["a", "b"], list(stage.counted(iter(["a", "b"]), "lines")))
+        self.assertEqual({"lines": 2}, stage.counts)
+
+    def test_summary(self):
+        stage = Stage("foo")
+        stage.seconds = 2.0
+        stage.count("lines", 10)
+        summary = stage.summary()
+        self.assertEqual({"lines": 10}, summary["counts"])
+        self.assertEqual({"lines_per_second": 5.0}, summary["rates"])
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stage(self):
+        clock = MockClock([0, 10, 13, 20, 21, 30])
+        metrics = Metrics("foo", clock=clock)
+        with metrics.stage("parse") as stage:
+            stage.count("lines", 6)
+        with metrics.stage("parse"):
+            pass
+
+        summary = metrics.summary()
+        stages = summary["stages"]
+        self.assertEqual(30, summary["wall_seconds"])
+        self.assertEqual(1, len(stages))
+        self.assertEqual("parse", stages[0]["stage"])
+        self.assertEqual(2, stages[0]["calls"])
+        self.assertEqual(4, stages[0]["seconds"])
+        self.assertEqual({"lines_per_second": 1.5}, stages[0]["rates"])
+
+    def test_stage_recordsTimeWhenBlockRaises(self):
+        metrics = Metrics("foo", clock=MockClock([0, 1, 3, 4]))
+        try:
+            with metrics.stage("parse"):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(2, metrics.summary()["stages"][0]["seconds"])
+
+    def test_stage_usesSamplerPeak(self):
+        metrics = Metrics("foo", sampler=MockSampler(42))
+        with metrics.stage("parse"):
+            pass
+        self.assertEqual(42, metrics.summary()["stages"][0]["peak_rss_mb"])
+
+    def test_count(self):
+        metrics = Metrics("foo")
+        metrics.count("samples", 2)
+        self.assertEqual({"samples": 2}, metrics.summary()["counts"])
+
+    def test_write_json(self):
+        metrics = Metrics("foo")
+        with metrics.stage("parse"):
+            pass
+        file_name = os.path.join(self.directory, "metrics.json")
+
+        metrics.write_json(file_name)
+
+        with open(file_name, "r") as metrics_file:
+            summary = json.load(metrics_file)
+        self.assertEqual("foo", summary["name"])
+        self.assertEqual(["parse"], [stage["stage"] for stage in summary["stages"]])
+        self.assertTrue(summary["peak_rss_mb"] > 0)
+
+    def test_metrics_for_withoutEnvironment(self):
+        metrics = metrics_for("foo", environ={})
+        self.assertEqual("foo", metrics.name)
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_metrics_for_createsMetricsDirectory(self):
+        metrics_dir = os.path.join(self.directory, "metrics")
+        exit_calls = []
+        metrics = metrics_for("foo", environ={METRICS_DIR_ENV: metrics_dir}, at_exit=lambda *args: exit_calls.append(args))
+        self.assertEqual("foo", metrics.name)
+        self.assertTrue(os.path.isdir(metrics_dir))
+
+        (write_json, file_name) = exit_calls[0]
+        write_json(file_name)
+        self.assertEqual([os.path.basename(file_name)], os.listdir(metrics_dir))
+        self.assertTrue(os.path.basename(file_name).startswith("foo."))
+
+
+class PeakMemorySamplerTestCase(unittest.TestCase):
+
+    def test_reset(self):
+        sampler = PeakMemorySampler(interval=0.01)
+        sampler.start()
+        try:
+            self.assertTrue(sampler.reset() > 0)
+        finally:
+            sampler.stop()
+
+
+class MockClock():
+    def __init__(self, times):
+        self._times = list(times)
+
+    def __call__(self):
+        return self._times.pop(0)
+
+
+class MockSampler():
+    def __init__(self, peak):
+        self._peak = peak
+
+    def reset(self):
+        return self._peak
+
+
+class MockWriter():
+    def __init__(self):
+        self._values = []
+
+    def write(self, value):
+        self._values.append(value)
+
+    def value(self):
+        return "".join(self._values)
+
+
+if __name__ == "__main__":
+    unittest.main()
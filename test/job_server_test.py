@@ -0,0 +1,114 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from bin import job_server
+from bin.job_server import job_script, submit, _listen, ServerRunningError, UnknownJobError
+
+
+class JobScriptTestCase(unittest.TestCase):
+
+    def test_job_script(self):
+        self.assertEqual(os.path.join(job_server.BIN_DIR, "cluster_gaps.py"), job_script("cluster_gaps"))
+        self.assertEqual(os.path.join(job_server.BIN_DIR, "cluster_gaps.py"), job_script("cluster_gaps.py"))
+
+    def test_job_script_unknownJobRaises(self):
+        self.assertRaises(UnknownJobError, job_script, "split_read")
+
+
+class ListenTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_file_name = os.path.join(self.directory, "jobs.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_listen_replacesStaleSocket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_file_name)
+        stale.close()
+
+        listener = _listen(self.socket_file_name)
+        try:
+            self.assertRaises(ServerRunningError, _listen, self.socket_file_name)
+        finally:
+            listener.close()
+
+
+class ServeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_file_name = os.path.join(self.directory, "jobs.sock")
+        self.mapping_file_name = os.path.join(self.directory, "mapping.txt")
+        with open(self.mapping_file_name, "w") as mapping_file:
+            mapping_file.write("ENSMUST01\tENSMUSG01\tGnai3\n")
+        with open(os.path.join(self.directory, "transcripts.tab"), "w") as transcript_file:
+            transcript_file.write("1\tENSMUST01\n2\tENSMUST02\n")
+        self.server = subprocess.Popen([sys.executable, os.path.join(job_server.BIN_DIR, "job_server.py"), "serve", self.socket_file_name, "--workers=2", "--gene-map=" + self.mapping_file_name], stderr=open(os.devnull, "w"))
+        for _ in range(300):
+            if os.path.exists(self.socket_file_name):
+                break
+            time.sleep(0.1)
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.terminate()
+            self.server.wait()
+        shutil.rmtree(self.directory)
+
+    def test_submit(self):
+        writer = StringIO()
+
+        status = submit(self.socket_file_name, "transcript_to_gene_symbol", ["transcripts.tab", "1", "mapping.txt", "genes.tab"], writer, cwd=self.directory)
+
+        self.assertEqual(0, status)
+        self.assertTrue("1 missed transcript lines\n" in writer.getvalue())
+        with open(os.path.join(self.directory, "genes.tab")) as genes_file:
+            self.assertEqual("1\tENSMUST01\tGnai3\n2\tENSMUST02\tNot found.\n", genes_file.read())
+
+    def test_submit_usesPreloadedGeneMap(self):
+        os.remove(self.mapping_file_name)
+        os.remove(self.mapping_file_name + ".cache")
+
+        status = submit(self.socket_file_name, "transcript_to_gene_symbol", ["transcripts.tab", "1", "mapping.txt", "genes.tab"], StringIO(), cwd=self.directory)
+
+        self.assertEqual(0, status)
+        self.assertFalse(os.path.exists(self.mapping_file_name + ".cache"))
+        with open(os.path.join(self.directory, "genes.tab")) as genes_file:
+            self.assertEqual("1\tENSMUST01\tGnai3\n2\tENSMUST02\tNot found.\n", genes_file.read())
+
+    def test_submit_outputMayContainNul(self):
+        with open(os.path.join(self.directory, "nul_mapping.txt"), "w") as mapping_file:
+            mapping_file.write("ENSMUST01\tENSMUSG01\tGnai3\nENSMUST\x0002\n")
+        writer = StringIO()
+
+        status = submit(self.socket_file_name, "transcript_to_gene_symbol", ["transcripts.tab", "1", "nul_mapping.txt", "genes.tab"], writer, cwd=self.directory)
+
+        self.assertEqual(0, status)
+        self.assertTrue("No gene symbol for transcript: 'ENSMUST\x0002'\n" in writer.getvalue())
+        self.assertTrue(writer.getvalue().endswith("done.\n"))
+
+    def test_submit_returnsJobExitStatus(self):
+        writer = StringIO()
+
+        status = submit(self.socket_file_name, "transcript_to_gene_symbol", ["missing.tab", "1", "mapping.txt", "genes.tab"], writer, cwd=self.directory)
+
+        self.assertEqual(1, status)
+        self.assertTrue("missing.tab" in writer.getvalue())
+
+    def test_terminateRemovesSocket(self):
+        self.server.terminate()
+        self.server.wait()
+
+        self.assertFalse(os.path.exists(self.socket_file_name))
+
+if __name__ == "__main__":
+    unittest.main()
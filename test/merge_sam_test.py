@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+from bin.merge_sam import merge_headers, merged_lines, merge, PrefetchingReader, UnsortedInputError
+
+
+class MergeHeadersTestCase(unittest.TestCase):
+
+    def test_merge_headers_unionsAndOrdersHeaders(self):
+        headers_a = ["@HD\tVN:1.0\n", "@SQ\tSN:chr1\n", "@RG\tID:a\tSM:a\n", "@PG\tID:bowtie\n", "@CO\tfoo\n"]
+        headers_b = ["@HD\tVN:1.4\n", "@SQ\tSN:chr1\n", "@SQ\tSN:chr2\n", "@PG\tID:bowtie\n", "@RG\tID:b\tSM:b\n"]
+
+        actual = merge_headers([headers_a, headers_b])
+
+        self.assertEqual(["@HD\tVN:1.0\n", "@SQ\tSN:chr1\n", "@SQ\tSN:chr2\n",
+            "@RG\tID:a\tSM:a\n", "@RG\tID:b\tSM:b\n", "@CO\tfoo\n"], actual)
+
+
+class MergedLinesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, lines):
+        file_name = os.path.join(self.directory, name)
+        with open(file_name, "w") as sam_file:
+            sam_file.write("".join(line + "\n" for line in lines))
+        return file_name
+
+    def test_prefetching_reader(self):
+        lines = ["line{0}".format(i) for i in range(1000)]
+        file_name = self._write("a.sam", lines)
+        self.assertEqual([line + "\n" for line in lines], list(PrefetchingReader(file_name)))
+
+    def test_merged_lines_concatenates(self):
+        file_a = self._write("a.sam", ["@SQ\tSN:chr1", "readA\t0\tchr1\t50", "readB\t0\tchr1\t10 XA:i:0  MD:Z:5"])
+        file_b = self._write("b.sam", ["@SQ\tSN:chr1", "@RG\tID:b\tSM:b", "readC\t0\tchr1\t20"])
+
+        actual = list(merged_lines([file_a, file_b]))
+
+        self.assertEqual(["@SQ\tSN:chr1\n", "@RG\tID:b\tSM:b\n", "readA\t0\tchr1\t50\n",
+            "readB\t0\tchr1\t10\tXA:i:0\tMD:Z:5\n", "readC\t0\tchr1\t20\n"], actual)
+
+    def test_merged_lines_notifiesEachInput(self):
+        file_a = self._write("a.sam", ["@SQ\tSN:chr1", "readA\t0\tchr1\t50"])
+        file_b = self._write("b.sam", ["@SQ\tSN:chr1", "readB\t0\tchr1\t20", "readC\t0\tchr1\t10"])
+        inputs = []
+
+        actual = [(inputs[-1] if inputs else None, line) for line in merged_lines([file_a, file_b], on_input=inputs.append)]
+
+        self.assertEqual([(None, "@SQ\tSN:chr1\n"), (0, "readA\t0\tchr1\t50\n"), (1, "readB\t0\tchr1\t20\n"), (1, "readC\t0\tchr1\t10\n")], actual)
+
+    def test_merged_lines_coordinateSorted(self):
+        file_a = self._write("a.sam", ["@SQ\tSN:chr2", "@SQ\tSN:chr1",
+            "a1\t0\tchr2\t5", "a2\t0\tchr2\t30", "a3\t0\tchr1\t7", "a4\t4\t*\t0"])
+        file_b = self._write("b.sam", ["@SQ\tSN:chr2", "@SQ\tSN:chr1",
+            "b1\t0\tchr2\t5", "b2\t0\tchr2\t10", "b3\t0\tchr1\t1"])
+
+        actual = [line.split("\t")[0] for line in merged_lines([file_a, file_b], coordinate_sorted=True)]
+
+        self.assertEqual(["@SQ", "@SQ", "a1", "b1", "b2", "a2", "b3", "a3", "a4"], actual)
+
+    def test_merged_lines_raisesOnUnsortedInput(self):
+        file_a = self._write("a.sam", ["@SQ\tSN:chr1", "a1\t0\tchr1\t50", "a2\t0\tchr1\t10"])
+
+        self.assertRaises(UnsortedInputError, list, merged_lines([file_a], coordinate_sorted=True))
+
+    def test_merge_returnsAlignmentCount(self):
+        file_a = self._write("a.sam", ["@SQ\tSN:chr1", "a1\t0\tchr1\t50"])
+        file_b = self._write("b.sam", ["@SQ\tSN:chr1", "b1\t0\tchr1\t10"])
+        writer = MockWriter()
+
+        self.assertEqual(2, merge([file_a, file_b], writer))
+        self.assertEqual(["@SQ\tSN:chr1", "a1\t0\tchr1\t50", "b1\t0\tchr1\t10"], writer.lines())
+
+
+class MockWriter():
+    def __init__(self):
+        self._content = []
+
+    def write(self, content):
+        self._content.append(content)
+
+    def lines(self):
+        return "".join(self._content).splitlines()
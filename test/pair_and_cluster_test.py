@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+from bin.cluster_gaps import GapTableBuilder, GapUtility
+from bin.identify_pairs import SamSplitReadBuilder, identify_read_group_pairs, _write_sam_pairs
+from bin import pair_and_cluster
+from bin.pair_and_cluster import pair_alignments, read_group_line, rsw_file_name
+
+
+SAM_HEADER = "@HD\tVN:1.0\n@SQ\tSN:T1\tLN:5000\n@PG\tID:Bowtie\n"
+
+def alignment(name, chromosome, position, seq):
+    return "{0}\t0\t{1}\t{2}\t255\t{3}M\t*\t0\t0\t{4}\t{5}\tXA:i:0\tMD:Z:{3}\tNM:i:0\n".format(name, chromosome, position, len(seq), seq, "I" * len(seq))
+
+
+class PairAndClusterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_file_name = os.path.join(self.directory, "sampleA_R1.sam")
+        lines = [SAM_HEADER]
+        for (i, position) in enumerate([100, 101, 103, 900]):
+            lines.append(alignment("read{0}-L-8".format(i), "T1", position, "A" * 8))
+            lines.append(alignment("read{0}-R-12".format(i), "T1", position + 58, "C" * 12))
+        lines.append(alignment("orphan-L-8", "T1", 300, "A" * 8))
+        lines.append("unaligned-R-12\t4\t*\t0\t0\t*\t*\t0\t0\tCCCCCCCCCCCC\tIIIIIIIIIIII\n")
+        with open(self.input_file_name, "w") as input_file:
+            input_file.write("".join(lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rsw_file_name(self):
+        self.assertEqual("/foo/sampleA.04-align.rsw", rsw_file_name("/foo/sampleA.04-align.sam"))
+
+    def test_read_group_line(self):
+        self.assertEqual("@RG|ID:sampleA|SM:sampleA\n", read_group_line("sampleA", "|"))
+
+    def test_pair_alignments_matchesIdentifyPairsSamOutput(self):
+        read_group_pairs = identify_read_group_pairs(20, self.input_file_name, 2, 39999, MockLogger())
+        builder = GapTableBuilder()
+
+        actual_writer = MockWriter()
+
+        count = pair_alignments("sampleA", self.input_file_name, read_group_pairs, 20, builder, actual_writer)
+
+        writer = MockWriter()
+        with open(self.input_file_name, "r") as reader:
+            _write_sam_pairs(read_group_pairs, reader, SamSplitReadBuilder(20), writer, MockLogger(), read_group=("sampleA", "sampleA"))
+        expected_lines = [line for line in writer.lines if not line.startswith("@")]
+        self.assertEqual(expected_lines, actual_writer.lines)
+        self.assertEqual(len(expected_lines), count)
+
+        gap_utility = GapUtility(20, "\t", MockLogger())
+        gap_utility.process_sam_header_line(read_group_line("sampleA"))
+        expected_gaps = list(gap_utility.samfile_to_gaps(expected_lines))
+        self.assertEqual(4, len(expected_gaps))
+        self.assertEqual(expected_gaps, list(builder.build()))
+
+    def test_main(self):
+        gap_file_name = os.path.join(self.directory, "out.tab")
+        output_sam_file_name = os.path.join(self.directory, "out.sam")
+        original_logger = pair_and_cluster.StdErrLogger
+        pair_and_cluster.StdErrLogger = MockStdErrLogger
+        try:
+            pair_and_cluster.main([("sampleA", self.input_file_name)], 20, 2, 39999, gap_file_name, output_sam_file_name)
+        finally:
+            pair_and_cluster.StdErrLogger = original_logger
+
+        with open(gap_file_name, "r") as gap_file:
+            gap_lines = [line for line in gap_file if not line.startswith("#")]
+        self.assertEqual(4, len(gap_lines))
+        self.assertEqual(["T1", "0", "sampleA", "108", "158"], gap_lines[0].split("\t")[:5])
+        self.assertEqual(["T1", "-1", "sampleA", "908", "958"], gap_lines[3].split("\t")[:5])
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, "out.cluster-groups.tab")))
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, "out.sample-groups.tab")))
+        self.assertTrue(os.path.isfile(rsw_file_name(self.input_file_name)))
+        with open(output_sam_file_name, "r") as output_sam_file:
+            sam_lines = output_sam_file.readlines()
+        self.assertIn("@RG\tID:sampleA\tSM:sampleA\n", sam_lines)
+        records = [line for line in sam_lines if not line.startswith("@")]
+        self.assertEqual(8, len(records))
+        self.assertTrue(records[0].rstrip().endswith("RG:Z:sampleA\tXC:i:0\tXR:Z:read0"))
+        self.assertEqual(sorted(["out.tab", "out.cluster-groups.tab", "out.sample-groups.tab", "out.sam", "sampleA_R1.sam", "sampleA_R1.rsw"]), sorted(os.listdir(self.directory)))
+
+
+class MockLogger():
+    def log(self, message, verbose=None):
+        pass
+
+
+class MockStdErrLogger(MockLogger):
+    def __init__(self, verbose=False):
+        pass
+
+
+class MockWriter():
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+if __name__ == "__main__":
+    unittest.main()
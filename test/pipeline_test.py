@@ -0,0 +1,209 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from bin.pipeline import Task, Pipeline, build_tasks, DuplicateOutputError, CyclicDependencyError
+
+
+def python_command(source):
+    return [sys.executable, "-c", source]
+
+def copy_task(name, input_name, output_name, **kwargs):
+    return Task(name, [python_command("import shutil; shutil.copy('{0}', '{1}')".format(input_name, output_name))], [input_name], [output_name], **kwargs)
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        Pipeline._POLL_INTERVAL = 0.01
+        self.write("a.txt", "a")
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def path(self, name):
+        return os.path.join(self.working_dir, name)
+
+    def write(self, name, content):
+        with open(self.path(name), "w") as outfile:
+            outfile.write(content)
+
+    def read(self, name):
+        with open(self.path(name), "r") as infile:
+            return infile.read()
+
+    def age(self, name, seconds):
+        mtime = os.path.getmtime(self.path(name)) - seconds
+        os.utime(self.path(name), (mtime, mtime))
+
+    def chain(self):
+        return [copy_task("c", "b.txt", "c.txt"),
+            copy_task("b", "a.txt", "b.txt"),
+            copy_task("x", "a.txt", "x.txt")]
+
+    def test_dependencies(self):
+        pipeline = Pipeline(self.chain(), 1, 1000, self.working_dir, MockLogger())
+        self.assertEqual(["b"], pipeline.dependencies("c"))
+        self.assertEqual([], pipeline.dependencies("b"))
+        self.assertEqual(["b", "x", "c"], pipeline.order())
+
+    def test_duplicateOutputRaises(self):
+        tasks = [copy_task("b", "a.txt", "b.txt"), copy_task("b2", "a.txt", "b.txt")]
+        self.assertRaises(DuplicateOutputError, Pipeline, tasks, 1, 1000)
+
+    def test_cycleRaises(self):
+        tasks = [copy_task("b", "c.txt", "b.txt"), copy_task("c", "b.txt", "c.txt")]
+        self.assertRaises(CyclicDependencyError, Pipeline, tasks, 1, 1000)
+
+    def test_run(self):
+        pipeline = Pipeline(self.chain(), 2, 1000, self.working_dir, MockLogger())
+
+        (completed, skipped, failed) = pipeline.run()
+
+        self.assertEqual(["b", "c", "x"], sorted(completed))
+        self.assertEqual(([], []), (skipped, failed))
+        self.assertEqual("a", self.read("c.txt"))
+        self.assertTrue(os.path.isfile(self.path(os.path.join("logs", "c.log"))))
+
+    def test_run_skipsUpToDateTasks(self):
+        Pipeline(self.chain(), 2, 1000, self.working_dir, MockLogger()).run()
+
+        pipeline = Pipeline(self.chain(), 2, 1000, self.working_dir, MockLogger())
+
+        self.assertEqual([], pipeline.stale_tasks())
+        self.assertEqual(([], ["b", "x", "c"], []), pipeline.run())
+
+    def test_run_rerunsStaleTaskAndDependents(self):
+        Pipeline(self.chain(), 2, 1000, self.working_dir, MockLogger()).run()
+        for name in ["b.txt", "c.txt", "x.txt"]:
+            self.age(name, 100)
+        self.age("a.txt", 50)
+        self.write("x.txt", "newer than a.txt")
+
+        pipeline = Pipeline(self.chain(), 2, 1000, self.working_dir, MockLogger())
+
+        self.assertEqual(["b", "c"], pipeline.stale_tasks())
+        (completed, skipped, _) = pipeline.run()
+        self.assertEqual((["b", "c"], ["x"]), (completed, skipped))
+
+    def test_run_failureBlocksDependents(self):
+        tasks = [copy_task("b", "missing.txt", "b.txt"),
+            copy_task("c", "b.txt", "c.txt"),
+            copy_task("x", "a.txt", "x.txt")]
+        pipeline = Pipeline(tasks, 2, 1000, self.working_dir, MockLogger())
+
+        (completed, skipped, failed) = pipeline.run()
+
+        self.assertEqual((["x"], [], ["b"]), (completed, skipped, failed))
+        self.assertFalse(os.path.exists(self.path("c.txt")))
+
+    def test_run_respectsBudget(self):
+        source = "import os, time; assert not os.path.exists('lock'); open('lock', 'w').close(); time.sleep(0.1); os.remove('lock'); open('{0}', 'w').close()"
+        tasks = [Task(name, [python_command(source.format(name))], ["a.txt"], [name], processors=2, memory=10) for name in ["b", "c", "d"]]
+        pipeline = Pipeline(tasks, 3, 1000, self.working_dir, MockLogger())
+
+        (completed, _, failed) = pipeline.run()
+
+        self.assertEqual((["b", "c", "d"], []), (sorted(completed), failed))
+
+    def test_run_tasksLargerThanBudgetRunAlone(self):
+        tasks = [copy_task("b", "a.txt", "b.txt", processors=8, memory=64000)]
+        pipeline = Pipeline(tasks, 2, 1000, self.working_dir, MockLogger())
+
+        self.assertEqual((["b"], [], []), pipeline.run())
+
+    def test_run_runsIndependentTasksConcurrently(self):
+        source = "import time; time.sleep(0.3); open('{0}', 'w').close()"
+        tasks = [Task(name, [python_command(source.format(name))], ["a.txt"], [name], memory=10) for name in ["b", "c", "d", "e"]]
+        pipeline = Pipeline(tasks, 4, 1000, self.working_dir, MockLogger())
+
+        start = time.time()
+        pipeline.run()
+
+        self.assertLess(time.time() - start, 1.0)
+
+
+class BuildTasksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        Pipeline._POLL_INTERVAL = 0.01
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_build_tasks(self):
+        tasks = build_tasks(["Sample_A", "Sample_B"], 50, 4)
+        pipeline = Pipeline(tasks, 2, 1000, self.working_dir, MockLogger())
+
+        self.assertEqual(2 * (2 * 4 + 1) + 3, len(tasks))
+        self.assertEqual(["Sample_A_R1.02-bowtie-genome"], pipeline.dependencies("Sample_A_R1.03-split_reads"))
+        self.assertEqual(["Sample_A_R1.04-bowtie_align_splits_to_transcriptome", "Sample_A_R2.04-bowtie_align_splits_to_transcriptome"],
+            pipeline.dependencies("Sample_A.05-identify_pairs_transcriptome"))
+        self.assertEqual(["Sample_A.05-identify_pairs_transcriptome", "Sample_B.05-identify_pairs_transcriptome"],
+            pipeline.dependencies("all_samples_merged.06-postprocess"))
+        self.assertEqual(["all_samples_merged.07-cluster"], pipeline.dependencies("all_samples_merged.08-genes"))
+        self.assertEqual("all_samples_merged.08-genes", pipeline.order()[-1])
+
+    def test_build_tasks_identifyPairsTagsReadGroup(self):
+        tasks = build_tasks(["Sample_A"], 50, 4)
+        identify_pairs = [task for task in tasks if task.name == "Sample_A.05-identify_pairs_transcriptome"][0]
+        self.assertEqual(["50", "2", "39999", "Sample_A", "Sample_A"], identify_pairs.commands[0][-5:])
+
+    def test_build_tasks_identifyPairsJointMates(self):
+        tasks = build_tasks(["Sample_A"], 50, 4)
+        identify_pairs = [task for task in tasks if task.name == "Sample_A.05-identify_pairs_transcriptome"][0]
+
+        self.assertEqual("R1=Sample_A_R1.04-bowtie_align_splits_to_transcriptome.sam,R2=Sample_A_R2.04-bowtie_align_splits_to_transcriptome.sam", identify_pairs.commands[0][2])
+        self.assertEqual(["Sample_A.05-identify_pairs_transcriptome.rsw", "Sample_A.05-identify_pairs_transcriptome.sam"], identify_pairs.outputs)
+
+    def test_build_tasks_genesLinkClusterOrderedGapFile(self):
+        tasks = build_tasks(["Sample_A"], 50, 4)
+        cluster = [task for task in tasks if task.name == "all_samples_merged.07-cluster"][0]
+        genes = [task for task in tasks if task.name == "all_samples_merged.08-genes"][0]
+
+        self.assertTrue("all_samples_merged.07-cluster.sorted.tab" in cluster.outputs)
+        self.assertEqual(["ln", "-f", "all_samples_merged.07-cluster.sorted.tab", "all_samples_merged.08-genes.tab"], genes.commands[0])
+
+    def test_build_tasks_collapseDuplicates(self):
+        split_reads = lambda tasks: [task for task in tasks if task.name == "Sample_A_R1.03-split_reads"][0]
+
+        self.assertEqual("4", split_reads(build_tasks(["Sample_A"], 50, 4)).commands[0][-1])
+        self.assertEqual("--collapse-duplicates", split_reads(build_tasks(["Sample_A"], 50, 4, collapse_duplicates=True)).commands[0][-1])
+
+    def test_build_tasks_filterReads(self):
+        tasks = build_tasks(["Sample_A"], 50, 4, filter_reads=True)
+        split_reads = [task for task in tasks if task.name == "Sample_A_R1.03-split_reads"][0]
+
+        self.assertEqual("--filter", split_reads.commands[0][-1])
+        self.assertEqual(["Sample_A_R1.03-split_reads.fastq", "Sample_A_R1.03-split_reads.filter_stats.tab"], split_reads.outputs)
+
+    def test_build_tasks_stubBowtie(self):
+        stub = os.path.join(self.working_dir, "bowtie_stub.py")
+        with open(stub, "w") as stub_file:
+            stub_file.write("import shutil, sys\nargs = sys.argv[1:]\nshutil.copy(args[args.index('-q') + 1], args[args.index('--un') + 1])\n")
+        with open(os.path.join(self.working_dir, "Sample_A_R1.fastq"), "w") as fastq:
+            fastq.write("@read1\nAAAAACCCCCGGGGGTTTTT\n+\nIIIIIIIIIIIIIIIIIIII\n")
+        tasks = build_tasks(["Sample_A"], 20, 4, bowtie_command=[sys.executable, stub])[:3]
+        pipeline = Pipeline(tasks, 2, 100000, self.working_dir, MockLogger())
+
+        (completed, _, failed) = pipeline.run()
+
+        self.assertEqual([], failed)
+        self.assertEqual(["Sample_A_R1.01-bowtie-transcriptome", "Sample_A_R1.02-bowtie-genome", "Sample_A_R1.03-split_reads"], completed)
+        self.assertTrue(os.path.getsize(os.path.join(self.working_dir, "Sample_A_R1.03-split_reads.fastq")) > 0)
+
+
+class MockLogger():
+    def __init__(self):
+        self._messages = []
+
+    def log(self, message):
+        self._messages.append(message)
+
+
+if __name__ == "__main__":
+    unittest.main()
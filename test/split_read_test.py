@@ -1,8 +1,9 @@
 import unittest
 import tempfile
 import os
+import shutil
 
-from bin.split_read import FQStanza, build_splits, write_stanzas, stanza_generator
+from bin.split_read import DuplicateCollapser, FQStanza, ReadFilter, build_splits, duplicate_count, filter_stats_file_name, write_stanzas, stanza_generator
 
 
 class FQStanzaTest(unittest.TestCase):
@@ -120,6 +121,108 @@ DEF
 		self.assertEquals("@h2", stanzas[1].main_header)
 
 
+class DuplicateCollapserTest(unittest.TestCase):
+
+	def setUp(self):
+		self.spill_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.spill_dir)
+
+	def test_duplicate_count(self):
+		self.assertEquals(1, duplicate_count("@read1"))
+		self.assertEquals(12, duplicate_count("@read1;size=12"))
+		self.assertEquals(12, duplicate_count("read1;size=12-L-20"))
+
+	def test_collapse(self):
+		stanzas = [FQStanza("@r1", "AAAA", "+", "1111"), FQStanza("@r2", "CCCC", "+", "2222"),
+			FQStanza("@r3", "AAAA", "+", "3333"), FQStanza("@r4", "AAAA", "+", "4444")]
+		collapser = DuplicateCollapser()
+
+		actual = [str(stanza) for stanza in collapser.collapse(stanzas)]
+
+		self.assertEquals(["@r1;size=3\nAAAA\n+\n1111", "@r2\nCCCC\n+\n2222"], actual)
+		self.assertEquals((4, 2), (collapser.read_count, collapser.distinct_count))
+
+	def test_collapse_addsExistingCounts(self):
+		stanzas = [FQStanza("@r1;size=2", "AAAA", "+", "1111"), FQStanza("@r2;size=5", "AAAA", "+", "2222")]
+
+		actual = list(DuplicateCollapser().collapse(stanzas))
+
+		self.assertEquals(["@r1;size=7"], [stanza.main_header for stanza in actual])
+
+	def test_collapse_spillsBeyondMemory(self):
+		sequences = ["ACGT"[i % 4] * 10 + "ACGT"[i % 3] * 10 for i in range(200)]
+		stanzas = [FQStanza("@r{0}".format(i), seq, "+", "I" * 20) for i, seq in enumerate(sequences)]
+		collapser = DuplicateCollapser(memory_bytes=2000, spill_dir=self.spill_dir)
+
+		actual = list(collapser.collapse(stanzas))
+
+		expected = dict((stanza.seq, stanza.main_header) for stanza in DuplicateCollapser().collapse(stanzas))
+		self.assertEquals(expected, dict((stanza.seq, stanza.main_header) for stanza in actual))
+		self.assertEquals(12, len(actual))
+		self.assertEquals((200, 12), (collapser.read_count, collapser.distinct_count))
+		self.assertEquals([], os.listdir(self.spill_dir))
+
+	def test_collapse_splitsOncePerSequence(self):
+		stanzas = [FQStanza("@r1", "ABCDE", "+", "12345"), FQStanza("@r2", "ABCDE", "+", "12345")]
+		writer = MockWriter()
+
+		write_stanzas(DuplicateCollapser().collapse(stanzas), writer, 2)
+
+		headers = writer.lines()[0::4]
+		self.assertEquals(["@r1;size=2-L-2", "@r1;size=2-R-3", "@r1;size=2-L-3", "@r1;size=2-R-2"], headers)
+
+
+class ReadFilterTest(unittest.TestCase):
+
+	def test_failures(self):
+		stanzas = [FQStanza("@ok", "ACGTACGTTGCAACGT", "+", "I" * 16),
+			FQStanza("@polyA", "ACGTCAAAAAAAAAAA", "+", "I" * 16),
+			FQStanza("@polyT", "TTTTTTTTTACGTCGA", "+", "I" * 16),
+			FQStanza("@Ns", "ACGTNNACGTNNACGT", "+", "I" * 16),
+			FQStanza("@lowQuality", "ACGTACGTTGCAACGT", "+", "#" * 16),
+			FQStanza("@homopolymer", "GGGGGGGGGGGGGGGC", "+", "I" * 16)]
+
+		failures = ReadFilter().failures(stanzas)
+
+		self.assertEquals([False, False, False, False, False, True], failures["entropy"].tolist())
+		self.assertEquals([False, True, True, False, False, False], failures["poly_a"].tolist())
+		self.assertEquals([False, False, False, True, False, False], failures["n_fraction"].tolist())
+		self.assertEquals([False, False, False, False, True, False], failures["mean_quality"].tolist())
+
+	def test_failures_disabledFilter(self):
+		stanzas = [FQStanza("@lowQuality", "ACGTACGTTGCAACGT", "+", "#" * 16)]
+
+		failures = ReadFilter(min_mean_quality=None).failures(stanzas)
+
+		self.assertEquals(["entropy", "n_fraction", "poly_a"], sorted(failures))
+
+	def test_filter_countsAcrossBlocks(self):
+		read_filter = ReadFilter()
+		read_filter._BLOCK_SIZE = 2
+		stanzas = [FQStanza("@r{0}".format(i), "ACGTACGTTGCAACGT" if i % 3 else "NNNNNNNNNNNNNNNN", "+", "I" * 16) for i in range(7)]
+
+		actual = [stanza.main_header for stanza in read_filter.filter(stanzas)]
+
+		self.assertEquals(["@r1", "@r2", "@r4", "@r5"], actual)
+		self.assertEquals(7, read_filter.counts["input"])
+		self.assertEquals(3, read_filter.counts["n_fraction"])
+		self.assertEquals(4, read_filter.counts["passed"])
+
+	def test_write_stats(self):
+		read_filter = ReadFilter(max_poly_a=None)
+		list(read_filter.filter([FQStanza("@r1", "NNNN", "+", "IIII"), FQStanza("@r2", "ACGT", "+", "IIII")]))
+		writer = MockWriter()
+
+		read_filter.write_stats(writer)
+
+		self.assertEquals(["#filter\tthreshold\treads", "input\t\t2", "entropy\t1.0\t1", "poly_a\t\t0", "n_fraction\t0.1\t1", "mean_quality\t20\t0", "passed\t\t1"], writer.lines())
+
+	def test_filter_stats_file_name(self):
+		self.assertEquals("/tmp/sample.03-split_reads.filter_stats.tab", filter_stats_file_name("/tmp/sample.03-split_reads.fastq"))
+
+
 def init_stanza(header):
 	return FQStanza(header, "ABCDE", "score_header", "score")
 		
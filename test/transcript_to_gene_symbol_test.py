@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from bin import transcript_to_gene_symbol
+from bin.transcript_to_gene_symbol import parse_gene_map, annotate_file, \
+    annotate_files, batch_file_name_pairs
+
+
+class ParseGeneMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mapping_file_name = os.path.join(self.directory, "mapping.txt")
+        self._write_mapping("ENSMUST01\tENSMUSG01\tGnai3\nENSMUST03\tENSMUSG03\tPbsn\nENSMUST04\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_mapping(self, content):
+        with open(self.mapping_file_name, "w") as mapping_file:
+            mapping_file.write(content)
+
+    def test_parse_gene_map(self):
+        gene_map = parse_gene_map(self.mapping_file_name)
+        self.assertEqual({"ENSMUST01": "Gnai3", "ENSMUST03": "Pbsn", "ENSMUST04": ""}, gene_map)
+        self.assertTrue(os.path.isfile(self.mapping_file_name + ".cache"))
+
+    def test_parse_gene_map_usesCacheWhenUnchanged(self):
+        parse_gene_map(self.mapping_file_name)
+        transcript_to_gene_symbol.GENE_MAPS.clear()
+        original_parse = transcript_to_gene_symbol._parse_gene_map
+        transcript_to_gene_symbol._parse_gene_map = None
+        try:
+            gene_map = parse_gene_map(self.mapping_file_name)
+        finally:
+            transcript_to_gene_symbol._parse_gene_map = original_parse
+        self.assertEqual("Gnai3", gene_map["ENSMUST01"])
+
+    def test_parse_gene_map_keepsLoadedMapInProcess(self):
+        gene_map = parse_gene_map(self.mapping_file_name)
+        original_read_cache = transcript_to_gene_symbol._read_cache
+        transcript_to_gene_symbol._read_cache = None
+        try:
+            self.assertTrue(gene_map is parse_gene_map(self.mapping_file_name))
+        finally:
+            transcript_to_gene_symbol._read_cache = original_read_cache
+
+    def test_parse_gene_map_keepsLoadedMapWhenFileRemoved(self):
+        gene_map = parse_gene_map(self.mapping_file_name)
+        os.remove(self.mapping_file_name)
+
+        self.assertTrue(gene_map is parse_gene_map(self.mapping_file_name))
+        self.assertRaises(OSError, parse_gene_map, os.path.join(self.directory, "missing.txt"))
+
+    def test_parse_gene_map_usesGivenRegistry(self):
+        registry = {}
+        gene_map = parse_gene_map(self.mapping_file_name, registry)
+        os.remove(self.mapping_file_name)
+
+        self.assertEqual([os.path.abspath(self.mapping_file_name)], list(registry))
+        self.assertFalse(os.path.abspath(self.mapping_file_name) in transcript_to_gene_symbol.GENE_MAPS)
+        self.assertTrue(gene_map is parse_gene_map(self.mapping_file_name, registry))
+        self.assertRaises(OSError, parse_gene_map, self.mapping_file_name)
+
+    def test_parse_gene_map_rebuildsWhenContentChanges(self):
+        parse_gene_map(self.mapping_file_name)
+        self._write_mapping("ENSMUST01\tENSMUSG01\tHoxb9\n")
+        stat = os.stat(self.mapping_file_name)
+        os.utime(self.mapping_file_name, (stat.st_atime, stat.st_mtime + 10))
+
+        self.assertEqual({"ENSMUST01": "Hoxb9"}, parse_gene_map(self.mapping_file_name))
+
+    def test_parse_gene_map_ignoresCorruptCache(self):
+        with open(self.mapping_file_name + ".cache", "wb") as cache_file:
+            cache_file.write(b"garbage")
+        self.assertEqual("Pbsn", parse_gene_map(self.mapping_file_name)["ENSMUST03"])
+
+
+class AnnotateFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gene_map = {"ENSMUST01": "Gnai3", "ENSMUST03": "Pbsn"}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, file_name, content):
+        file_name = os.path.join(self.directory, file_name)
+        with open(file_name, "w") as outfile:
+            outfile.write(content)
+        return file_name
+
+    def _read(self, file_name):
+        with open(file_name, "r") as infile:
+            return infile.read()
+
+    def test_annotate_file(self):
+        input_file_name = self._write("a.tab", "ENSMUST01\t5\nENSMUST02\t6\nENSMUST02\t7\nENSMUST03\t8\n")
+        output_file_name = os.path.join(self.directory, "a.out.tab")
+        stats = annotate_file(input_file_name, output_file_name, 0, self.gene_map)
+        self.assertEqual("ENSMUST01\t5\tGnai3\nENSMUST02\t6\tNot found.\nENSMUST02\t7\tNot found.\nENSMUST03\t8\tPbsn\n", self._read(output_file_name))
+        self.assertEqual(4, stats.total_lines)
+        self.assertEqual(2, stats.missed_lines)
+        self.assertEqual(set(["ENSMUST01", "ENSMUST03"]), stats.mapped_keys)
+        self.assertEqual(set(["ENSMUST02"]), stats.missed_keys)
+        self.assertEqual(["4 total transcript lines", "2 mapped transcripts", "2 missed transcript lines", "1 missed transcript IDs"], stats.summary())
+
+    def test_annotate_files(self):
+        pairs = []
+        for i in range(5):
+            input_file_name = self._write("{0}.tab".format(i), "x\tENSMUST01\n" * i)
+            pairs.append((input_file_name, input_file_name + ".out"))
+        all_stats = annotate_files(pairs, 1, self.gene_map, threads=3)
+        self.assertEqual([pair[0] for pair in pairs], [stats.input_file_name for stats in all_stats])
+        self.assertEqual([0, 1, 2, 3, 4], [stats.total_lines for stats in all_stats])
+        self.assertEqual("x\tENSMUST01\tGnai3\n" * 3, self._read(pairs[3][1]))
+
+    def test_batch_file_name_pairs(self):
+        a_file_name = self._write("a.tab", "")
+        b_file_name = self._write("b.tab", "")
+        pairs = batch_file_name_pairs(["in.tab=out.tab", os.path.join(self.directory, "*.tab")])
+        self.assertEqual([("in.tab", "out.tab"),
+            (a_file_name, os.path.join(self.directory, "a.genes.tab")),
+            (b_file_name, os.path.join(self.directory, "b.genes.tab"))], pairs)
+
+    def test_batch_file_name_pairs_missingFileRaises(self):
+        self.assertRaises(ValueError, batch_file_name_pairs, [os.path.join(self.directory, "*.missing")])